@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compare the streaming key path extraction with decoding the whole report
+#
+# Runs both over recorded serverinfo responses (json files given on the
+# command line) or, without any, over synthetic reports with a growing number
+# of apps. Reports the time per document and the peak memory allocated.
+#
+# usage: python3 benchmarks/extract.py [--runs 20] [--json results.json] [response.json ...]
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nextcloud_munin import registry  # noqa: E402
+from nextcloud_munin.extract import extract  # noqa: E402
+from nextcloud_munin.serverinfo import CHUNK_SIZE  # noqa: E402
+from server import synthetic  # noqa: E402
+
+# everything the multigraph plugin reads
+PATHS = registry.paths(tuple(registry.GRAPHS))
+
+
+def measure(function, runs):
+    started = time.perf_counter()
+    for _ in range(runs):
+        function()
+    elapsed = (time.perf_counter() - started) / runs
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='compare the streaming key path extraction with decoding the whole report')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('responses', nargs='*', help='recorded serverinfo responses')
+    args = parser.parse_args()
+
+    documents = list()
+    for path in args.responses:
+        with open(path, 'rb') as f:
+            documents.append((os.path.basename(path), f.read()))
+    if not documents:
+        documents = [('synthetic_%d_apps' % n, synthetic(n)) for n in (50, 500, 5000)]
+
+    results = list()
+    for name, body in documents:
+        def chunks():
+            return (body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE))
+
+        full_time, full_peak = measure(lambda: json.loads(b''.join(chunks())), args.runs)
+        extract_time, extract_peak = measure(lambda: extract(chunks(), PATHS), args.runs)
+
+        result = {'document': name, 'bytes': len(body),
+                  'json_time': full_time, 'json_peak_bytes': full_peak,
+                  'extract_time': extract_time, 'extract_peak_bytes': extract_peak}
+        results.append(result)
+        print('{document:24} {bytes:>10} bytes  json {json_time:.4f}s {json_peak_bytes:>10} B peak  '
+              'extract {extract_time:.4f}s {extract_peak_bytes:>10} B peak'.format(**result))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
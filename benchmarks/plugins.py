@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark every plugin class against a local serverinfo stand-in
+#
+# Starts benchmarks/server.py in-process and runs every plugin drawing
+# serverinfo graphs, including the multigraph plugin, in a fresh interpreter
+# per run for a set of scenarios (payload size, latency, error status,
+# nextcloud version). Measured are:
+#
+#   startup     wall time of a config run, i.e. interpreter start and imports
+#   process     wall time and peak RSS of a whole fetch run
+#   import      time to import the plugin module
+#   main        wall time of main() doing a fetch, including the lazy network imports
+#   fetch       time of serverinfo.fetch() once the network stack is loaded
+#   parse       time of turning the report into value lines
+#   peak        memory allocated by python during main(), via tracemalloc
+#
+# Caching is disabled and the circuit breaker never opens, every run talks to
+# the stand-in. The results are written as json, --compare prints the change
+# against an earlier result file.
+#
+# usage: python3 benchmarks/plugins.py [--runs 5] [--scenario large] [--json results.json]
+#                                      [--compare earlier.json]
+import argparse
+import contextlib
+import glob
+import importlib.util
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from server import DEFAULT_VERSION, StandIn, serve, sized  # noqa: E402
+
+SCENARIOS = [
+    {'name': 'small', 'payload_kb': 4},
+    {'name': 'large', 'payload_kb': 2048},
+    {'name': 'large_gzip', 'payload_kb': 2048, 'compress': True},
+    {'name': 'latency', 'payload_kb': 4, 'latency': 0.2},
+    {'name': 'server_error', 'payload_kb': 4, 'status': 996},
+    {'name': 'old_version', 'payload_kb': 4, 'version': '13.0.0.0'},
+]
+
+# the metrics compared by --compare
+COMPARED = ('main_time', 'fetch_time', 'parse_time', 'main_peak_bytes', 'max_rss_kb')
+
+
+def plugin_class(path):
+    # import a plugin script and return the plugin class it defines together with the import time
+    started = time.perf_counter()
+    spec = importlib.util.spec_from_file_location('benchmarked_plugin', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    import_time = time.perf_counter() - started
+
+    from nextcloud_munin.plugin import NextcloudPlugin
+    for value in vars(module).values():
+        if isinstance(value, type) and issubclass(value, NextcloudPlugin) and value.__module__ == module.__name__:
+            return value, import_time
+
+    raise ValueError('%s defines no plugin class' % path)
+
+
+def serverinfo_plugins():
+    # the plugins drawing registry graphs, the ones reading the database, logs or the data directory
+    # never talk to the stand-in
+    sys.path.insert(0, ROOT)
+    return [path for path in sorted(glob.glob(os.path.join(ROOT, 'nextcloud_*.py'))) if plugin_class(path)[0].graphs]
+
+
+def child(path):
+    # runs inside the fresh interpreter, prints the in-process measurements as json
+    sys.path.insert(0, ROOT)
+    cls, import_time = plugin_class(path)
+    from nextcloud_munin import serverinfo
+
+    sys.argv = [path, 'fetch']
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        started = time.perf_counter()
+        cls().main()
+        main_time = time.perf_counter() - started
+
+    plugin = cls()
+    started = time.perf_counter()
+    report = serverinfo.fetch(sections=plugin.sections, paths=plugin.paths)
+    fetch_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    error = plugin.handle(report)
+    parse_time = time.perf_counter() - started
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        cls().main()
+    main_peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(json.dumps({
+        'class': cls.__name__,
+        'import_time': import_time,
+        'main_time': main_time,
+        'fetch_time': fetch_time,
+        'parse_time': parse_time,
+        'main_peak_bytes': main_peak_bytes,
+        'output_lines': len(output.getvalue().splitlines()),
+        'error': error,
+        'max_rss_kb': peak_rss(),
+    }))
+
+
+def peak_rss():
+    # peak resident set size of this process in KB, the rusage of a child also counts its parent before exec
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(command, environment):
+    # returns (wall time, stdout) of one fresh process
+    started = time.perf_counter()
+    output = subprocess.run(command, cwd=ROOT, env=environment, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            check=True).stdout
+    return time.perf_counter() - started, output
+
+
+def measure(plugin, environment, runs):
+    startup = [run([sys.executable, plugin, 'config'], environment)[0] for _ in range(runs)]
+
+    samples = list()
+    for _ in range(runs):
+        wall_time, output = run([sys.executable, os.path.abspath(__file__), '--child', plugin], environment)
+        samples.append(dict(json.loads(output.decode('utf-8')), process_time=wall_time))
+
+    result = {'plugin': os.path.basename(plugin), 'class': samples[0]['class'], 'runs': runs,
+              'startup_time': statistics.median(startup), 'error': samples[0]['error'],
+              'output_lines': samples[0]['output_lines']}
+    for metric in ('process_time', 'max_rss_kb', 'import_time', 'main_time', 'fetch_time', 'parse_time',
+                   'main_peak_bytes'):
+        result[metric] = statistics.median(sample[metric] for sample in samples)
+    return result
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, path):
+    with open(path) as f:
+        earlier = {(r['scenario']['name'], r['plugin']): r for r in json.load(f)['results']}
+
+    for result in results:
+        before = earlier.get((result['scenario']['name'], result['plugin']))
+        if before is None:
+            continue
+        changes = ['%s %+.0f%%' % (metric, (result[metric] / before[metric] - 1) * 100)
+                   for metric in COMPARED if before.get(metric)]
+        print('{:14} {:24} {}'.format(result['scenario']['name'], result['plugin'], '  '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the plugins against a local serverinfo stand-in')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--scenario', action='append', help='only run these scenarios, default all')
+    parser.add_argument('--json', help='write the results to this file, default benchmarks/results/<revision>.json')
+    parser.add_argument('--compare', help='print the change against an earlier result file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    stand_in = StandIn()
+    server, url = serve(stand_in)
+    state = tempfile.TemporaryDirectory()
+    environment = dict(os.environ, url=url, username='benchmark', password='benchmark', cache_ttl='0',
+                       MUNIN_PLUGSTATE=state.name, breaker_threshold=str(sys.maxsize))
+    for variable in ('collector_socket', 'instances', 'MUNIN_DEBUG', 'MUNIN_CAP_DIRTYCONFIG'):
+        environment.pop(variable, None)
+
+    results = list()
+    plugins = serverinfo_plugins()
+    try:
+        for scenario in SCENARIOS:
+            if args.scenario and scenario['name'] not in args.scenario:
+                continue
+
+            stand_in.version = scenario.get('version', DEFAULT_VERSION)
+            stand_in.num_apps = sized(scenario['payload_kb'] * 1024, stand_in.version)
+            stand_in.latency = scenario.get('latency', 0.0)
+            stand_in.status = scenario.get('status', 200)
+            stand_in.compress = scenario.get('compress', False)
+
+            for plugin in plugins:
+                result = dict(measure(plugin, environment, args.runs), scenario=scenario)
+                results.append(result)
+                print('{:14} {plugin:24} main {main_time:7.4f}s  fetch {fetch_time:7.4f}s  parse {parse_time:8.6f}s  '
+                      'startup {startup_time:7.4f}s  {max_rss_kb:7.0f} KB RSS  {main_peak_bytes:>9} B peak'.format(
+                          scenario['name'], **result))
+    finally:
+        server.shutdown()
+        state.cleanup()
+
+    path = args.json or os.path.join(ROOT, 'benchmarks', 'results', '%s.json' % revision())
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'revision': revision(), 'time': time.time(), 'python': platform.python_version(),
+                   'runs': args.runs, 'results': results}, f, indent=2)
+    print('results written to %s' % path)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the serverinfo OCS endpoint of a nextcloud instance
+#
+# Serves a synthetic report of a configurable size and nextcloud version after
+# a configurable latency, or answers with an error status like 996 instead.
+# skipApps and gzip are honoured like a real instance behind nginx does.
+#
+# usage: python3 benchmarks/server.py [--port 8080] [--payload-kb 64] [--latency 0.2]
+#                                     [--status 200] [--version 27.1.0.7] [--gzip]
+import argparse
+import gzip
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+PATH = '/ocs/v2.php/apps/serverinfo/api/v1/info'
+DEFAULT_VERSION = '27.1.0.7'
+
+
+def synthetic(num_apps, version=DEFAULT_VERSION, apps=True):
+    # a serverinfo report growing with the number of installed apps, like a real one does
+    app_updates = {'app_%d' % i: '%d.%d.%d' % (i % 30, i % 7, i) for i in range(num_apps)}
+    system = {'version': version, 'cpuload': [0.52, 0.61, 0.58], 'mem_total': 16318480, 'mem_free': 9823124,
+              'swap_total': 2097148, 'swap_free': 2097148}
+    if apps:
+        system['apps'] = {'num_installed': num_apps, 'num_updates_available': 3, 'app_updates': app_updates}
+
+    return json.dumps({'ocs': {'meta': {'status': 'ok', 'statuscode': 200}, 'data': {
+        'nextcloud': {
+            'system': system,
+            'storage': {'num_users': 1200, 'num_files': 98765432, 'num_storages': 1300, 'num_storages_local': 2,
+                        'num_storages_home': 1200, 'num_storages_other': 98},
+            'shares': {'num_shares': 4321, 'num_shares_user': 1234, 'num_shares_groups': 321, 'num_shares_link': 2100,
+                       'num_shares_mail': 50, 'num_shares_room': 40, 'num_shares_link_no_password': 1800,
+                       'num_fed_shares_sent': 10, 'num_fed_shares_received': 12},
+        },
+        'server': {
+            'webserver': 'nginx',
+            'php': {'version': '8.2.10', 'memory_limit': 536870912, 'max_execution_time': 3600,
+                    'upload_max_filesize': 536870912,
+                    'opcache': {'opcache_enabled': True,
+                                'memory_usage': {'used_memory': 98304512, 'free_memory': 35913216,
+                                                 'wasted_memory': 0, 'current_wasted_percentage': 0},
+                                'opcache_statistics': {'num_cached_scripts': num_apps * 10, 'hits': 8234567,
+                                                       'misses': 4567, 'opcache_hit_rate': 99.94},
+                                'scripts': {'/var/www/%d.php' % i: {'hits': i} for i in range(num_apps * 10)}},
+                    'apcu': {'cache': {'num_hits': 1234567, 'num_misses': 2345, 'mem_size': 12345678},
+                             'sma': {'num_seg': 1, 'seg_size': 33554432, 'avail_mem': 20123456}}},
+            'database': {'type': 'pgsql', 'version': '15.4', 'size': 123456789012},
+        },
+        'activeUsers': {'last5minutes': 12, 'last1hour': 80, 'last24hours': 600},
+    }}}).encode('utf-8')
+
+
+def sized(payload_bytes, version=DEFAULT_VERSION):
+    # the number of apps giving a report of about payload_bytes, the report grows linearly with it
+    base = len(synthetic(0, version))
+    per_app = (len(synthetic(100, version)) - base) / 100
+    return max(0, int(round((payload_bytes - base) / per_app)))
+
+
+class StandIn:
+    # the behaviour of the stand-in, changed between benchmark scenarios while it is running
+    def __init__(self, num_apps=50, latency=0.0, status=200, version=DEFAULT_VERSION, compress=False):
+        self.num_apps = num_apps
+        self.latency = latency
+        self.status = status
+        self.version = version
+        self.compress = compress
+        self.requests = 0
+        self.bodies = dict()
+
+    def body(self, apps):
+        key = (self.num_apps, self.version, apps)
+        if key not in self.bodies:
+            self.bodies[key] = synthetic(self.num_apps, self.version, apps)
+        return self.bodies[key]
+
+
+def handler(stand_in):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            stand_in.requests += 1
+            parts = urlsplit(self.path)
+            if parts.path != PATH:
+                self.answer(404, b'')
+                return
+
+            time.sleep(stand_in.latency)
+            if stand_in.status != 200:
+                self.answer(stand_in.status, b'')
+                return
+
+            query = parse_qs(parts.query)
+            body = stand_in.body(query.get('skipApps', ['false'])[0] != 'true')
+            encoding = None
+            if stand_in.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body, 6)
+                encoding = 'gzip'
+            self.answer(200, body, encoding)
+
+        def answer(self, status, body, encoding=None):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # plugins extracting only a few values hang up before the report was sent completely
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(stand_in, port=0):
+    # starts the stand-in in a daemon thread, returns the server and the url of the endpoint
+    server = Server(('127.0.0.1', port), handler(stand_in))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d%s' % (server.server_address[1], PATH)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='local stand-in for the nextcloud serverinfo endpoint')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--payload-kb', type=float, default=4)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before answering')
+    parser.add_argument('--status', type=int, default=200, help='e.g. 996, 997 or 998')
+    parser.add_argument('--version', default=DEFAULT_VERSION, help='nextcloud version string')
+    parser.add_argument('--gzip', action='store_true', help='compress if the client accepts it')
+    args = parser.parse_args()
+
+    stand_in = StandIn(sized(args.payload_kb * 1024, args.version), args.latency, args.status, args.version, args.gzip)
+    server, url = serve(stand_in, args.port)
+    print('serving %s' % url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
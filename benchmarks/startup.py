@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measure wall time and peak RSS of every plugin invocation
+#
+# Every plugin is started as a fresh process, just like munin-node does, and
+# run with config and autoconf. If url, username and password are set in the
+# environment a fetch is measured as well.
+#
+# usage: python3 benchmarks/startup.py [--runs 10] [--json results.json]
+import argparse
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(plugin, argument, runs):
+    wall_times = list()
+    max_rss = list()
+    command = [sys.executable, plugin] + ([argument] if argument else [])
+
+    for _ in range(runs):
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # wait4 reports the resource usage of exactly this child
+        _, _, usage = os.wait4(process.pid, 0)
+        wall_times.append(time.perf_counter() - started)
+        max_rss.append(usage.ru_maxrss)
+
+    return {
+        'plugin': os.path.basename(plugin),
+        'argument': argument or 'fetch',
+        'runs': runs,
+        'wall_time_median': statistics.median(wall_times),
+        'wall_time_min': min(wall_times),
+        'max_rss_kb': statistics.median(max_rss),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure wall time and peak RSS of every plugin invocation')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    arguments = ['config', 'autoconf']
+    if os.environ.get('url'):
+        arguments.append(None)
+
+    results = list()
+    for plugin in sorted(glob.glob(os.path.join(ROOT, 'nextcloud_*.py'))):
+        for argument in arguments:
+            result = measure(plugin, argument, args.runs)
+            results.append(result)
+            print('{plugin:24} {argument:9} {wall_time_median:8.4f}s {max_rss_kb:8.0f} KB'.format(**result))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
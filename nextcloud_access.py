@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Plugin to monitor how fast the web server answers the requests to the specified nextcloud instance
+#   * requests per class (WebDAV, OCS API, static files, pages, other) and unreadable lines
+#   * median, 95th and 99th percentile of the request time of all requests
+#     and, in child graphs, of every class
+#
+# The access logs are read incrementally from where the previous run stopped,
+# see nextcloud_munin/tail.py and nextcloud_munin/access.py. The percentiles
+# are those of the requests logged since the previous run. The munin user needs
+# read access to the logs (env.access_log).
+#
+# Parameters understood:
+#     config   (required)
+#     autoconf (optional - used by munin-config)
+#     acquire  (optional - append one sample to the spool)
+#     sample   (optional - keep appending samples every env.sample_interval seconds)
+#     spoolfetch <timestamp> (optional - output all spooled samples taken after timestamp)
+
+# Magic markers - optional - used by installation scripts and
+# munin-config:
+#
+#  #%# family=manual
+#  #%# capabilities=autoconf
+import os
+import sys
+
+from nextcloud_munin import access
+from nextcloud_munin.plugin import NextcloudPlugin
+from nextcloud_munin.sketch import Sketch
+from nextcloud_munin.tail import Tail
+
+
+def latency_config(graph, title):
+    config = [
+        'multigraph %s' % graph,
+        'graph_title %s' % title,
+        'graph_args --base 1000 -l 0',
+        'graph_vlabel seconds',
+        'graph_info graph showing the request time percentiles of the requests since the previous run',
+        'graph_category nextcloud',
+    ]
+    for name, quantile in access.QUANTILES:
+        config.extend(['%s.label %s' % (name, name), '%s.min 0' % name,
+                       '%s.info %.0fth percentile of the request time' % (name, quantile * 100)])
+    return config
+
+
+class NextcloudAccess(NextcloudPlugin):
+    multigraph = True
+
+    def __init__(self):
+        super().__init__()
+        self.tail = Tail('access', os.environ.get('access_log', access.DEFAULT_ACCESS_LOG).split())
+
+        self.config = [
+            'multigraph nextcloud_access_requests',
+            'graph_title Nextcloud requests',
+            'graph_args --base 1000 -l 0',
+            'graph_vlabel requests per ${graph_period}',
+            'graph_info graph showing the requests answered by the web server by route',
+            'graph_category nextcloud',
+        ]
+        for name, label, _ in access.CLASSES:
+            self.config.extend(['%s.label %s' % (name, label), '%s.type DERIVE' % name, '%s.min 0' % name,
+                                '%s.draw AREASTACK' % name])
+        self.config.extend(['invalid.label unreadable lines', 'invalid.info lines not in the expected log format',
+                            'invalid.type DERIVE', 'invalid.min 0'])
+
+        self.config.extend(latency_config('nextcloud_access_latency', 'Nextcloud request time'))
+        for name, label, _ in access.CLASSES:
+            self.config.extend(latency_config('nextcloud_access_latency.%s' % name,
+                                              'Nextcloud request time - %s' % label))
+
+    def collect(self):
+        try:
+            with self.tail.lock():
+                self.tail.load()
+                sketches = access.count(self.tail)
+                self.tail.commit()
+        except OSError as e:
+            return 'reading the access log failed: %s' % e
+
+        self.result = ['multigraph nextcloud_access_requests']
+        self.result.extend('%s.value %d' % (name, self.tail.data['requests'][name]) for name, _, _ in access.CLASSES)
+        self.result.append('invalid.value %d' % self.tail.data['invalid'])
+
+        # the sketches of the classes add up to the one of all requests
+        total = Sketch()
+        for sketch in sketches.values():
+            total.merge(sketch)
+
+        self.result.extend(self.latency_values('nextcloud_access_latency', total))
+        for name, _, _ in access.CLASSES:
+            self.result.extend(self.latency_values('nextcloud_access_latency.%s' % name, sketches[name]))
+        return None
+
+    @staticmethod
+    def latency_values(graph, sketch):
+        # no values without requests, munin records them as unknown
+        lines = ['multigraph %s' % graph]
+        if sketch.count:
+            lines.extend('%s.value %.6f' % (name, sketch.quantile(quantile)) for name, quantile in access.QUANTILES)
+        return lines
+
+    def main(self):
+        # the logs are read locally, no credentials are needed
+        if sys.argv[1:2] == ['autoconf']:
+            paths = os.environ.get('access_log', access.DEFAULT_ACCESS_LOG).split()
+            print('yes' if all(os.access(path, os.R_OK) for path in paths) else 'no (access log not readable)')
+            return
+        super().main()
+
+
+if __name__ == "__main__":
+    NextcloudAccess().main()
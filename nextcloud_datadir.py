@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Plugin to monitor the disk usage of the data directory of the specified nextcloud instance
+#   * bytes of the files, trash bins, versions and previews of all users
+#   * bytes of the users using the most disk space
+#   * directories listed, reused from the cache and deferred by the scanner
+#
+# The data directory (env.datadir, or the one of env.db_config) is walked by a
+# pool of threads, unchanged directories are taken from a cache, see
+# nextcloud_munin/datadir.py. The munin user needs read access to the data
+# directory, e.g. with "user www-data" in the plugin configuration. Until every
+# directory was listed once only the scanner graph has values.
+#
+# Parameters understood:
+#     config   (required)
+#     autoconf (optional - used by munin-config)
+#     acquire  (optional - append one sample to the spool)
+#     sample   (optional - keep appending samples every env.sample_interval seconds)
+#     spoolfetch <timestamp> (optional - output all spooled samples taken after timestamp)
+
+# Magic markers - optional - used by installation scripts and
+# munin-config:
+#
+#  #%# family=manual
+#  #%# capabilities=autoconf
+import os
+import sys
+import time
+
+from nextcloud_munin import datadir, instances
+from nextcloud_munin.plugin import NextcloudPlugin
+
+LABELS = {
+    'files': 'files',
+    'trashbin': 'trash bin',
+    'versions': 'versions',
+    datadir.PREVIEWS: 'previews',
+}
+
+
+def field_name(user):
+    return instances.field_name('user', user)
+
+
+class NextcloudDatadir(NextcloudPlugin):
+    multigraph = True
+
+    def __init__(self):
+        super().__init__()
+        try:
+            self.directory = datadir.data_directory()
+        except OSError:
+            self.directory = None
+
+        # the top users are taken from the cache, config does not walk the data directory
+        state = datadir.DatadirCache(self.directory).load() if self.directory else {'roots': {}}
+        self.config = self.datadir_config(state)
+
+    @staticmethod
+    def datadir_config(state):
+        config = [
+            'multigraph nextcloud_datadir',
+            'graph_title Nextcloud data directory',
+            'graph_args --base 1024 -l 0',
+            'graph_vlabel bytes',
+            'graph_info graph showing the disk space used by the files, trash bins and versions of all users '
+            'and by the previews',
+            'graph_category nextcloud',
+        ]
+        for category, label in LABELS.items():
+            config.extend(['%s.label %s' % (category, label), '%s.draw AREASTACK' % category, '%s.min 0' % category])
+
+        config.extend([
+            'multigraph nextcloud_datadir_users',
+            'graph_title Nextcloud top users by disk usage',
+            'graph_args --base 1024 -l 0',
+            'graph_vlabel bytes',
+            'graph_info graph showing the users using the most disk space with their files, trash bin and versions',
+            'graph_category nextcloud',
+        ])
+        for user, _ in datadir.users(state):
+            config.extend(['%s.label %s' % (field_name(user), user), '%s.min 0' % field_name(user)])
+
+        config.extend([
+            'multigraph nextcloud_datadir_scan',
+            'graph_title Nextcloud data directory scanner',
+            'graph_args --base 1000 -l 0',
+            'graph_printf %.0lf',
+            'graph_vlabel directories',
+            'graph_info graph showing how much of the data directory the scanner had to list',
+            'graph_category nextcloud',
+            'listed.label listed',
+            'listed.info directories listed because they changed or were new',
+            'listed.min 0',
+            'unchanged.label unchanged',
+            'unchanged.info directories taken from the cache',
+            'unchanged.min 0',
+            'deferred.label deferred',
+            'deferred.info directories left for the next run when the budget was spent',
+            'deferred.min 0',
+        ])
+        return config
+
+    def collect(self):
+        if not self.directory:
+            return 'env variable datadir is missing'
+
+        try:
+            state, scan = datadir.refresh(self.directory, time.time())
+        except OSError as e:
+            return 'scanning the data directory failed: %s' % e
+
+        # values before every directory was listed once would be too low
+        self.result = ['multigraph nextcloud_datadir']
+        if datadir.complete(state):
+            for category, (size, _) in datadir.categories(state).items():
+                self.result.append('%s.value %d' % (category, size))
+        self.result.append('multigraph nextcloud_datadir_users')
+        if datadir.complete(state):
+            self.result.extend('%s.value %d' % (field_name(user), size) for user, size in datadir.users(state))
+
+        # another run was scanning, nothing was listed by this one
+        self.result.append('multigraph nextcloud_datadir_scan')
+        if scan is not None:
+            self.result.extend(['listed.value %d' % scan.listed, 'unchanged.value %d' % scan.unchanged,
+                                'deferred.value %d' % scan.deferred])
+        return None
+
+    def main(self):
+        # the data directory is read locally, no credentials are needed
+        if sys.argv[1:2] == ['autoconf']:
+            print('yes' if self.directory and os.access(self.directory, os.R_OK | os.X_OK) else
+                  'no (data directory not readable)')
+            return
+        super().main()
+
+
+if __name__ == "__main__":
+    NextcloudDatadir().main()
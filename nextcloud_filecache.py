@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Plugin to monitor how the files of the specified nextcloud instance are spread
+#   * bytes and files of the storages with the most bytes
+#   * bytes and files of the mimetypes with the most bytes
+#   * progress of the filecache scanner
+#
+# The values are aggregated from the oc_filecache table incrementally, only the
+# fileid ranges which changed since the previous run are read again, see
+# nextcloud_munin/filecache.py. The database connection is configured like the
+# database backend (env.db_type, env.db_name, ... or env.db_config). Until the
+# first scan of the whole table is complete only the scanner graph has values.
+#
+# Parameters understood:
+#     config   (required)
+#     autoconf (optional - used by munin-config)
+#     acquire  (optional - append one sample to the spool)
+#     sample   (optional - keep appending samples every env.sample_interval seconds)
+#     spoolfetch <timestamp> (optional - output all spooled samples taken after timestamp)
+
+# Magic markers - optional - used by installation scripts and
+# munin-config:
+#
+#  #%# family=manual
+#  #%# capabilities=autoconf
+import sys
+import time
+
+from nextcloud_munin import filecache, instances
+from nextcloud_munin.database import Database, settings, source
+from nextcloud_munin.plugin import NextcloudPlugin
+
+# graph name, what is drawn, position in the aggregates, name prefix of the fields
+BREAKDOWNS = (
+    ('nextcloud_filecache_storage_bytes', 'bytes', filecache.STORAGE, 'storage'),
+    ('nextcloud_filecache_storage_files', 'files', filecache.STORAGE, 'storage'),
+    ('nextcloud_filecache_mimetype_bytes', 'bytes', filecache.MIMETYPE, 'mime'),
+    ('nextcloud_filecache_mimetype_files', 'files', filecache.MIMETYPE, 'mime'),
+)
+
+
+def label(state, position, key):
+    names = state['storages'] if position == filecache.STORAGE else state['mimetypes']
+    return names.get(str(key), str(key))
+
+
+class NextcloudFilecache(NextcloudPlugin):
+    multigraph = True
+
+    def __init__(self):
+        super().__init__()
+
+        # the storages and mimetypes drawn are taken from the state, config does not query the database
+        try:
+            state = filecache.FilecacheState(source()).load()
+        except (OSError, ValueError):
+            state = filecache.empty_state(filecache.DEFAULT_RANGE)
+        self.config = self.filecache_config(state)
+
+    @staticmethod
+    def filecache_config(state):
+        config = list()
+        for graph, unit, position, prefix in BREAKDOWNS:
+            kind = 'storages' if position == filecache.STORAGE else 'mimetypes'
+            config.extend([
+                'multigraph %s' % graph,
+                'graph_title Nextcloud %s %s' % (kind, unit),
+                'graph_args --base %d -l 0' % (1024 if unit == 'bytes' else 1000),
+                'graph_vlabel %s' % unit,
+                'graph_info graph showing the %s of the %s with the most bytes, directories not counted' % (
+                    unit, kind),
+                'graph_category nextcloud',
+            ])
+            if unit == 'files':
+                config.append('graph_printf %.0lf')
+            for key, _, _ in filecache.top(state, position):
+                name = instances.field_name(prefix, label(state, position, key))
+                config.extend(['%s.label %s' % (name, label(state, position, key)), '%s.min 0' % name])
+
+        config.extend([
+            'multigraph nextcloud_filecache_scan',
+            'graph_title Nextcloud filecache scanner',
+            'graph_args --base 1000 -l 0',
+            'graph_printf %.0lf',
+            'graph_vlabel ranges',
+            'graph_info graph showing the fileid ranges of the filecache aggregated and still to aggregate',
+            'graph_category nextcloud',
+            'ranges.label known ranges',
+            'ranges.info fileid ranges holding files',
+            'ranges.min 0',
+            'scanned.label aggregated',
+            'scanned.info ranges aggregated in this run',
+            'scanned.min 0',
+            'pending.label pending',
+            'pending.info changed ranges left for the next runs',
+            'pending.min 0',
+        ])
+        return config
+
+    def collect(self):
+        try:
+            state, scanned = filecache.refresh(time.time())
+        except Exception as e:
+            return 'filecache scan failed: %s' % e
+
+        self.result = list()
+        for graph, unit, position, prefix in BREAKDOWNS:
+            self.result.append('multigraph %s' % graph)
+            # values before the whole table was aggregated once would be too low
+            if not state['built']:
+                continue
+            for key, files, total in filecache.top(state, position):
+                self.result.append('%s.value %d' % (
+                    instances.field_name(prefix, label(state, position, key)), total if unit == 'bytes' else files))
+
+        self.result.extend([
+            'multigraph nextcloud_filecache_scan',
+            'ranges.value %d' % len(state['ranges']),
+            'scanned.value %d' % scanned,
+            'pending.value %d' % len(state['dirty']),
+        ])
+        return None
+
+    def main(self):
+        # the database is queried directly, no nextcloud credentials are needed
+        if sys.argv[1:2] == ['autoconf']:
+            try:
+                Database(settings()).close()
+                print('yes')
+            except Exception as e:
+                print('no (%s)' % e)
+            return
+        super().main()
+
+
+if __name__ == "__main__":
+    NextcloudFilecache().main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Plugin to monitor the background jobs of the specified nextcloud instance
+#   * queued, reserved, stuck and never run jobs
+#   * jobs per job class
+#   * age of the oldest last run per job class and time since the last cron run
+#
+# The values are read from the oc_jobs and oc_appconfig tables with a few
+# aggregate queries, see nextcloud_munin/jobs.py. The database connection is
+# configured like the database backend (env.db_type, env.db_name, ... or
+# env.db_config). Only the env.jobs_top largest and most behind job classes
+# are drawn.
+#
+# Parameters understood:
+#     config   (required)
+#     autoconf (optional - used by munin-config)
+#     acquire  (optional - append one sample to the spool)
+#     sample   (optional - keep appending samples every env.sample_interval seconds)
+#     spoolfetch <timestamp> (optional - output all spooled samples taken after timestamp)
+
+# Magic markers - optional - used by installation scripts and
+# munin-config:
+#
+#  #%# family=manual
+#  #%# capabilities=autoconf
+import sys
+import time
+
+from nextcloud_munin import instances, jobs
+from nextcloud_munin.plugin import NextcloudPlugin
+
+
+def field_name(cls):
+    return instances.field_name('job', cls)
+
+
+def short_name(cls):
+    # OCA\Files\BackgroundJob\ScanFiles is shown as ScanFiles
+    return cls.rpartition('\\')[2]
+
+
+class NextcloudJobs(NextcloudPlugin):
+    multigraph = True
+
+    def __init__(self):
+        super().__init__()
+        self.queue = None
+        self.error = None
+
+        # the job classes are only known from the database, without it the graphs have no class fields
+        try:
+            self.queue = jobs.fetch(time.time())
+        except Exception as e:
+            self.error = 'querying the jobs failed: %s' % e
+        self.config = self.jobs_config(self.queue)
+
+    @staticmethod
+    def jobs_config(queue):
+        config = [
+            'multigraph nextcloud_jobs',
+            'graph_title Nextcloud background jobs',
+            'graph_args --base 1000 -l 0',
+            'graph_printf %.0lf',
+            'graph_vlabel jobs',
+            'graph_info graph showing the state of the background job queue',
+            'graph_category nextcloud',
+            'queued.label queued',
+            'queued.info jobs in the queue',
+            'queued.min 0',
+            'reserved.label reserved',
+            'reserved.info jobs picked up by a cron run and not finished yet',
+            'reserved.min 0',
+            'stuck.label stuck',
+            'stuck.info jobs reserved for longer than env.jobs_stuck_after seconds',
+            'stuck.min 0',
+            'stuck.warning 1',
+            'never_run.label never run',
+            'never_run.info jobs which did not run yet',
+            'never_run.min 0',
+            'multigraph nextcloud_jobs_classes',
+            'graph_title Nextcloud background jobs per class',
+            'graph_args --base 1000 -l 0',
+            'graph_printf %.0lf',
+            'graph_vlabel jobs',
+            'graph_info graph showing the job classes with the most jobs in the queue',
+            'graph_category nextcloud',
+        ]
+        for cls in queue.largest() if queue else ():
+            config.extend(['%s.label %s' % (field_name(cls), short_name(cls)), '%s.info %s' % (field_name(cls), cls),
+                           '%s.draw AREASTACK' % field_name(cls), '%s.min 0' % field_name(cls)])
+
+        config.extend([
+            'multigraph nextcloud_jobs_lag',
+            'graph_title Nextcloud background job lag',
+            'graph_args --base 1000 -l 0',
+            'graph_vlabel seconds',
+            'graph_info graph showing the time since the last cron run and the age of the oldest last run of '
+            'the job classes most behind',
+            'graph_category nextcloud',
+            'cron.label last cron run',
+            'cron.info seconds since the last cron run',
+            'cron.min 0',
+            'cron.warning 900',
+            'cron.critical 3600',
+        ])
+        for cls in queue.most_behind() if queue else ():
+            config.extend(['%s.label %s' % (field_name(cls), short_name(cls)),
+                           '%s.info seconds since the oldest last run of %s' % (field_name(cls), cls),
+                           '%s.min 0' % field_name(cls)])
+        return config
+
+    def collect(self):
+        # the query made for the config is reused when munin asks for config and values at once
+        now = time.time()
+        queue, self.queue = self.queue, None
+        if queue is None:
+            try:
+                queue = jobs.fetch(now)
+            except Exception as e:
+                return 'querying the jobs failed: %s' % e
+
+        self.result = [
+            'multigraph nextcloud_jobs',
+            'queued.value %d' % queue.queued,
+            'reserved.value %d' % queue.reserved,
+            'stuck.value %d' % queue.stuck,
+            'never_run.value %d' % queue.never_run,
+            'multigraph nextcloud_jobs_classes',
+        ]
+        self.result.extend('%s.value %d' % (field_name(cls), queue.classes[cls][0]) for cls in queue.largest())
+
+        self.result.append('multigraph nextcloud_jobs_lag')
+        if queue.last_cron is not None:
+            self.result.append('cron.value %.0f' % max(0, now - queue.last_cron))
+        self.result.extend('%s.value %.0f' % (field_name(cls), max(0, now - queue.classes[cls][1]))
+                           for cls in queue.most_behind())
+        return None
+
+    def main(self):
+        # the database is queried directly, no nextcloud credentials are needed
+        if sys.argv[1:2] == ['autoconf']:
+            print('yes' if self.error is None else 'no (%s)' % self.error)
+            return
+        super().main()
+
+
+if __name__ == "__main__":
+    NextcloudJobs().main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Plugin to monitor the entries of the nextcloud.log of the specified nextcloud instance
+#   * entries per level
+#   * entries per app
+#   * top exception classes
+#   * slow entries
+#
+# The log is read incrementally from where the previous run stopped, see
+# nextcloud_munin/tail.py and nextcloud_munin/logfile.py. The munin user needs
+# read access to the log (env.log_file).
+#
+# Parameters understood:
+#     config   (required)
+#     autoconf (optional - used by munin-config)
+#     acquire  (optional - append one sample to the spool)
+#     sample   (optional - keep appending samples every env.sample_interval seconds)
+#     spoolfetch <timestamp> (optional - output all spooled samples taken after timestamp)
+
+# Magic markers - optional - used by installation scripts and
+# munin-config:
+#
+#  #%# family=manual
+#  #%# capabilities=autoconf
+import os
+import sys
+import time
+
+from nextcloud_munin import instances, logfile
+from nextcloud_munin.plugin import NextcloudPlugin
+from nextcloud_munin.tail import Tail
+
+
+def rate_field(name, label, info):
+    return ['%s.label %s' % (name, label), '%s.info %s' % (name, info), '%s.type DERIVE' % name, '%s.min 0' % name]
+
+
+class NextcloudLog(NextcloudPlugin):
+    multigraph = True
+
+    def __init__(self):
+        super().__init__()
+        self.tail = Tail('log', [os.environ.get('log_file', logfile.DEFAULT_LOG_FILE)])
+
+        # the top apps and exceptions are taken from the counters of the previous run
+        self.config = self.log_config(self.tail.data, time.time())
+
+    def log_config(self, data, now):
+        config = [
+            'multigraph nextcloud_log_levels',
+            'graph_title Nextcloud log entries',
+            'graph_args --base 1000 -l 0',
+            'graph_vlabel entries per ${graph_period}',
+            'graph_info graph showing the entries of nextcloud.log by level',
+            'graph_category nextcloud',
+        ]
+        for level in logfile.LEVELS:
+            config.extend(rate_field(level, level, '%s entries' % level))
+            config.append('%s.draw AREASTACK' % level)
+
+        config.extend([
+            'multigraph nextcloud_log_apps',
+            'graph_title Nextcloud log entries by app',
+            'graph_args --base 1000 -l 0',
+            'graph_vlabel entries per ${graph_period}',
+            'graph_info graph showing the apps writing the most log entries during the last day',
+            'graph_category nextcloud',
+        ])
+        for app in logfile.ranked(data.get('apps', {}), now):
+            config.extend(rate_field(instances.field_name('app', app), app, 'entries written by %s' % app))
+
+        config.extend([
+            'multigraph nextcloud_log_exceptions',
+            'graph_title Nextcloud top exceptions',
+            'graph_args --base 1000 -l 0',
+            'graph_vlabel exceptions per ${graph_period}',
+            'graph_info graph showing the exceptions logged most often during the last day',
+            'graph_category nextcloud',
+        ])
+        for name in logfile.ranked(data.get('exceptions', {}), now):
+            config.extend(rate_field(instances.field_name('exception', name), name.rpartition('\\')[2],
+                                     'exceptions of class %s' % name))
+
+        config.extend([
+            'multigraph nextcloud_log_slow',
+            'graph_title Nextcloud slow log entries',
+            'graph_args --base 1000 -l 0',
+            'graph_vlabel entries per ${graph_period}',
+            'graph_info graph showing the log entries reporting slow operations (env.log_slow_pattern)',
+            'graph_category nextcloud',
+        ])
+        config.extend(rate_field('slow', 'slow entries', 'entries matching env.log_slow_pattern'))
+        config.extend(rate_field('invalid', 'unreadable lines', 'lines which are not a json log entry'))
+        return config
+
+    def collect(self):
+        now = time.time()
+        try:
+            with self.tail.lock():
+                self.tail.load()
+                data = logfile.count(self.tail, now)
+                self.tail.commit()
+        except OSError as e:
+            return 'reading the log failed: %s' % e
+
+        self.result = ['multigraph nextcloud_log_levels']
+        self.result.extend('%s.value %d' % (level, data['levels'][level]) for level in logfile.LEVELS)
+
+        self.result.append('multigraph nextcloud_log_apps')
+        for app in logfile.ranked(data['apps'], now):
+            self.result.append('%s.value %d' % (instances.field_name('app', app), data['apps'][app][0]))
+
+        self.result.append('multigraph nextcloud_log_exceptions')
+        for name in logfile.ranked(data['exceptions'], now):
+            self.result.append('%s.value %d' % (instances.field_name('exception', name), data['exceptions'][name][0]))
+
+        self.result.extend(['multigraph nextcloud_log_slow', 'slow.value %d' % data['slow'],
+                            'invalid.value %d' % data['invalid']])
+        return None
+
+    def main(self):
+        # the log is read locally, no credentials are needed
+        if sys.argv[1:2] == ['autoconf']:
+            print('yes' if os.access(os.environ.get('log_file', logfile.DEFAULT_LOG_FILE), os.R_OK) else
+                  'no (log file not readable)')
+            return
+        super().main()
+
+
+if __name__ == "__main__":
+    NextcloudLog().main()
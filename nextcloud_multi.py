@@ -6,240 +6,147 @@
 #   * db size
 #   * share count
 #   * available app updates
+#   * server load, memory and swap
+#   * php opcache, apcu and limits
+#   * growth rates and capacity forecasts
+#   * php-fpm pool processes, listen queue and saturation (with env.fpm_status)
 #
 # Parameters understood:
 #     config   (required)
 #     autoconf (optional - used by munin-config)
+#     acquire  (optional - append one sample to the spool)
+#     sample   (optional - keep appending samples every env.sample_interval seconds)
+#     spoolfetch <timestamp> (optional - output all spooled samples taken after timestamp)
+#     supersample (optional - keep sampling every env.supersample_interval seconds for min/avg/max/p95)
 
 # Magic markers - optional - used by installation scripts and
 # munin-config:
 #
 #  #%# family=manual
 #  #%# capabilities=autoconf
-import requests
-import sys
 import os
+import sys
+import time
+from collections import OrderedDict
+
+from nextcloud_munin.plugin import NextcloudPlugin
+from nextcloud_munin import forecast, fpm, instances, registry
+
+
+class NextcloudMultiGraph(NextcloudPlugin):
+    # all graphs of nextcloud_munin/registry.py, the self-instrumentation and php-fpm graphs are optional
+    graphs = tuple(name for name in registry.GRAPHS if name not in registry.PERF_GRAPHS + registry.FPM_GRAPHS)
+    multigraph = True
 
+    # the growth and forecast graphs are fitted to the history
+    keep_history = True
 
-class NextcloudMultiGraph:
     def __init__(self):
-        self.config = [
-            # users
-            'multigraph nextcloud_users',
-            'graph_title Nextcloud User Activity',
-            'graph_args --base 1000 -l 0',
-            'graph_printf %.0lf',
-            'graph_vlabel connected users',
-            'graph_info graph showing the number of connected user',
-            'graph_category nextcloud',
-            'last5minutes.label last 5 minutes',
-            'last5minutes.info users connected in the last 5 minutes',
-            'last5minutes.min 0',
-            'last1hour.label last hour',
-            'last1hour.info users connected in the last hour',
-            'last1hour.min 0',
-            'last24hours.label last 24 hours',
-            'last24hours.info users connected in the last 24 hours',
-            'last24hours.min 0',
-            'num_users.label number of users',
-            'num_users.info total number of users',
-            'num_users.min 0',
-
-            # shares
-            'multigraph nextcloud_shares',
-            'graph_title Nextcloud Shares',
-            'graph_args --base 1000 -l 0',
-            'graph_printf %.0lf',
-            'graph_vlabel number of shares',
-            'graph_info graph showing the number of shares',
-            'graph_category nextcloud',
-            'num_shares.label total number of shares',
-            'num_shares.info current over all total of shares',
-            'num_shares.min 0',
-            'num_shares_user.label user shares',
-            'num_shares_user.info current total of user shares',
-            'num_shares_user.min 0',
-            'num_shares_groups.label group shares',
-            'num_shares_groups.info current total of group shares',
-            'num_shares_groups.min 0',
-            'num_shares_link.label link shares',
-            'num_shares_link.info current total of shares through a link',
-            'num_shares_link.min 0',
-            'num_shares_mail.label mail shares',
-            'num_shares_mail.info current total of mail shares',
-            'num_shares_mail.min 0',
-            'num_shares_room.label room shares',
-            'num_shares_room.info current total of room shares',
-            'num_shares_room.min 0',
-            'num_shares_link_no_password.label link shares without a password',
-            'num_shares_link_no_password.info current total of shares through a link without a password protection',
-            'num_shares_link_no_password.min 0',
-            'num_fed_shares_sent.label federated shares sent',
-            'num_fed_shares_sent.info current total of federated shares sent',
-            'num_fed_shares_sent.min 0',
-            'num_fed_shares_received.label federated shares recieved',
-            'num_fed_shares_received.info current total of federated shares recieved',
-            'num_fed_shares_received.min 0',
-
-            # dbsize
-            'multigraph nextcloud_dbsize',
-            'graph_title Nextcloud Database Size',
-            'graph_args --base 1024 -l 0',
-            'graph_vlabel size in byte',
-            'graph_info graph showing the database size in byte',
-            'graph_category nextcloud',
-            'db_size.label database size in byte',
-            'db_size.info users connected in the last 5 minutes',
-            'db_size.draw AREA',
-            'db_size.min 0',
-
-            # available_updates
-            'multigraph nextcloud_available_updates',
-            'graph_title Nextcloud available App updates',
-            'graph_args --base 1000 -l 0',
-            'graph_printf %.0lf',
-            'graph_vlabel updates available',
-            'graph_info graph showing the number of available app updates',
-            'graph_category nextcloud',
-            'num_updates_available.label available app updates',
-            'num_updates_available.info number of available app updates',
-            'num_updates_available.min 0',
-            'num_updates_available.warning 1',
-
-            # storages
-            'multigraph nextcloud_storages',
-            'graph_title Nextcloud Storages',
-            'graph_args --base 1000 -l 0',
-            'graph_printf %.0lf',
-            'graph_vlabel number',
-            'graph_info graph showing the number of storages',
-            'graph_category nextcloud',
-            'num_storages.label total number of storages',
-            'num_storages.info current over all total of storages',
-            'num_storages.min 0',
-            'num_storages_local.label number of local storages',
-            'num_storages_local.info current over all total of storage',
-            'num_storages_local.min 0',
-            'num_storages_home.label number of home storages',
-            'num_storages_home.info current over all total of storage',
-            'num_storages_home.min 0',
-            'num_storages_other.label number of other storages',
-            'num_storages_other.info current over all total of storage',
-            'num_storages_other.min 0',
-
-            # filecount
-            'multigraph nextcloud_filecount',
-            'graph_title Nextcloud Files',
-            'graph_args --base 1000 -l 0',
-            'graph_printf %.0lf',
-            'graph_vlabel number of files',
-            'graph_info graph showing the number of files',
-            'graph_category nextcloud',
-            'num_files.label number of files',
-            'num_files.info current number of files in the repository',
-            'num_files.min 0'
-        ]
-        self.result = list()
-
-    def parse_data(self, api_response):
-        # users
-        users = api_response['ocs']['data']['activeUsers']
-        num_users = api_response['ocs']['data']['nextcloud']['storage']['num_users']
-        self.result.append('multigraph nextcloud_users')
-
-        # append for every key in users the key and the value to the results
-        for key, value in users.items():
-            self.result.append('{k}.value {v}'.format(k=key, v=value))
-
-        # append total number of users
-        self.result.append('num_users.value %s' % num_users)
-
-        # shares
-        shares = api_response['ocs']['data']['nextcloud']['shares']
-        self.result.append('multigraph nextcloud_shares')
-
-        # append for every key in shares the key and the value if the key starts with "num"
-        for key, value in shares.items():
-            if key.startswith('num'):
-                self.result.append('{k}.value {v}'.format(k=key, v=value))
-
-        # dbsize
-        dbsize = api_response['ocs']['data']['server']['database']['size']
-        self.result.append('multigraph nextcloud_dbsize')
-        self.result.append('db_size.value %s' % dbsize)
-
-        # app updates
-        # precaution for Nextcloud versions prior to version 14
-        version = api_response['ocs']['data']['nextcloud']['system']['version'].split(sep=".")
-
-        if int(version[0]) >= 14:
-            num_updates_available = api_response['ocs']['data']['nextcloud']['system']['apps']['num_updates_available']
-            self.result.append('multigraph nextcloud_available_updates')
-            self.result.append('num_updates_available.value %s' % num_updates_available)
-
-        # storage
-        storage = api_response['ocs']['data']['nextcloud']['storage']
-        self.result.append('multigraph nextcloud_storages')
-
-        # append for every key in storage the key and the value if the key starts with "num"
-        for key, value in storage.items():
-            if key.startswith('num_storages'):
-                self.result.append('{k}.value {v}'.format(k=key, v=value))
-
-        # filecount
-        num_files = api_response['ocs']['data']['nextcloud']['storage']['num_files']
-        self.result.append('multigraph nextcloud_filecount')
-        self.result.append('num_files.value %s' % num_files)
-
-    def run(self):
-        # init request session with specific header and credentials
-        with requests.Session() as s:
-            # read credentials from env
-            s.auth = (os.environ.get('username'), os.environ.get('password'))
-
-            # update header for json
-            s.headers.update({'Accept': 'application/json'})
-
-            # request the data
-            r = s.get(os.environ.get('url'))
-
-        # if status code is successful continue
-        if r.status_code == 200:
-            self.parse_data(r.json())
-
-            # output results to stdout
-            for el in self.result:
-                print(el, file=sys.stdout)
-
-        elif r.status_code == 996:
-            print('server error')
-        elif r.status_code == 997:
-            print('not authorized')
-        elif r.status_code == 998:
-            print('not found')
-        else:
-            print('unknown error')
-
-    def main(self):
-        # check if any argument is given
-        if sys.argv.__len__() >= 2:
-            # check if first argument is config or autoconf if not fetch data
-            if sys.argv[1] == "config":
-                # output config list to stdout
-                for el in self.config:
-                    print(el, file=sys.stdout)
-
-                # if DIRTYCONFIG true also return the corresponding values
-                if os.environ.get('MUNIN_CAP_DIRTYCONFIG') == '1':
-                    self.run()
-
-            elif sys.argv[1] == 'autoconf':
-                if None in [os.environ.get('username'), os.environ.get('password')]:
-                    print('env variables are missing')
-                else:
-                    print('yes')
-        else:
-            self.run()
+        super().__init__()
+        self.reports = list()
+        self.instance = None
+
+        # with env.instances every graph gets an aggregate and one child graph per instance
+        self.instances = instances.configured()
+        if self.instances:
+            self.config = instances.nest_config(self.config, self.instances)
+
+        # with env.perf_graph 1 the plugin graphs its own runtime, once for all instances
+        self.perf = os.environ.get('perf_graph') == '1'
+        if self.perf:
+            self.config.extend(registry.config(registry.PERF_GRAPHS, True))
+            self.perf_extractor = registry.Extractor(registry.PERF_GRAPHS, True)
+
+        # with env.fpm_status the status of the php-fpm pool is graphed as well, once for all instances
+        self.fpm = fpm.enabled()
+        if self.fpm:
+            self.config.extend(registry.config(registry.FPM_GRAPHS, True))
+            self.fpm_extractor = registry.Extractor(registry.FPM_GRAPHS, True)
+
+    def collect(self):
+        # the php-fpm status is requested while serverinfo is, so it adds no wall time
+        status = fpm.StatusRequest() if self.fpm else None
+        error = self.collect_serverinfo()
+        if status is None:
+            return error
+
+        # a saturated pool is the usual reason for serverinfo to fail, so its status is reported either way
+        if error is not None:
+            print(error, file=sys.stderr)
+            self.result = list()
+        self.result.extend(self.fpm_extractor.values(None, status.values() or dict()))
+        return None
+
+    def collect_serverinfo(self):
+        self.parse_time = 0.0
+        if not self.instances:
+            error = super().collect()
+            self.reports = [self.report]
+            return error
+
+        # fetch all instances concurrently and parse every successful response on its own
+        results = OrderedDict()
+        responses = instances.fetch_all(self.instances, sections=self.sections, paths=self.paths)
+        self.reports = list(responses.values())
+        for name, report in responses.items():
+            self.result = list()
+            self.instance = name
+            if self.handle(report) is None:
+                results[name] = self.result
+                self.record(self.result, report, instance=name)
+            else:
+                # a failing instance still reports the age of its data and the state of its circuit breaker
+                results[name] = list(self.extractor.values(None, self.plugin_values()))
+
+        self.result = instances.nest_results(results, registry.aggregates(self.graphs))
+        return None
+
+    def plugin_values(self):
+        values = super().plugin_values()
+        if self.report is not None and self.report.status_code == 200:
+            values.update(forecast.values(self.report.data, time.time() - self.report.age, self.instance))
+        return values
+
+    def perf_values(self, output_time):
+        # request phases are the slowest of all instances, sizes the sum and hit rates the share of instances
+        stats = [report.stats for report in self.reports if report.stats]
+        values = {'parse': '%.6f' % self.parse_time, 'output': '%.6f' % output_time}
+
+        for phase in ('connect', 'tls', 'ttfb', 'download'):
+            times = [s['phases'][phase] for s in stats if phase in s.get('phases', ())]
+            if times:
+                values[phase] = '%.6f' % max(times)
+
+        for size in ('payload_bytes', 'transfer_bytes'):
+            sizes = [s[size] for s in stats if size in s]
+            if sizes:
+                values[size] = sum(sizes)
+
+        if self.reports:
+            for field, source in (('cache', 'hit'), ('collector', 'collector'), ('stale', 'stale')):
+                hits = sum(1 for s in stats if s.get('source') == source)
+                values[field] = '%.0f' % (100.0 * hits / len(self.reports))
+
+        return values
+
+    def run(self, out=None):
+        if not self.perf:
+            return super().run(out)
+
+        out = out or sys.stdout
+        error = self.fetch()
+        if error:
+            print(error, file=out)
+            return
+
+        # the instrumentation comes last, so it can tell how long writing everything else took
+        started = time.monotonic()
+        for el in self.result:
+            print(el, file=out)
+        out.flush()
+
+        for el in self.perf_extractor.values(None, self.perf_values(time.monotonic() - started)):
+            print(el, file=out)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+# Shared helpers for the nextcloud munin plugins
+#
+# The plugins in the repository root stay standalone scripts which can be
+# symlinked into the munin plugin directory. Everything they have in common
+# (fetching serverinfo, caching, the munin command handling) lives here.
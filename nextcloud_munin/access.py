@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Request rates and latency percentiles from the web server access log
+#
+# Every run reads the requests appended to the access logs (env.access_log,
+# several files separated by spaces) since the previous run, classifies them
+# by route and adds their request time to one quantile sketch per class
+# (nextcloud_munin/sketch.py). The sketches of all classes merge into the one
+# of all requests, no request time is kept, so a busy log costs the same
+# memory as a quiet one. The number of requests per class is kept as a
+# running total for munin to turn into rates.
+#
+# The request path is read from the request line ("GET /path HTTP/1.1") of the
+# common and combined formats of nginx and Apache, the request time from the
+# whitespace separated field env.access_time_field of the line (default -1,
+# the last one) in the unit env.access_time_unit: s for nginx $request_time
+# (default), ms, or us for Apache %D.
+import os
+import re
+
+from nextcloud_munin.sketch import Sketch
+
+DEFAULT_ACCESS_LOG = '/var/log/nginx/access.log'
+QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+UNITS = {'s': 1.0, 'ms': 1e-3, 'us': 1e-6}
+
+REQUEST = re.compile(rb'"[A-Z]+ (\S+)[^"]*"')
+STATIC = re.compile(r'\.(?:js|mjs|css|map|png|jpe?g|gif|svg|ico|webp|woff2?|ttf|otf)$')
+
+# request classes and the path prefixes selecting them in this order, static files are recognized by their
+# extension, so files downloaded through WebDAV still count as WebDAV
+CLASSES = (
+    ('webdav', 'WebDAV', ('/remote.php/dav', '/remote.php/webdav', '/public.php/dav', '/public.php/webdav')),
+    ('ocs', 'OCS API', ('/ocs/', '/ocs-provider/')),
+    ('static', 'static files', ()),
+    ('page', 'pages', ('/index.php', '/apps/', '/login', '/logout', '/s/', '/settings/')),
+    ('other', 'other', ()),
+)
+
+
+def classify(path):
+    path = path.split('?', 1)[0]
+    for name, _, prefixes in CLASSES:
+        if name == 'static' and STATIC.search(path) or prefixes and path.startswith(prefixes):
+            return name
+    return 'page' if path == '/' else 'other'
+
+
+def parse(line, field, unit):
+    # (class, request time in seconds) of a log line or None
+    m = REQUEST.search(line)
+    if m is None:
+        return None
+
+    try:
+        value = float(line.split()[field].strip(b'"'))
+    except (IndexError, ValueError):
+        return None
+
+    return classify(m.group(1).decode('utf-8', 'replace')), value * unit
+
+
+def count(tail):
+    # the sketch per class of the new requests, the request totals are added to tail.data
+    field = int(os.environ.get('access_time_field', -1))
+    unit = UNITS[os.environ.get('access_time_unit', 's')]
+    requests = tail.data.setdefault('requests', dict((name, 0) for name, _, _ in CLASSES))
+    tail.data.setdefault('invalid', 0)
+    sketches = dict((name, Sketch()) for name, _, _ in CLASSES)
+
+    for line in tail.lines():
+        parsed = parse(line, field, unit)
+        if parsed is None:
+            if line.strip():
+                tail.data['invalid'] += 1
+            continue
+
+        name, seconds = parsed
+        requests[name] += 1
+        sketches[name].add(seconds)
+
+    return sketches
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Persistent circuit breaker per nextcloud instance
+#
+# Consecutive failed requests are counted in the plugin state directory. Once
+# env.breaker_threshold failures in a row were seen the circuit opens and no
+# request is sent for env.breaker_backoff seconds, doubled with every further
+# failure up to env.breaker_max_backoff. After that a single trial request is
+# let through (half open), its outcome closes or reopens the circuit.
+import contextlib
+import fcntl
+import json
+import os
+import time
+
+from nextcloud_munin.cache import cache_key, state_dir
+
+DEFAULT_THRESHOLD = 3
+DEFAULT_BACKOFF = 60
+DEFAULT_MAX_BACKOFF = 3600
+
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+# error classes of the status codes nextcloud answers with
+ERROR_CLASSES = {
+    996: 'server error',
+    997: 'not authorized',
+    998: 'not found',
+}
+
+
+def error_class(status_code=None, exception=None):
+    if exception is not None:
+        name = type(exception).__name__.lower()
+        return 'timeout' if 'timeout' in name else 'connection error'
+    return ERROR_CLASSES.get(status_code, 'http %s' % status_code)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, url, username, directory=None):
+        self.path = os.path.join(directory or state_dir(), 'nextcloud_breaker_%s.json' % cache_key(url, username))
+        self.threshold = int(os.environ.get('breaker_threshold', DEFAULT_THRESHOLD))
+        self.backoff = float(os.environ.get('breaker_backoff', DEFAULT_BACKOFF))
+        self.max_backoff = float(os.environ.get('breaker_max_backoff', DEFAULT_MAX_BACKOFF))
+
+    @contextlib.contextmanager
+    def state(self):
+        # read-modify-write of the state file under an exclusive lock
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'r+', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = json.load(f)
+            except ValueError:
+                state = dict()
+            state.setdefault('state', CLOSED)
+            state.setdefault('failures', 0)
+            state.setdefault('last_error', None)
+            state.setdefault('open_until', 0)
+
+            before = dict(state)
+            yield state
+
+            if state != before:
+                f.seek(0)
+                json.dump(state, f)
+                f.truncate()
+
+    def health(self):
+        with self.state() as state:
+            return {'breaker_state': state['state'], 'failures': state['failures'], 'last_error': state['last_error']}
+
+    def allow(self):
+        # whether a request may be sent now, the first caller after the backoff gets the trial request
+        with self.state() as state:
+            if state['state'] == CLOSED:
+                return True
+            if time.time() < state['open_until']:
+                return False
+
+            # half open, keep everyone else out until the trial request reported back
+            state['state'] = HALF_OPEN
+            state['open_until'] = time.time() + self.current_backoff(state['failures'])
+            return True
+
+    def current_backoff(self, failures):
+        return min(self.max_backoff, self.backoff * 2 ** max(0, failures - self.threshold))
+
+    def record_success(self):
+        with self.state() as state:
+            state.update({'state': CLOSED, 'failures': 0, 'last_error': None, 'open_until': 0})
+
+    def record_failure(self, error):
+        with self.state() as state:
+            state['failures'] += 1
+            state['last_error'] = error
+            if state['failures'] >= self.threshold:
+                state['state'] = OPEN
+                state['open_until'] = time.time() + self.current_backoff(state['failures'])
+
+    def guard(self, request, claim=None):
+        # wrap a request function returning (status_code, data, stats) to record its outcome, claim tells
+        # whether the outcome is still to be recorded when the caller may have recorded it already
+        def guarded(*args, **kwargs):
+            if not self.allow():
+                raise CircuitOpen('circuit open')
+
+            try:
+                result = request(*args, **kwargs)
+            except Exception as e:
+                if claim is None or claim():
+                    self.record_failure(error_class(exception=e))
+                raise
+
+            if claim is None or claim():
+                if result[0] == 200:
+                    self.record_success()
+                else:
+                    self.record_failure(error_class(result[0]))
+            return result
+
+        return guarded
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache of the parsed serverinfo response
+#
+# munin-node starts all plugins of a cycle at roughly the same time. Without a
+# shared cache every single plugin would ask the serverinfo endpoint to compute
+# the whole report again. The cache is keyed by url and credentials and guarded
+# by a file lock, so only the first plugin fetches while the others wait for
+# the lock and read the stored result afterwards.
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+DEFAULT_TTL = 60
+
+
+def state_dir():
+    # munin-node exports a writable state directory for every plugin
+    directory = os.environ.get('MUNIN_PLUGSTATE') or tempfile.gettempdir()
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def cache_key(*parts):
+    digest = hashlib.sha256('\0'.join(str(part or '') for part in parts).encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+
+class ResponseCache:
+    def __init__(self, url, username, password, ttl=None, directory=None):
+        if ttl is None:
+            ttl = float(os.environ.get('cache_ttl', DEFAULT_TTL))
+
+        self.ttl = ttl
+        self.path = os.path.join(directory or state_dir(),
+                                 'nextcloud_serverinfo_%s.json' % cache_key(url, username, password))
+        self.lock_path = self.path + '.lock'
+
+        # either 'hit', 'miss' or 'disabled' and the entry served after get() has been called
+        self.status = None
+        self.entry = None
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def is_fresh(self, entry, sections=(), paths=None):
+        # an entry only answers a request if it contains every section and key path the request needs
+        return (entry is not None and time.time() - entry['time'] < self.ttl
+                and set(sections) <= set(entry.get('sections', ()))
+                and covers(entry.get('paths'), paths))
+
+    def last_good(self, sections=(), paths=None):
+        # the last successful entry covering the request, no matter how old it is
+        entry = self.load()
+        if entry is not None and entry['status_code'] != 200:
+            entry = entry.get('last_good')
+
+        if (entry is None or not set(sections) <= set(entry.get('sections', ()))
+                or not covers(entry.get('paths'), paths)):
+            return None
+        return entry
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, status_code, data, stats=None):
+        entry = dict(stats or {}, time=time.time(), status_code=status_code, data=data)
+
+        # an error must not throw away the last good report, it is the fallback for missed deadlines
+        if status_code != 200:
+            previous = self.load()
+            if previous is not None:
+                entry['last_good'] = previous if previous['status_code'] == 200 else previous.get('last_good')
+
+        # write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.nextcloud_serverinfo_')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+        return entry
+
+    @contextlib.contextmanager
+    def lock(self):
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def get(self, fetch, sections=(), paths=None):
+        # fetch is a callable taking the sections and key paths to request and returning (status_code, data, stats)
+        if not self.enabled:
+            self.status = 'disabled'
+            status_code, data, stats = fetch(sections, paths)
+            self.entry = dict(stats, time=time.time(), status_code=status_code, data=data)
+            return status_code, data
+
+        entry = self.load()
+        if not self.is_fresh(entry, sections, paths):
+            with self.lock():
+                # another plugin might have refreshed the entry while we were waiting for the lock
+                entry = self.load()
+                if not self.is_fresh(entry, sections, paths):
+                    # keep asking for the sections and paths of the previous entry, so all plugins
+                    # of a cycle converge on one request which covers every one of them
+                    if entry is not None:
+                        sections = set(sections) | set(entry.get('sections', ()))
+                        paths = merge_paths(paths, entry.get('paths'))
+
+                    self.status = 'miss'
+                    self.entry = self.store(*fetch(sections, paths))
+                    return self.entry['status_code'], self.entry['data']
+
+        self.status = 'hit'
+        self.entry = entry
+        return entry['status_code'], entry['data']
+
+
+def covers(cached_paths, paths):
+    # None stands for the whole document
+    if cached_paths is None:
+        return True
+    if paths is None:
+        return False
+
+    cached_paths = [tuple(path) for path in cached_paths]
+    return all(any(tuple(path[:len(cached)]) == cached for cached in cached_paths) for path in paths)
+
+
+def merge_paths(paths, other):
+    if paths is None or other is None:
+        return None
+
+    return sorted(set(tuple(path) for path in paths) | set(tuple(path) for path in other))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# Resident collector for the nextcloud munin plugins
+#
+# Keeps a warm keep-alive connection to the nextcloud instance, refreshes the
+# serverinfo report on its own schedule and answers the latest report on a
+# local unix socket. Plugins with env.collector_socket set ask the collector
+# first and only fall back to fetching themselves if it is not reachable.
+#
+# usage: url=... username=... password=... collector_socket=/run/munin/nextcloud.sock \
+#            python3 -m nextcloud_munin.collector
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import requests
+
+from nextcloud_munin import serverinfo
+from nextcloud_munin.breaker import CircuitBreaker, CircuitOpen
+
+DEFAULT_INTERVAL = 60
+CLIENT_TIMEOUT = 2.0
+
+
+def query(path, timeout=CLIENT_TIMEOUT):
+    # ask a running collector for the latest report, returns the snapshot with time, status_code and data
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(b'serverinfo\n')
+        s.shutdown(socket.SHUT_WR)
+
+        chunks = list()
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    snapshot = json.loads(b''.join(chunks).decode('utf-8'))
+    if snapshot.get('time') is None or snapshot.get('status_code') is None:
+        raise ValueError('collector has no data yet')
+
+    return snapshot
+
+
+class Collector:
+    def __init__(self, url, username, password, interval=DEFAULT_INTERVAL):
+        self.url = url
+        self.interval = interval
+        self.timeout = float(os.environ.get('timeout', serverinfo.DEFAULT_TIMEOUT))
+
+        # one long-lived session keeps the tls connection to the instance alive
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers.update({'Accept': 'application/json'})
+
+        # shared with the plugins, which skip the instance as well while the circuit is open
+        self.breaker = CircuitBreaker(url, username)
+
+        self.lock = threading.Lock()
+        self.snapshot = {'time': None, 'status_code': None, 'data': None, 'interval': interval}
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        try:
+            status_code, data, stats = self.breaker.guard(serverinfo.request)(self.url, session=self.session,
+                                                                              timeout=self.timeout)
+        except CircuitOpen:
+            return
+        except requests.RequestException as e:
+            # keep serving the previous report, the plugins stop using it once it is too old
+            print('refresh failed: %s' % e, file=sys.stderr)
+            return
+
+        with self.lock:
+            self.snapshot = dict(stats, time=time.time(), status_code=status_code, data=data, interval=self.interval)
+
+    def current(self):
+        with self.lock:
+            return json.dumps(self.snapshot).encode('utf-8')
+
+    def try_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            # keep serving the previous report
+            print('refresh failed: %s' % e, file=sys.stderr)
+
+    def refresh_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.try_refresh()
+
+    def serve(self, path):
+        collector = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                if self.rfile.readline().strip() == b'serverinfo':
+                    self.wfile.write(collector.current())
+
+        # remove a stale socket left behind by a previous run
+        if os.path.exists(path):
+            os.unlink(path)
+
+        # after a failed first refresh the snapshot stays empty, the plugins fetch directly until one succeeds
+        self.try_refresh()
+        threading.Thread(target=self.refresh_loop, daemon=True).start()
+
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+            # munin plugins usually run as a different user in the same group
+            os.chmod(path, int(os.environ.get('collector_socket_mode', '660'), 8))
+            try:
+                server.serve_forever()
+            finally:
+                self.stopped.set()
+                os.unlink(path)
+
+
+def main():
+    path = os.environ.get('collector_socket')
+    if not path:
+        print('env variable collector_socket is missing', file=sys.stderr)
+        sys.exit(1)
+
+    collector = Collector(os.environ.get('url'), os.environ.get('username'), os.environ.get('password'),
+                          interval=float(os.environ.get('collector_interval', DEFAULT_INTERVAL)))
+    # let the service manager stop the collector with a clean removal of the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        collector.serve(path)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+# Collect the counts of the serverinfo report straight from the nextcloud database
+#
+# With env.backend database the plugins do not ask the serverinfo endpoint,
+# which runs the same queries in PHP on an app server worker, but query the
+# database themselves. The result has the shape of the serverinfo report, so
+# parse_data() emits identical lines for everything the database knows:
+#
+#   storage       num_users, num_files, num_storages(_local, _home, _other)
+#   shares        num_shares(_user, _groups, _link, _mail, _room, _link_no_password),
+#                 num_fed_shares_sent, num_fed_shares_received
+#   activeUsers   last5minutes, last1hour, last24hours
+#   database      type, size
+#
+# Version, app updates, system load and php statistics are only known to the
+# app server and missing from this report.
+#
+# The connection is read from nextcloud's config.php (env.db_config) and/or
+# env.db_type (sqlite3, mysql, pgsql), env.db_name, env.db_host, env.db_port,
+# env.db_user, env.db_password, env.db_prefix and for sqlite env.db_path.
+# sqlite3 is part of python, mysql needs pymysql and pgsql psycopg2. With
+# env.db_approximate 1 the number of files is taken from the table statistics
+# of mysql and pgsql instead of counting the whole filecache.
+import os
+import re
+import time
+
+# the url the database backend is known by to the cache and the circuit breaker
+SCHEME = 'database:'
+
+DEFAULT_PREFIX = 'oc_'
+
+# share types, see OCP\Share\IShare
+SHARE_USER = 0
+SHARE_GROUP = 1
+SHARE_LINK = 3
+SHARE_EMAIL = 4
+SHARE_REMOTE = 6
+SHARE_ROOM = 10
+
+CONFIG_ENTRY = re.compile(r"""['"](\w+)['"]\s*=>\s*(?:'((?:[^'\\]|\\.)*)'|"((?:[^"\\]|\\.)*)"|(-?\d+)|(true|false))""")
+
+# the report sections and the key path prefix selecting them
+PARTS = (
+    ('storage', ('ocs', 'data', 'nextcloud', 'storage')),
+    ('shares', ('ocs', 'data', 'nextcloud', 'shares')),
+    ('active_users', ('ocs', 'data', 'activeUsers')),
+    ('database', ('ocs', 'data', 'server', 'database')),
+)
+
+
+def enabled():
+    return os.environ.get('backend') == 'database'
+
+
+def read_config(path):
+    # the scalar entries of a nextcloud config.php
+    with open(path, encoding='utf-8') as f:
+        content = f.read()
+
+    config = dict()
+    for m in CONFIG_ENTRY.finditer(content):
+        key, single, double, number, boolean = m.groups()
+        if single is not None:
+            config[key] = re.sub(r"\\(['\\])", r'\1', single)
+        elif double is not None:
+            config[key] = re.sub(r'\\(.)', r'\1', double)
+        elif number is not None:
+            config[key] = number
+        else:
+            config[key] = boolean
+    return config
+
+
+def settings():
+    # connection settings, env overrides config.php
+    config = read_config(os.environ['db_config']) if os.environ.get('db_config') else dict()
+    result = {
+        'type': config.get('dbtype', 'sqlite3'),
+        'name': config.get('dbname', 'nextcloud'),
+        'host': config.get('dbhost', 'localhost'),
+        'port': config.get('dbport', ''),
+        'user': config.get('dbuser'),
+        'password': config.get('dbpassword'),
+        'prefix': config.get('dbtableprefix', DEFAULT_PREFIX),
+        'path': None,
+    }
+    if 'datadirectory' in config:
+        result['path'] = os.path.join(config['datadirectory'], '%s.db' % result['name'])
+
+    for key in result:
+        if os.environ.get('db_%s' % key) is not None:
+            result[key] = os.environ['db_%s' % key]
+
+    # dbhost may carry the port or a unix socket, e.g. localhost:3306 or localhost:/run/mysqld/mysqld.sock
+    host, sep, rest = result['host'].partition(':')
+    if sep and not result['port']:
+        result['host'] = host
+        result['port'] = rest
+
+    if result['type'] == 'sqlite':
+        result['type'] = 'sqlite3'
+    return result
+
+
+def source(config=None):
+    # the url identifying the database, used as the cache and breaker key instead of the serverinfo url
+    config = config or settings()
+    if config['type'] == 'sqlite3':
+        return '%ssqlite3:%s' % (SCHEME, os.path.abspath(config['path'] or ''))
+    return '%s%s://%s@%s:%s/%s' % (SCHEME, config['type'], config['user'], config['host'], config['port'],
+                                   config['name'])
+
+
+class Database:
+    def __init__(self, config, timeout=None):
+        self.config = config
+        self.type = config['type']
+        self.prefix = config['prefix']
+        self.connection = self.connect(timeout)
+
+    def connect(self, timeout):
+        config = self.config
+        if self.type == 'sqlite3':
+            import sqlite3
+            if not config['path']:
+                raise ValueError('env variable db_path is missing')
+            return sqlite3.connect('file:%s?mode=ro' % config['path'], uri=True, timeout=timeout or 5)
+
+        if self.type == 'mysql':
+            import pymysql
+            socket = config['port'] if config['port'].startswith('/') else None
+            return pymysql.connect(host=config['host'], port=int(config['port']) if config['port'] and not socket else 3306,
+                                   unix_socket=socket, user=config['user'], password=config['password'] or '',
+                                   database=config['name'], connect_timeout=int(timeout or 10))
+
+        if self.type == 'pgsql':
+            import psycopg2
+            return psycopg2.connect(host=config['host'], port=config['port'] or None, user=config['user'],
+                                    password=config['password'], dbname=config['name'],
+                                    connect_timeout=int(timeout or 10))
+
+        raise ValueError('database type %s is not supported' % self.type)
+
+    def close(self):
+        self.connection.close()
+
+    def rows(self, sql, parameters=None):
+        # all rows of the query, {p} is the table prefix and %s a parameter
+        sql = sql.replace('{p}', self.prefix)
+        if self.type == 'sqlite3':
+            sql = sql.replace('%s', '?')
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, parameters) if parameters is not None else cursor.execute(sql)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def query(self, sql, parameters=None):
+        # the first row of the query
+        rows = self.rows(sql, parameters)
+        return rows[0] if rows else None
+
+    def count(self, table):
+        return int(self.query('SELECT COUNT(*) FROM {p}%s' % table)[0])
+
+    def estimate(self, table):
+        # the row count from the table statistics, cheap but only approximate
+        if self.type == 'mysql':
+            row = self.query('SELECT table_rows FROM information_schema.tables '
+                             'WHERE table_schema = DATABASE() AND table_name = %s', (self.prefix + table,))
+        elif self.type == 'pgsql':
+            row = self.query('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', (self.prefix + table,))
+        else:
+            row = None
+        if row is None or row[0] is None or int(row[0]) < 0:
+            return self.count(table)
+        return int(row[0])
+
+    def storage(self):
+        storages, local, home = self.query(
+            "SELECT COUNT(*), "
+            "COALESCE(SUM(CASE WHEN id LIKE 'local::%' THEN 1 ELSE 0 END), 0), "
+            "COALESCE(SUM(CASE WHEN id LIKE 'home::%' THEN 1 ELSE 0 END), 0) "
+            "FROM {p}storages")
+        approximate = os.environ.get('db_approximate') == '1'
+        return {
+            'num_users': int(self.query("SELECT COUNT(*) FROM {p}preferences "
+                                        "WHERE appid = 'login' AND configkey = 'lastLogin'")[0]),
+            'num_files': self.estimate('filecache') if approximate else self.count('filecache'),
+            'num_storages': int(storages),
+            'num_storages_local': int(local),
+            'num_storages_home': int(home),
+            'num_storages_other': int(storages) - int(local) - int(home),
+        }
+
+    def shares(self):
+        # one pass over the share table for all share types
+        by_type = dict((int(share_type), (int(count), int(no_password))) for share_type, count, no_password in self.rows(
+            'SELECT share_type, COUNT(*), COALESCE(SUM(CASE WHEN password IS NULL THEN 1 ELSE 0 END), 0) '
+            'FROM {p}share GROUP BY share_type'))
+
+        try:
+            received = self.count('share_external')
+        except Exception:
+            # the table only exists while federated file sharing is installed
+            self.connection.rollback()
+            received = 0
+
+        return {
+            'num_shares': sum(count for count, _ in by_type.values()),
+            'num_shares_user': by_type.get(SHARE_USER, (0, 0))[0],
+            'num_shares_groups': by_type.get(SHARE_GROUP, (0, 0))[0],
+            'num_shares_link': by_type.get(SHARE_LINK, (0, 0))[0],
+            'num_shares_mail': by_type.get(SHARE_EMAIL, (0, 0))[0],
+            'num_shares_room': by_type.get(SHARE_ROOM, (0, 0))[0],
+            'num_shares_link_no_password': by_type.get(SHARE_LINK, (0, 0))[1],
+            'num_fed_shares_sent': by_type.get(SHARE_REMOTE, (0, 0))[0],
+            'num_fed_shares_received': received,
+        }
+
+    def active_users(self, now=None):
+        # lastLogin is stored as text, compare it as a number like nextcloud does
+        now = int(now or time.time())
+        cast = {'sqlite3': 'INTEGER', 'mysql': 'UNSIGNED', 'pgsql': 'BIGINT'}[self.type]
+        row = self.query(
+            "SELECT COALESCE(SUM(CASE WHEN last_login >= %s THEN 1 ELSE 0 END), 0), "
+            "COALESCE(SUM(CASE WHEN last_login >= %s THEN 1 ELSE 0 END), 0), "
+            "COALESCE(SUM(CASE WHEN last_login >= %s THEN 1 ELSE 0 END), 0) "
+            "FROM (SELECT CAST(configvalue AS " + cast + ") AS last_login FROM {p}preferences "
+            "WHERE appid = 'login' AND configkey = 'lastLogin') logins",
+            (now - 300, now - 3600, now - 86400))
+        return {'last5minutes': int(row[0]), 'last1hour': int(row[1]), 'last24hours': int(row[2])}
+
+    def database(self):
+        if self.type == 'sqlite3':
+            size = os.path.getsize(self.config['path'])
+        elif self.type == 'mysql':
+            size = self.query('SELECT SUM(data_length + index_length) FROM information_schema.tables '
+                              'WHERE table_schema = DATABASE()')[0]
+        else:
+            size = self.query('SELECT pg_database_size(current_database())')[0]
+        return {'type': self.type, 'size': int(size or 0)}
+
+
+def wanted(paths):
+    # the report parts the key paths need, all of them without paths
+    if paths is None:
+        return [name for name, _ in PARTS]
+    paths = [tuple(path) for path in paths]
+    return [name for name, prefix in PARTS
+            if any(path[:len(prefix)] == prefix or prefix[:len(path)] == path for path in paths)]
+
+
+def request(url=None, username=None, password=None, timeout=None, sections=(), paths=None):
+    # same as serverinfo.request(), the url, credentials and sections are not needed
+    started = time.monotonic()
+    database = Database(settings(), timeout)
+    connected = time.monotonic()
+    try:
+        parts = dict((name, getattr(database, name)()) for name in wanted(paths))
+    finally:
+        database.close()
+
+    data = dict()
+    if 'storage' in parts or 'shares' in parts:
+        data['nextcloud'] = dict((name, parts[name]) for name in ('storage', 'shares') if name in parts)
+    if 'active_users' in parts:
+        data['activeUsers'] = parts['active_users']
+    if 'database' in parts:
+        data['server'] = {'database': parts['database']}
+
+    stats = {
+        'sections': sorted(sections),
+        'paths': paths and sorted(paths),
+        'fetch_time': time.monotonic() - started,
+        'phases': {'connect': connected - started, 'ttfb': time.monotonic() - connected},
+        'payload_bytes': 0,
+        'transfer_bytes': 0,
+    }
+
+    return 200, {'ocs': {'meta': {'status': 'ok', 'statuscode': 200, 'message': 'OK'}, 'data': data}}, stats
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+# Disk usage of the nextcloud data directory per user and category
+#
+# The data directory holds per user the files, the trash bin
+# (files_trashbin) and the old versions (files_versions), and the previews of
+# all users below appdata_<instanceid>/preview. Each of these is a root the
+# scanner walks with env.datadir_workers threads calling os.scandir, the
+# directories of all roots are listed concurrently.
+#
+# The listing of every directory is cached in the plugin state directory with
+# the directory mtime: the bytes and number of its files and its
+# subdirectories, in a file per root next to an index holding the totals of
+# every root, so a run only reads and writes the listings of the roots it
+# walks. A directory whose mtime did not change costs a single stat, its files
+# are neither listed nor stat'ed again, only its subdirectories are visited.
+# Nextcloud writes every file to a part file and renames it, which changes the
+# mtime of the directory, so an unchanged mtime means unchanged files.
+#
+# A run stops listing after env.datadir_budget seconds. The roots are visited
+# one after the other, the ones scanned completely the longest ago first. The
+# directories not reached keep their cached totals and the next run continues
+# with them, so a large data directory is brought up to date over several runs.
+import contextlib
+import fcntl
+import heapq
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from nextcloud_munin.cache import cache_key, state_dir
+from nextcloud_munin.database import read_config
+
+DEFAULT_WORKERS = 8
+DEFAULT_BUDGET = 8
+DEFAULT_TOP = 10
+
+# directory of a user below the data directory to category
+CATEGORIES = (
+    ('files', 'files'),
+    ('files_trashbin', 'trashbin'),
+    ('files_versions', 'versions'),
+)
+PREVIEWS = 'previews'
+
+# positions in the cached listing of a directory
+MTIME, BYTES, FILES, CHILDREN = range(4)
+
+
+def data_directory():
+    # env.datadir or the datadirectory of nextcloud's config.php (env.db_config)
+    if os.environ.get('datadir'):
+        return os.environ['datadir']
+    if os.environ.get('db_config'):
+        return read_config(os.environ['db_config']).get('datadirectory')
+    return None
+
+
+def roots(directory):
+    # (relative path, user or None, category) of every root below the data directory
+    result = list()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if entry.name.startswith('appdata_'):
+                if os.path.isdir(os.path.join(entry.path, 'preview')):
+                    result.append(('%s/preview' % entry.name, None, PREVIEWS))
+            elif os.path.isdir(os.path.join(entry.path, 'files')):
+                for name, category in CATEGORIES:
+                    if os.path.isdir(os.path.join(entry.path, name)):
+                        result.append(('%s/%s' % (entry.name, name), entry.name, category))
+    return sorted(result)
+
+
+def usage(stat):
+    # the bytes allocated on disk like du, the size where the file system does not tell
+    blocks = getattr(stat, 'st_blocks', None)
+    return blocks * 512 if blocks is not None else stat.st_size
+
+
+def visit(path, cached):
+    # runs in a worker: (listing, whether the directory was listed), the listing keeps the cached subdirectories
+    stat = os.stat(path, follow_symlinks=False)
+    if cached is not None and cached[MTIME] == stat.st_mtime_ns:
+        return cached, False
+
+    # the directory itself takes space as well, as with du
+    size = usage(stat)
+    files = 0
+    children = dict()
+    old = cached[CHILDREN] if cached is not None else dict()
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    children[entry.name] = old.get(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    size += usage(entry.stat(follow_symlinks=False))
+                    files += 1
+            except FileNotFoundError:
+                # removed while listing
+                continue
+    return [stat.st_mtime_ns, size, files, children], True
+
+
+def locate(entry, key, path):
+    # (parent, name) under which the listing of path below the root key is kept, None if it is not cached
+    parent, name = entry, 'listing'
+    for part in path[len(key):].split('/')[1:]:
+        listing = parent[name]
+        if listing is None or part not in listing[CHILDREN]:
+            return None
+        parent, name = listing[CHILDREN], part
+    return parent, name
+
+
+def total(listing):
+    # (bytes, files) of a directory and all directories below it
+    size, files = 0, 0
+    stack = [listing]
+    while stack:
+        listing = stack.pop()
+        if listing is None:
+            continue
+        size += listing[BYTES]
+        files += listing[FILES]
+        stack.extend(listing[CHILDREN].values())
+    return size, files
+
+
+class DatadirCache:
+    # an index of the roots with their totals, and the listing of each root in a file of its own, so a run
+    # reads and writes the listings of the roots it walks only
+    def __init__(self, directory, state_directory=None):
+        self.path = os.path.join(state_directory or state_dir(), 'nextcloud_datadir_%s.json' % cache_key(directory))
+
+    def listing_path(self, key):
+        return '%s_%s.json' % (self.path[:-len('.json')], cache_key(key)[:16])
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {'roots': {}}
+        return state if isinstance(state, dict) and 'roots' in state else {'roots': {}}
+
+    def load_listing(self, key):
+        # the cached listing of the root, None if it was never listed
+        try:
+            with open(self.listing_path(key), 'r', encoding='utf-8') as f:
+                listing = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return listing if isinstance(listing, list) else None
+
+    @contextlib.contextmanager
+    def lock(self):
+        # one scanning run at a time, the others report the cache as it is
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
+
+    def store(self, state):
+        self.write(self.path, state)
+
+    def store_listing(self, key, listing):
+        self.write(self.listing_path(key), listing)
+
+    def remove_listing(self, key):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.listing_path(key))
+
+    @staticmethod
+    def write(path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.nextcloud_datadir_')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+
+class Listers:
+    # daemon threads calling visit, a listing hanging on a slow storage keeps neither the run nor the plugin
+    # process from ending
+    def __init__(self, count):
+        self.tasks = queue.Queue()
+        self.results = queue.Queue()
+        self.stopped = threading.Event()
+        self.count = count
+        for _ in range(count):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None or self.stopped.is_set():
+                return
+            item, path, cached = task
+            try:
+                listing, listed = visit(path, cached)
+            except Exception as e:
+                self.results.put((item, None, False, e))
+                continue
+            self.results.put((item, listing, listed, None))
+
+    def submit(self, item, path, cached):
+        self.tasks.put((item, path, cached))
+
+    def stop(self):
+        # the idle threads end, the ones still listing end once their listing returns
+        self.stopped.set()
+        for _ in range(self.count):
+            self.tasks.put(None)
+
+
+class Scan:
+    # one walk over the roots, the listing of a root is loaded from the cache when the walk reaches it
+    def __init__(self, directory, state, now, cache):
+        self.directory = directory
+        self.state = state
+        self.now = now
+        self.cache = cache
+        # root to {'listing': listing} of the roots loaded, and the roots whose listing changed
+        self.loaded = dict()
+        self.changed = set()
+        self.listed = 0
+        self.unchanged = 0
+        self.deferred = 0
+
+    def start(self, key):
+        # the (path, (parent, name)) the walk of the root starts from, the directories left by its previous walk
+        self.loaded[key] = holder = {'listing': self.cache.load_listing(key)}
+        paths = self.state['roots'][key].get('resume') or [key]
+        places = [locate(holder, key, path) for path in paths]
+        if None in places:
+            paths, places = [key], [locate(holder, key, key)]
+        return zip(paths, places)
+
+    def run(self, budget=None, workers=None):
+        budget = float(budget or os.environ.get('datadir_budget', DEFAULT_BUDGET))
+        workers = int(workers or os.environ.get('datadir_workers', DEFAULT_WORKERS))
+        deadline = time.monotonic() + budget
+
+        found = roots(self.directory)
+        entries = self.state['roots']
+        for key in set(entries) - set(path for path, _, _ in found):
+            del entries[key]
+            self.cache.remove_listing(key)
+        for path, user, category in found:
+            entries.setdefault(path, {'user': user, 'category': category, 'time': 0, 'bytes': 0, 'files': 0})
+
+        # the roots scanned completely the longest ago go first, a directory is queued behind its root's
+        # earlier directories, so the budget ends the walk of one root instead of all of them. The queue
+        # starts with an item (without path) per root which loads the listing of the root when it is reached,
+        # a root whose previous walk ran out of budget continues with the directories that were left.
+        order = sorted(entries, key=lambda key: (entries[key]['time'], key))
+        waiting = [(rank, rank, key, None, None, None) for rank, key in enumerate(order)]
+        sequence = len(waiting)
+
+        # sequence to item of the directories being listed
+        running = dict()
+        listers = Listers(workers)
+        try:
+            while waiting or running:
+                while waiting and len(running) < workers * 2 and time.monotonic() < deadline:
+                    item = heapq.heappop(waiting)
+                    rank, _, key, path, parent, name = item
+                    if path is None:
+                        for path, (parent, name) in self.start(key):
+                            heapq.heappush(waiting, (rank, sequence, key, path, parent, name))
+                            sequence += 1
+                        continue
+                    running[item[1]] = item
+                    listers.submit(item, os.path.join(self.directory, path), parent[name])
+                if not running:
+                    break
+
+                try:
+                    item, listing, listed, error = listers.results.get(
+                        timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    # over budget, the directories still being listed keep their cached listing
+                    break
+
+                rank, _, key, path, parent, name = running.pop(item[1])
+                if isinstance(error, FileNotFoundError):
+                    # removed since its parent was listed
+                    parent[name] = None
+                    self.changed.add(key)
+                    continue
+                elif isinstance(error, OSError):
+                    continue
+                elif error is not None:
+                    raise error
+
+                parent[name] = listing
+                if listed:
+                    self.listed += 1
+                    self.changed.add(key)
+                else:
+                    self.unchanged += 1
+                for child in listing[CHILDREN]:
+                    heapq.heappush(waiting, (rank, sequence, key, '%s/%s' % (path, child), listing[CHILDREN], child))
+                    sequence += 1
+        finally:
+            # listings still running on a slow storage are abandoned, not waited for
+            listers.stop()
+
+        # the directories not visited are where the walk of their root continues next time, the roots not
+        # reached keep theirs
+        left = dict()
+        for _, _, key, path, _, _ in waiting + list(running.values()):
+            if key in self.loaded:
+                left.setdefault(key, list()).append(path)
+            else:
+                self.deferred += len(entries[key].get('resume') or [key])
+        self.deferred += sum(len(paths) for paths in left.values())
+        for key, holder in self.loaded.items():
+            if key in left:
+                entries[key]['resume'] = sorted(left[key])
+            else:
+                entries[key].pop('resume', None)
+                entries[key]['time'] = self.now
+            entries[key]['bytes'], entries[key]['files'] = total(holder['listing'])
+            if key in self.changed:
+                self.cache.store_listing(key, holder['listing'])
+        return self
+
+
+def complete(state):
+    # whether every root was scanned completely at least once
+    return all(entry['time'] for entry in state['roots'].values())
+
+
+def categories(state):
+    # category to (bytes, files)
+    result = dict((category, [0, 0]) for _, category in CATEGORIES)
+    result[PREVIEWS] = [0, 0]
+    for entry in state['roots'].values():
+        result[entry['category']][0] += entry['bytes']
+        result[entry['category']][1] += entry['files']
+    return result
+
+
+def users(state, size=None):
+    # the (user, bytes) of the users using the most disk space, files, trash bin and versions together
+    size = size or int(os.environ.get('datadir_top', DEFAULT_TOP))
+    result = dict()
+    for entry in state['roots'].values():
+        if entry['user'] is not None:
+            result[entry['user']] = result.get(entry['user'], 0) + entry['bytes']
+    return sorted(result.items(), key=lambda item: (-item[1], item[0]))[:size]
+
+
+def refresh(directory, now):
+    # (state, scan or None), a run finding another one scanning reports the cache as it is
+    cache = DatadirCache(directory)
+    with cache.lock() as locked:
+        state = cache.load()
+        if not locked:
+            return state, None
+
+        scan = Scan(directory, state, now, cache).run()
+        cache.store(state)
+        return state, scan
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# Prometheus exporter for the nextcloud serverinfo report
+#
+# Refreshes the report of every instance every env.exporter_interval seconds,
+# extracts the values of the multigraph plugin's graphs exactly like the munin
+# plugins do and serves them on /metrics in the Prometheus text format. Every
+# scrape is answered from the rendered snapshot, so any number of scrapers
+# cost one serverinfo request per instance and interval. The response cache is
+# shared with the munin plugins running on the same host.
+#
+# Metrics are named <graph>_<field>, e.g. nextcloud_users_last5minutes, and
+# labelled with the instance (env.instances as for the multigraph plugin, or
+# the host of env.url). Fields munin draws as DERIVE are exported as counters.
+#
+# usage: url=... username=... password=... exporter_listen=127.0.0.1:9205 \
+#            python3 -m nextcloud_munin.exporter
+import gzip
+import os
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from nextcloud_munin import instances, registry, serverinfo
+from nextcloud_munin.plugin import NextcloudPlugin
+
+DEFAULT_INTERVAL = 60
+DEFAULT_LISTEN = '127.0.0.1:9205'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Extraction(NextcloudPlugin):
+    # the graphs and extraction of the multigraph plugin, without its self-instrumentation and php-fpm status
+    graphs = tuple(name for name in registry.GRAPHS if name not in registry.PERF_GRAPHS + registry.FPM_GRAPHS)
+    multigraph = True
+
+    def lines(self, report):
+        # the value lines of one instance, only the age and health if the report could not be parsed
+        self.result = list()
+        if self.handle(report) is None:
+            return self.result
+        return list(self.extractor.values(None, self.plugin_values()))
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metrics(lines):
+    # yields (graph, field, value) of the value lines with a numeric value
+    graph = None
+    for line in lines:
+        if line.startswith('multigraph '):
+            graph = line[len('multigraph '):]
+            continue
+
+        field, sep, value = line.partition('.value ')
+        if not sep or graph is None:
+            continue
+        try:
+            yield graph, field, float(value)
+        except ValueError:
+            continue
+
+
+def render(samples_by_instance, duration):
+    # the exposition text of the value lines of every instance
+    fields = dict(((graph.name, field.name), field) for graph in registry.GRAPHS.values() for field in graph.fields)
+    families = dict()
+
+    for instance, (up, lines) in samples_by_instance.items():
+        families.setdefault('nextcloud_up', ('gauge', 'whether the serverinfo report could be fetched', []))[2].append(
+            (instance, 1 if up else 0))
+
+        for graph, name, value in metrics(lines):
+            field = fields.get((graph, name))
+            if field is None:
+                continue
+
+            counter = field.attributes.get('type') in ('DERIVE', 'COUNTER')
+            metric = '%s_%s%s' % (graph, name, '_total' if counter else '')
+            help_text = field.attributes.get('info') or field.attributes.get('label', name)
+            families.setdefault(metric, ('counter' if counter else 'gauge', help_text, []))[2].append(
+                (instance, value * field.scale))
+
+    out = list()
+    for metric, (kind, help_text, samples) in families.items():
+        out.append('# HELP %s %s' % (metric, help_text.replace('\\', '\\\\').replace('\n', '\\n')))
+        out.append('# TYPE %s %s' % (metric, kind))
+        for instance, value in samples:
+            out.append('%s{nextcloud_instance="%s"} %s' % (metric, escape(instance), repr(float(value))))
+
+    out.append('# HELP nextcloud_exporter_refresh_seconds time the last refresh of all instances took')
+    out.append('# TYPE nextcloud_exporter_refresh_seconds gauge')
+    out.append('nextcloud_exporter_refresh_seconds %r' % duration)
+    out.append('# HELP nextcloud_exporter_refresh_timestamp_seconds unix time of the last refresh')
+    out.append('# TYPE nextcloud_exporter_refresh_timestamp_seconds gauge')
+    out.append('nextcloud_exporter_refresh_timestamp_seconds %r' % time.time())
+
+    return '\n'.join(out) + '\n'
+
+
+class Exporter:
+    def __init__(self, instance_list, interval=DEFAULT_INTERVAL):
+        self.instances = instance_list
+        self.interval = interval
+        self.extraction = Extraction()
+
+        self.lock = threading.Lock()
+        self.body = b''
+        self.compressed = b''
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        started = time.monotonic()
+        reports = instances.fetch_all(self.instances, sections=self.extraction.sections, paths=self.extraction.paths)
+
+        samples = dict()
+        for instance in self.instances:
+            report = reports[instance.name]
+            samples[instance.name] = (report.status_code == 200, self.extraction.lines(report))
+
+        body = render(samples, time.monotonic() - started).encode('utf-8')
+        compressed = gzip.compress(body, 6)
+        with self.lock:
+            self.body, self.compressed = body, compressed
+
+    def current(self, compressed):
+        with self.lock:
+            return self.compressed if compressed else self.body
+
+    def refresh_loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                # keep serving the previous snapshot
+                print('refresh failed: %s' % e, file=sys.stderr)
+
+    def serve(self, host, port):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if urlsplit(self.path).path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                compressed = 'gzip' in self.headers.get('Accept-Encoding', '')
+                body = exporter.current(compressed)
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                if compressed:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.refresh()
+        threading.Thread(target=self.refresh_loop, daemon=True).start()
+
+        with ThreadingHTTPServer((host, port), Handler) as server:
+            try:
+                server.serve_forever()
+            finally:
+                self.stopped.set()
+
+
+def configured():
+    # the instances of env.instances, or the one of env.url named after its host
+    instance_list = instances.configured()
+    if instance_list or not os.environ.get('url'):
+        return instance_list
+
+    url = os.environ.get('url')
+    return [instances.Instance(urlsplit(url).hostname or 'nextcloud', url,
+                               os.environ.get('username'), os.environ.get('password'),
+                               float(os.environ.get('timeout', serverinfo.DEFAULT_TIMEOUT)))]
+
+
+def main():
+    instance_list = configured()
+    if not instance_list:
+        print('env variables url or instances are missing', file=sys.stderr)
+        sys.exit(1)
+
+    host, _, port = os.environ.get('exporter_listen', DEFAULT_LISTEN).rpartition(':')
+    exporter = Exporter(instance_list, interval=float(os.environ.get('exporter_interval', DEFAULT_INTERVAL)))
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        exporter.serve(host.strip('[]') or '0.0.0.0', int(port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
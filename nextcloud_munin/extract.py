@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+# Selective streaming extraction of key paths from a JSON document
+#
+# extract() reads the document chunk by chunk and only materialises the values
+# at the requested key paths, e.g. ('ocs', 'data', 'server', 'database', 'size').
+# Everything else is skipped with a regex scan of the structural characters
+# instead of being decoded, and reading stops as soon as every path was found.
+# The result is a pruned document of the same shape, so parse_data() can walk
+# it like the full response:
+#
+#   {'ocs': {'data': {'server': {'database': {'size': 987654321}}}}}
+#
+# Integers in a path index into arrays, arrays of the pruned document keep the
+# positions of their elements and hold None in place of everything skipped.
+import codecs
+import json
+import re
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+SCALAR = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?|true|false|null')
+# a scalar cut off at the end of a chunk would still match SCALAR, so require the delimiter as well
+DELIMITED_SCALAR = re.compile(r'(?:%s)(?=[ \t\n\r,\]}])' % SCALAR.pattern)
+# everything up to the next bracket outside of a string, or up to a string cut off at the end of a chunk.
+# Containers without nested containers (the bulk of most documents) are consumed by the regex as a whole.
+# The patterns are written as unrolled loops, nested quantifiers would backtrack exponentially.
+STRING_BODY = r'[^"\\]*(?:\\.[^"\\]*)*'
+FLAT = r'[^"{}\[\]]*(?:"%s"[^"{}\[\]]*)*' % STRING_BODY
+SKIPPABLE = re.compile(r'%s(?:(?:\{%s\}|\[%s\])%s)*' % (FLAT, FLAT, FLAT, FLAT))
+SKIP_WINDOW = 8192
+
+
+class Done(Exception):
+    # raised once every requested path was extracted
+    pass
+
+
+class Stream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.mark = None
+        self.eof = False
+        self.bytes_read = 0
+
+    def fill(self):
+        # append the next chunk, dropping everything consumed and not marked
+        if self.eof:
+            return False
+
+        try:
+            chunk = next(self.chunks)
+            self.bytes_read += len(chunk)
+            text = self.decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        except StopIteration:
+            self.eof = True
+            text = self.decoder.decode(b'', final=True)
+
+        keep = self.position if self.mark is None else self.mark
+        self.buffer = self.buffer[keep:] + text
+        self.position -= keep
+        if self.mark is not None:
+            self.mark -= keep
+
+        return True
+
+    def match(self, pattern):
+        # match at the current position, reading more while the match could still grow
+        while True:
+            m = pattern.match(self.buffer, self.position)
+            if m is not None and (m.end() < len(self.buffer) or self.eof):
+                return m
+            if not self.fill():
+                return m
+
+    def peek(self):
+        self.position = self.match(WHITESPACE).end()
+        while self.position >= len(self.buffer):
+            if not self.fill():
+                raise ValueError('unexpected end of document')
+            self.position = self.match(WHITESPACE).end()
+
+        return self.buffer[self.position]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expected %r at position %d' % (char, self.position))
+        self.position += 1
+
+    def string(self):
+        self.peek()
+        m = self.match(STRING)
+        if m is None:
+            raise ValueError('invalid string at position %d' % self.position)
+        self.position = m.end()
+        return json.loads(m.group())
+
+    def skip(self):
+        # skip one value without decoding it
+        char = self.peek()
+        if char == '"':
+            self.string()
+            return
+
+        if char not in '{[':
+            m = self.match(DELIMITED_SCALAR)
+            if m is None and self.eof:
+                m = SCALAR.match(self.buffer, self.position)
+            if m is None:
+                raise ValueError('invalid value at position %d' % self.position)
+            self.position = m.end()
+            return
+
+        # step into the container first, SKIPPABLE would otherwise swallow a flat one as a whole
+        self.position += 1
+        depth = 1
+        while True:
+            # the window bounds the backtracking state the regex engine keeps for a match
+            end = min(len(self.buffer), self.position + SKIP_WINDOW)
+            self.position = SKIPPABLE.match(self.buffer, self.position, end).end()
+            if self.position >= len(self.buffer):
+                if not self.fill():
+                    raise ValueError('unexpected end of document')
+                continue
+
+            char = self.buffer[self.position]
+            if char == '"':
+                # a string crossing the window or the end of the chunk
+                self.string()
+            elif char in '{[':
+                depth += 1
+                self.position += 1
+            elif char in '}]':
+                depth -= 1
+                self.position += 1
+                if depth == 0:
+                    return
+
+    def value(self):
+        # decode one value, containers are decoded in one go by the json module
+        self.peek()
+        self.mark = self.position
+        try:
+            self.skip()
+            return json.loads(self.buffer[self.mark:self.position])
+        finally:
+            self.mark = None
+
+
+class Extractor:
+    def __init__(self, paths):
+        paths = set(tuple(path) for path in paths)
+
+        # a path below another requested path is already part of that value
+        self.paths = set(path for path in paths if not any(path[:i] in paths for i in range(1, len(path))))
+        self.prefixes = set(path[:i] for path in self.paths for i in range(len(path)))
+        self.result = dict()
+        self.missing = len(self.paths)
+
+    def store(self, path, value):
+        node = self.result
+        for key, next_key in zip(path[:-1], path[1:]):
+            node = child(node, key, list() if isinstance(next_key, int) else dict())
+        child(node, path[-1], value)
+
+        self.missing -= 1
+        if self.missing == 0:
+            raise Done()
+
+    def walk(self, stream, path):
+        if path in self.paths:
+            self.store(path, stream.value())
+        elif path in self.prefixes and stream.peek() == '{':
+            self.walk_object(stream, path)
+        elif path in self.prefixes and stream.peek() == '[':
+            self.walk_array(stream, path)
+        else:
+            stream.skip()
+
+    def walk_object(self, stream, path):
+        stream.expect('{')
+        if stream.peek() == '}':
+            stream.position += 1
+            return
+
+        while True:
+            key = stream.string()
+            stream.expect(':')
+            self.walk(stream, path + (key,))
+
+            if stream.peek() == '}':
+                stream.position += 1
+                return
+            stream.expect(',')
+
+    def walk_array(self, stream, path):
+        stream.expect('[')
+        if stream.peek() == ']':
+            stream.position += 1
+            return
+
+        index = 0
+        while True:
+            self.walk(stream, path + (index,))
+
+            if stream.peek() == ']':
+                stream.position += 1
+                return
+            stream.expect(',')
+            index += 1
+
+
+def child(node, key, default):
+    # the child of an object or array, set to default if it does not exist yet
+    if isinstance(node, list):
+        node.extend([None] * (key + 1 - len(node)))
+        if node[key] is None:
+            node[key] = default
+        return node[key]
+    return node.setdefault(key, default)
+
+
+def extract(chunks, paths):
+    # returns (pruned document, number of bytes read) of the document read from the chunks
+    extractor = Extractor(paths)
+    stream = Stream(chunks)
+
+    if extractor.paths:
+        try:
+            extractor.walk(stream, ())
+        except Done:
+            pass
+
+    return extractor.result, stream.bytes_read
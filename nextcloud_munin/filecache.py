@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+# Bytes and files per storage and per mimetype from the oc_filecache table
+#
+# Grouping the whole filecache by storage and mimetype reads every row, which
+# takes far longer than a munin run on instances with hundreds of millions of
+# files. The scanner therefore splits the fileid space into ranges of
+# env.filecache_range ids and keeps the per (storage, mimetype) aggregate of
+# every range in the plugin state directory. A run only aggregates again the
+# ranges which changed since the previous one, each with a primary key range
+# scan:
+#
+#   * ranges above the fileid watermark, which hold the new rows
+#   * ranges holding rows whose mtime (indexed) lies after the mtime watermark,
+#     read in pages ordered by mtime and fileid, a pass cut short by the budget
+#     continues after the last row read in the next run
+#   * ranges not aggregated for env.filecache_verify seconds, oldest first,
+#     which catches deleted rows and changes that kept an old mtime
+#
+# The work stops after env.filecache_budget seconds, the ranges left over are
+# remembered and go first in the next run. Directories are not counted, their
+# size is the one of their content. The database connection is configured as
+# for the database backend, see nextcloud_munin/database.py.
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+from nextcloud_munin.cache import cache_key, state_dir
+from nextcloud_munin.database import Database, settings, source
+
+DEFAULT_RANGE = 100000
+DEFAULT_BUDGET = 5
+DEFAULT_VERIFY = 86400
+DEFAULT_TOP = 10
+DIRECTORY = 'httpd/unix-directory'
+
+# seconds the mtime watermark is moved back to allow for writes racing the run
+MTIME_SLACK = 60
+# rows read per query of the mtime pass
+MTIME_PAGE = 10000
+
+# positions in the aggregate rows of a range
+STORAGE, MIMETYPE, FILES, BYTES = range(4)
+
+
+def empty_state(size):
+    return {'fileid': 0, 'mtime': 0, 'size': size, 'built': False, 'ranges': {}, 'dirty': [],
+            'storages': {}, 'mimetypes': {}}
+
+
+class FilecacheState:
+    def __init__(self, url, directory=None):
+        self.path = os.path.join(directory or state_dir(), 'nextcloud_filecache_%s.json' % cache_key(url))
+
+    def load(self, size=None):
+        # a state aggregated with another range size is started over
+        size = size or int(os.environ.get('filecache_range', DEFAULT_RANGE))
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return empty_state(size)
+        if not isinstance(state, dict) or state.get('size') != size:
+            return empty_state(size)
+        return state
+
+    @contextlib.contextmanager
+    def lock(self):
+        # one scanning run at a time, the others report the state as it is
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
+
+    def store(self, state):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.nextcloud_filecache_')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+
+def range_index(fileid, size):
+    # range i holds the fileids i * size + 1 to (i + 1) * size
+    return (fileid - 1) // size
+
+
+def aggregate(database, index, size, directory):
+    # the [storage, mimetype, files, bytes] rows of one range, a primary key range scan
+    rows = database.rows(
+        'SELECT storage, mimetype, COUNT(*), COALESCE(SUM(CASE WHEN size > 0 THEN size ELSE 0 END), 0) '
+        'FROM {p}filecache WHERE fileid > %s AND fileid <= %s AND mimetype <> %s GROUP BY storage, mimetype',
+        (index * size, (index + 1) * size, directory))
+    return [[int(column) for column in row] for row in rows]
+
+
+def changed(database, state, deadline):
+    # the ranges holding rows changed since the mtime watermark, the (mtime, fileid) after which the pass continues
+    # is kept in state['cursor'] while it did not get through all rows within the budget
+    size = state['size']
+    mtime, fileid = state.get('cursor') or (state['mtime'] - MTIME_SLACK, state['fileid'])
+    result = set()
+    while True:
+        rows = database.rows(
+            'SELECT mtime, fileid FROM {p}filecache WHERE mtime >= %s AND fileid <= %s AND (mtime > %s OR fileid > %s) '
+            'ORDER BY mtime, fileid LIMIT %s', (mtime, state['fileid'], mtime, fileid, MTIME_PAGE))
+        for _, row_fileid in rows:
+            result.add(range_index(int(row_fileid), size))
+        if len(rows) < MTIME_PAGE:
+            state.pop('cursor', None)
+            return result
+        mtime, fileid = int(rows[-1][0]), int(rows[-1][1])
+        state['cursor'] = [mtime, fileid]
+        if time.monotonic() >= deadline:
+            return result
+
+
+def scan(database, state, now, budget=None):
+    # bring the range aggregates of state up to date within the budget, returns the number of ranges aggregated
+    budget = float(budget or os.environ.get('filecache_budget', DEFAULT_BUDGET))
+    verify = float(os.environ.get('filecache_verify', DEFAULT_VERIFY))
+    deadline = time.monotonic() + budget
+    size = state['size']
+
+    row = database.query('SELECT id FROM {p}mimetypes WHERE mimetype = %s', (DIRECTORY,))
+    directory = int(row[0]) if row else -1
+    top = int(database.query('SELECT COALESCE(MAX(fileid), 0) FROM {p}filecache')[0])
+
+    dirty = set(state['dirty'])
+    if top > state['fileid']:
+        dirty.update(range(state['fileid'] // size, range_index(top, size) + 1))
+    if state['fileid']:
+        dirty.update(changed(database, state, deadline))
+    # ranges above the highest fileid lost all their rows
+    for key in [key for key in state['ranges'] if int(key) > range_index(top, size)]:
+        del state['ranges'][key]
+    dirty = set(index for index in dirty if index <= range_index(top, size))
+
+    outdated = sorted((entry['time'], int(key)) for key, entry in state['ranges'].items()
+                      if entry['time'] < now - verify and int(key) not in dirty)
+    scanned = 0
+    for index in sorted(dirty) + [index for _, index in outdated]:
+        if time.monotonic() >= deadline:
+            break
+        groups = aggregate(database, index, size, directory)
+        if groups:
+            state['ranges'][str(index)] = {'time': now, 'groups': groups}
+        else:
+            state['ranges'].pop(str(index), None)
+        dirty.discard(index)
+        scanned += 1
+
+    state['dirty'] = sorted(dirty)
+    state['fileid'] = top
+    if 'cursor' not in state:
+        state['mtime'] = int(now)
+    state['built'] = state['built'] or not dirty
+    names(database, state)
+    return scanned
+
+
+def totals(state, position):
+    # storage or mimetype id to [files, bytes] over all ranges
+    result = dict()
+    for entry in state['ranges'].values():
+        for group in entry['groups']:
+            total = result.setdefault(group[position], [0, 0])
+            total[0] += group[FILES]
+            total[1] += group[BYTES]
+    return result
+
+
+def top(state, position, size=None):
+    # the (id, files, bytes) of the storages or mimetypes with the most bytes
+    size = size or int(os.environ.get('filecache_top', DEFAULT_TOP))
+    ranked = sorted(totals(state, position).items(), key=lambda item: (-item[1][1], -item[1][0], item[0]))
+    return [(key, files, total) for key, (files, total) in ranked[:size]]
+
+
+def names(database, state):
+    # the names of the mimetypes and of the storages drawn, so config needs no database
+    state['mimetypes'] = dict((str(mimetype_id), name) for mimetype_id, name in
+                              database.rows('SELECT id, mimetype FROM {p}mimetypes'))
+    storages = [storage for storage, _, _ in top(state, STORAGE)]
+    state['storages'] = dict()
+    if storages:
+        state['storages'] = dict((str(numeric_id), name) for numeric_id, name in database.rows(
+            'SELECT numeric_id, id FROM {p}storages WHERE numeric_id IN (%s)' % ', '.join(['%s'] * len(storages)),
+            tuple(storages)))
+
+
+def refresh(now):
+    # (state, ranges aggregated in this run), a run finding another one scanning reports the state as it is
+    config = settings()
+    files = FilecacheState(source(config))
+    with files.lock() as locked:
+        state = files.load()
+        if not locked:
+            return state, 0
+
+        database = Database(config)
+        try:
+            scanned = scan(database, state, now)
+        finally:
+            database.close()
+        files.store(state)
+        return state, scanned
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# Growth rates and capacity exhaustion forecasts from the local history
+#
+# For the database size, the file count and the number of users the slope of a
+# line fitted through the history of the last day and week gives the growth per
+# day. Extrapolating a fit over the last env.forecast_window seconds (default a
+# week) tells when a configured limit (env.db_size_limit, env.num_files_limit,
+# env.num_users_limit, or <instance>_... per instance) will be crossed.
+#
+# The fit is a Theil-Sen estimator, the median of the slopes between all pairs
+# of samples, which shrugs off single outliers like a cleanup or a restored
+# backup. It runs on at most MAX_POINTS evenly spaced samples, so the cost per
+# fetch is bounded however long the history gets. env.forecast_method ols
+# switches to an ordinary least squares fit.
+import os
+import statistics
+import time
+
+from nextcloud_munin import registry
+from nextcloud_munin.history import History
+
+DAY = 86400
+WEEK = 7 * DAY
+DEFAULT_FORECAST_WINDOW = WEEK
+MAX_POINTS = 64
+
+# the fit needs at least this many samples spanning at least this many seconds
+MIN_POINTS = 3
+MIN_SPAN = 3600
+
+# metric name, the graph and field it is recorded under
+METRICS = (
+    ('db_size', 'nextcloud_dbsize', 'db_size'),
+    ('num_files', 'nextcloud_filecount', 'num_files'),
+    ('num_users', 'nextcloud_users', 'num_users'),
+)
+
+UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4, 'p': 1024 ** 5}
+
+
+def parse_limit(value):
+    # a plain number or one with a k, m, g, t or p suffix, e.g. 500g
+    value = value.strip().lower().rstrip('b')
+    if value and value[-1] in UNITS:
+        return float(value[:-1]) * UNITS[value[-1]]
+    return float(value)
+
+
+def limit(metric, instance=None):
+    value = None
+    if instance:
+        value = os.environ.get('%s_%s_limit' % (instance, metric))
+    value = value or os.environ.get('%s_limit' % metric)
+    return parse_limit(value) if value else None
+
+
+def ols(points):
+    # least squares line through the points, returns (slope, intercept)
+    n = len(points)
+    mean_t = sum(t for t, _ in points) / n
+    mean_v = sum(v for _, v in points) / n
+    variance = sum((t - mean_t) ** 2 for t, _ in points)
+    if not variance:
+        return 0.0, mean_v
+    slope = sum((t - mean_t) * (v - mean_v) for t, v in points) / variance
+    return slope, mean_v - slope * mean_t
+
+
+def theil_sen(points):
+    # median of the pairwise slopes, returns (slope, intercept)
+    slopes = [(v2 - v1) / (t2 - t1) for i, (t1, v1) in enumerate(points) for t2, v2 in points[i + 1:] if t2 != t1]
+    if not slopes:
+        return 0.0, statistics.median(v for _, v in points)
+    slope = statistics.median(slopes)
+    return slope, statistics.median(v - slope * t for t, v in points)
+
+
+def thinned(points, size=MAX_POINTS):
+    # at most size points evenly spaced over the series, always including the newest one
+    if len(points) <= size:
+        return points
+    step = (len(points) - 1) / (size - 1)
+    return [points[int(round(i * step))] for i in range(size)]
+
+
+def fit(points, method=None):
+    # (slope, intercept) of the points or None if there are too few of them
+    if len(points) < MIN_POINTS or points[-1][0] - points[0][0] < MIN_SPAN:
+        return None
+    method = method or os.environ.get('forecast_method', 'theil-sen')
+    # fit relative to the newest sample, absolute epoch seconds cost precision in the products
+    origin = points[-1][0]
+    relative = [(t - origin, v) for t, v in thinned(points)]
+    slope, intercept = ols(relative) if method == 'ols' else theil_sen(relative)
+    return slope, intercept - slope * origin
+
+
+def values(data, timestamp, instance=None, directory=None):
+    # the growth and forecast fields of the multigraph plugin for the report data fetched at timestamp
+    now = time.time()
+    window = float(os.environ.get('forecast_window', DEFAULT_FORECAST_WINDOW))
+    result = dict()
+
+    for metric, graph, field in METRICS:
+        name = '%s.%s' % (graph, instance) if instance else graph
+        points = History(name, directory=directory).series(field, start=now - max(window, WEEK))
+
+        # the current report is only recorded after the values are parsed
+        current = registry.lookup(data, registry.field(graph, field).path)
+        if current is not None and (not points or timestamp > points[-1][0]):
+            points.append((timestamp, float(current)))
+
+        # fits by the span they cover, the forecast window is a week as well by default
+        fits = dict()
+        for span in (DAY, WEEK, window):
+            if span not in fits:
+                fits[span] = fit([point for point in points if point[0] >= now - span])
+
+        for suffix, span in (('day', DAY), ('week', WEEK)):
+            if fits[span] is not None:
+                result['%s_%s' % (metric, suffix)] = '%.2f' % (fits[span][0] * DAY)
+
+        maximum = limit(metric, instance)
+        line = fits[window]
+        if maximum is None or line is None:
+            continue
+
+        slope, intercept = line
+        remaining = maximum - (slope * now + intercept)
+        if remaining <= 0:
+            result['%s_days' % metric] = '0'
+        elif slope > 0:
+            result['%s_days' % metric] = '%.1f' % (remaining / slope / DAY)
+
+    return result
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# Pool status of the PHP-FPM serving nextcloud
+#
+# A slow serverinfo endpoint usually means a saturated PHP-FPM pool. The
+# status page of the pool (pm.status_path) tells how many processes are busy
+# and idle, how many requests wait in the listen queue and how often the pool
+# ran into pm.max_children or logged a slow request. env.fpm_status names
+# where it is asked:
+#
+#   https://cloud.example.com/fpm-status   through the web server
+#   unix:/run/php/php-fpm.sock             FastCGI on a unix socket
+#   tcp:127.0.0.1:9000 or 127.0.0.1:9000   FastCGI on a tcp socket
+#
+# Over FastCGI the web server is not involved, env.fpm_status_path (default
+# /status) is the pm.status_path of the pool. The status is requested in a
+# thread of its own, so the multigraph plugin asks it while it waits for
+# serverinfo.
+import json
+import os
+import socket
+import struct
+import threading
+
+from nextcloud_munin.serverinfo import DEFAULT_TIMEOUT, debug
+
+DEFAULT_STATUS_PATH = '/status'
+
+# FastCGI record types and the responder role, see the FastCGI specification
+FCGI_VERSION = 1
+FCGI_BEGIN_REQUEST = 1
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_RESPONDER = 1
+HEADER = struct.Struct('>BBHHBx')
+
+# field names of the graphs to the keys of the json status
+KEYS = (
+    ('active', 'active processes'),
+    ('idle', 'idle processes'),
+    ('listen_queue', 'listen queue'),
+    ('listen_queue_len', 'listen queue len'),
+    ('max_children_reached', 'max children reached'),
+    ('slow_requests', 'slow requests'),
+)
+
+
+def enabled():
+    return bool(os.environ.get('fpm_status'))
+
+
+def record(kind, content=b''):
+    return HEADER.pack(FCGI_VERSION, kind, 1, len(content), 0) + content
+
+
+def name_value(name, value):
+    # lengths below 128 take one byte, longer ones four with the high bit set
+    name, value = name.encode('utf-8'), value.encode('utf-8')
+    lengths = b''.join(struct.pack('>B', len(part)) if len(part) < 128 else struct.pack('>I', len(part) | 0x80000000)
+                       for part in (name, value))
+    return lengths + name + value
+
+
+def read_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('php-fpm closed the connection')
+        data += chunk
+    return data
+
+
+def fastcgi(address, path, timeout):
+    # the body of a GET of path?json from the FastCGI socket address (unix:... or tcp:host:port)
+    if address.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        target = address[len('unix:'):]
+    else:
+        host, _, port = address.split('tcp:', 1)[-1].rpartition(':')
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        target = (host.strip('[]'), int(port))
+
+    params = b''.join(name_value(name, value) for name, value in (
+        ('GATEWAY_INTERFACE', 'CGI/1.1'),
+        ('REQUEST_METHOD', 'GET'),
+        ('SCRIPT_NAME', path),
+        ('SCRIPT_FILENAME', path),
+        ('REQUEST_URI', path + '?json'),
+        ('QUERY_STRING', 'json'),
+        ('SERVER_PROTOCOL', 'HTTP/1.1'),
+    ))
+
+    sock.settimeout(timeout)
+    try:
+        sock.connect(target)
+        sock.sendall(record(FCGI_BEGIN_REQUEST, struct.pack('>HB5x', FCGI_RESPONDER, 0)) +
+                     record(FCGI_PARAMS, params) + record(FCGI_PARAMS) + record(FCGI_STDIN))
+
+        output = b''
+        while True:
+            _, kind, _, length, padding = HEADER.unpack(read_exactly(sock, HEADER.size))
+            content = read_exactly(sock, length + padding)[:length]
+            if kind == FCGI_STDOUT:
+                output += content
+            elif kind == FCGI_END_REQUEST:
+                break
+    finally:
+        sock.close()
+
+    # a cgi response, the headers end with an empty line
+    headers, _, body = output.partition(b'\r\n\r\n')
+    for line in headers.split(b'\r\n'):
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'status' and not value.strip().startswith(b'200'):
+            raise ValueError('php-fpm status page answered %s' % value.strip().decode('ascii', 'replace'))
+    return body
+
+
+def http(url, timeout):
+    import requests
+
+    r = requests.get(url, params='json', timeout=timeout)
+    r.raise_for_status()
+    return r.content
+
+
+def fetch(address=None, timeout=None):
+    # the values of the graph fields from the pool status
+    address = address or os.environ['fpm_status']
+    if timeout is None:
+        timeout = float(os.environ.get('timeout', DEFAULT_TIMEOUT))
+
+    if address.startswith(('http://', 'https://')):
+        body = http(address, timeout)
+    else:
+        body = fastcgi(address, os.environ.get('fpm_status_path', DEFAULT_STATUS_PATH), timeout)
+
+    status = json.loads(body)
+    return dict((field, int(status[key])) for field, key in KEYS if key in status)
+
+
+class StatusRequest:
+    # asks the pool status in a thread while the caller waits for something else
+    def __init__(self, address=None, timeout=None):
+        if timeout is None:
+            timeout = float(os.environ.get('timeout', DEFAULT_TIMEOUT))
+        self.timeout = timeout
+        self.outcome = dict()
+        self.thread = threading.Thread(target=self.get, args=(address,), daemon=True)
+        self.thread.start()
+
+    def get(self, address):
+        try:
+            self.outcome['values'] = fetch(address, self.timeout)
+        except Exception as e:
+            debug('php-fpm status not available: %s' % e)
+
+    def values(self):
+        # the values, None if the status could not be read in time
+        self.thread.join(self.timeout)
+        return self.outcome.get('values')
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+# Fixed-size on-disk history of the values of a graph
+#
+# Every graph gets a ring buffer file in the plugin state directory holding the
+# last env.history_capacity samples of all its fields:
+#
+#   header   magic, capacity, number of fields, samples appended, names length
+#   names    the field names, newline separated, padded to 8 bytes
+#   records  capacity x (timestamp, value of every field) as little endian doubles
+#
+# Appending writes one record and the header in place, reading maps the file
+# and bisects the timestamps. Missing values are stored as NaN. Writers hold
+# an exclusive and readers a shared lock on the file, so concurrent plugin
+# processes never see a half written record.
+import array
+import contextlib
+import fcntl
+import math
+import mmap
+import os
+import struct
+import sys
+from collections import OrderedDict
+
+from nextcloud_munin.cache import state_dir
+
+MAGIC = b'NCHIST01'
+HEADER = struct.Struct('<8sIIQII')
+DEFAULT_CAPACITY = 2016  # a week of samples every 5 minutes
+
+
+def enabled():
+    return os.environ.get('history') == '1'
+
+
+def path(name, directory=None):
+    return os.path.join(directory or state_dir(), 'nextcloud_history_%s' % name)
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class History:
+    def __init__(self, name, fields=None, capacity=None, directory=None):
+        # without fields the history is opened read-only with the fields it was created with
+        if capacity is None:
+            capacity = int(os.environ.get('history_capacity', DEFAULT_CAPACITY))
+
+        self.name = name
+        self.path = path(name, directory)
+        self.fields = tuple(fields) if fields is not None else None
+        self.capacity = capacity
+
+    @contextlib.contextmanager
+    def open(self, exclusive):
+        flags = os.O_RDWR | os.O_CREAT if exclusive else os.O_RDONLY
+        fd = os.open(self.path, flags, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield fd
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def header(fd):
+        # returns (capacity, fields, appended, offset of the first record) or None for an empty or foreign file
+        raw = os.pread(fd, HEADER.size, 0)
+        if len(raw) < HEADER.size:
+            return None
+
+        magic, capacity, num_fields, appended, names_length, _ = HEADER.unpack(raw)
+        if magic != MAGIC:
+            return None
+
+        names = os.pread(fd, names_length, HEADER.size).decode('utf-8')
+        fields = tuple(names.split('\n')) if names else ()
+        if len(fields) != num_fields:
+            return None
+
+        return capacity, fields, appended, HEADER.size + padded(names_length)
+
+    def create(self, fd):
+        names = '\n'.join(self.fields).encode('utf-8')
+        offset = HEADER.size + padded(len(names))
+
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, offset + self.capacity * (len(self.fields) + 1) * 8)
+        os.pwrite(fd, HEADER.pack(MAGIC, self.capacity, len(self.fields), 0, len(names), 0), 0)
+        os.pwrite(fd, names, HEADER.size)
+
+        return self.capacity, self.fields, 0, offset
+
+    def append(self, timestamp, values):
+        # values are in the order of the fields, returns False if the sample is not newer than the last one
+        if self.fields is None:
+            raise ValueError('history %s was opened without fields' % self.name)
+
+        record_size = (len(self.fields) + 1) * 8
+        with self.open(True) as fd:
+            header = self.header(fd)
+            if header is None or header[0] != self.capacity or header[1] != self.fields:
+                # new, or the graph or capacity changed, the old samples do not fit any more
+                header = self.create(fd)
+
+            capacity, fields, appended, offset = header
+            if appended:
+                last = struct.unpack('<d', os.pread(fd, 8, offset + (appended - 1) % capacity * record_size))[0]
+                if timestamp <= last:
+                    return False
+
+            record = array.array('d', [timestamp] + [number(value) for value in values])
+            if sys.byteorder != 'little':
+                record.byteswap()
+
+            # the record first, a crash in between leaves the header pointing at the previous one
+            os.pwrite(fd, record.tobytes(), offset + appended % capacity * record_size)
+            os.pwrite(fd, struct.pack('<Q', appended + 1), 16)
+
+        return True
+
+    def range(self, start=None, end=None):
+        # returns the fields and a list of (timestamp, values) of all samples with start <= timestamp <= end
+        try:
+            with self.open(False) as fd:
+                return self.read(fd, start, end)
+        except FileNotFoundError:
+            return self.fields or (), list()
+
+    def read(self, fd, start, end):
+        header = self.header(fd)
+        if header is None or not header[2]:
+            return header[1] if header else self.fields or (), list()
+
+        capacity, fields, appended, offset = header
+        width = len(fields) + 1
+        first = appended - min(appended, capacity)
+
+        records = array.array('d')
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+            def timestamp(index):
+                return struct.unpack_from('<d', mapped, offset + index % capacity * width * 8)[0]
+
+            low = first if start is None else bisect(timestamp, first, appended, start)
+            high = appended if end is None else bisect(timestamp, low, appended, end, right=True)
+
+            # only the requested records are copied, in one piece unless they wrap around the end of the file
+            for begin, stop in segments(low, high, capacity):
+                records.frombytes(mapped[offset + begin * width * 8:offset + stop * width * 8])
+
+        if sys.byteorder != 'little':
+            records.byteswap()
+
+        samples = list()
+        for position in range(0, len(records), width):
+            samples.append((records[position], tuple(records[position + 1:position + width])))
+
+        return fields, samples
+
+    def series(self, field, start=None, end=None):
+        # list of (timestamp, value) of one field, without the samples missing it
+        fields, samples = self.range(start, end)
+        if field not in fields:
+            return list()
+
+        column = fields.index(field)
+        return [(timestamp, values[column]) for timestamp, values in samples if not math.isnan(values[column])]
+
+
+def padded(length):
+    return (length + 7) // 8 * 8
+
+
+def segments(low, high, capacity):
+    # the file positions of the logical indices [low, high) as one or two (begin, end) ranges
+    if low >= high:
+        return []
+    if low // capacity == (high - 1) // capacity:
+        return [(low % capacity, (high - 1) % capacity + 1)]
+    return [(low % capacity, capacity), (0, (high - 1) % capacity + 1)]
+
+
+def bisect(key, low, high, value, right=False):
+    # first logical index in [low, high) whose timestamp is >= value (> value with right)
+    while low < high:
+        middle = (low + high) // 2
+        if key(middle) < value or (right and key(middle) == value):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def record(lines, timestamp, graph=None, suffix=None, fields=None, directory=None):
+    # append the value lines of a plugin run to the history of every graph they belong to,
+    # graph names the graph of plugins without multigraph lines, suffix e.g. the instance name
+    # and fields maps graph names to the fields they always have
+    values = OrderedDict()
+    for line in lines:
+        if line.startswith('multigraph '):
+            graph = line[len('multigraph '):]
+            continue
+
+        field, sep, value = line.partition('.value ')
+        if sep and graph is not None:
+            values.setdefault(graph, OrderedDict())[field] = value
+
+    for name, graph_values in values.items():
+        names = (fields or dict()).get(name.partition('.')[0]) or tuple(graph_values)
+        History('%s.%s' % (name, suffix) if suffix else name, names, directory=directory).append(
+            timestamp, [graph_values.get(field) for field in names])
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Multi-instance support for the multigraph plugin
+#
+# env.instances lists the instance names, url and credentials of every
+# instance are read from env.<name>_url, env.<name>_username and
+# env.<name>_password. All instances are fetched concurrently, bounded by
+# env.max_workers overall and env.max_per_host per host, and every instance is
+# given up after env.instance_timeout (or env.<name>_timeout) seconds.
+# The graphs are emitted as nested multigraphs: the cluster-wide aggregate in
+# the parent graph and one child graph per instance.
+import concurrent.futures
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from nextcloud_munin import serverinfo
+from nextcloud_munin.cache import cache_key
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_PER_HOST = 2
+DEFAULT_TIMEOUT = 30
+
+
+def clean_name(name):
+    # munin graph and field names may only contain letters, digits and underscores
+    return re.sub(r'[^A-Za-z0-9_]', '_', name)
+
+
+def field_name(prefix, value):
+    # a field for an arbitrary value, e.g. a user id, which gets a hash if cleaning changed it to stay unique
+    name = clean_name(value)
+    return '%s_%s' % (prefix, name) if name == value else '%s_%s_%s' % (prefix, name, cache_key(value)[:8])
+
+
+class Instance:
+    def __init__(self, name, url, username, password, timeout=DEFAULT_TIMEOUT):
+        self.name = clean_name(name)
+        self.url = url
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+
+    @property
+    def host(self):
+        return urlsplit(self.url or '').hostname
+
+
+def configured():
+    instances = list()
+    default_timeout = float(os.environ.get('instance_timeout', DEFAULT_TIMEOUT))
+
+    for name in os.environ.get('instances', '').split():
+        if not os.environ.get('%s_url' % name):
+            serverinfo.debug('instance %s has no url configured' % name)
+            continue
+
+        instances.append(Instance(name,
+                                  os.environ.get('%s_url' % name),
+                                  os.environ.get('%s_username' % name),
+                                  os.environ.get('%s_password' % name),
+                                  float(os.environ.get('%s_timeout' % name, default_timeout))))
+
+    return instances
+
+
+def fetch_all(instances, max_workers=None, max_per_host=None, sections=serverinfo.ALL_SECTIONS, paths=None):
+    # returns a dict of instance name to its serverinfo.Report, status_code is None on failure
+    if max_workers is None:
+        max_workers = int(os.environ.get('max_workers', DEFAULT_MAX_WORKERS))
+    if max_per_host is None:
+        max_per_host = int(os.environ.get('max_per_host', DEFAULT_MAX_PER_HOST))
+
+    host_limits = {instance.host: threading.BoundedSemaphore(max_per_host) for instance in instances}
+    started = dict()
+
+    def fetch(instance):
+        with host_limits[instance.host]:
+            # the deadline of an instance starts once it is allowed to talk to its host
+            started[instance.name] = time.monotonic()
+            return serverinfo.fetch(instance.url, instance.username, instance.password,
+                                    timeout=instance.timeout, sections=sections, paths=paths)
+
+    results = {instance.name: serverinfo.Report(None, None, None, False) for instance in instances}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(instances))))
+    pending = {executor.submit(fetch, instance): instance for instance in instances}
+
+    try:
+        while pending:
+            now = time.monotonic()
+            deadlines = dict()
+            for future, instance in pending.items():
+                deadlines[future] = started.get(instance.name, now) + instance.timeout
+
+            # give up on every instance which ran past its own deadline
+            for future in [f for f, deadline in deadlines.items() if deadline <= now]:
+                serverinfo.debug('instance %s missed its deadline' % pending.pop(future).name)
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(pending, timeout=min(deadlines.values()) - now,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                instance = pending.pop(future)
+                try:
+                    results[instance.name] = future.result()
+                except Exception as e:
+                    serverinfo.debug('instance %s failed: %s' % (instance.name, e))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return results
+
+
+def split_graphs(lines):
+    # split multigraph output into an ordered dict of graph name to its lines
+    graphs = OrderedDict()
+    lines_of_graph = None
+
+    for line in lines:
+        if line.startswith('multigraph '):
+            lines_of_graph = graphs.setdefault(line.split(' ', 1)[1], list())
+        elif lines_of_graph is not None:
+            lines_of_graph.append(line)
+
+    return graphs
+
+
+def nest_config(config, instances):
+    nested = list()
+
+    for graph, lines in split_graphs(config).items():
+        nested.append('multigraph %s' % graph)
+        for line in lines:
+            if line.startswith('graph_title '):
+                line = '%s (all instances)' % line
+            nested.append(line)
+
+        for instance in instances:
+            nested.append('multigraph %s.%s' % (graph, instance.name))
+            for line in lines:
+                if line.startswith('graph_title '):
+                    line = '%s - %s' % (line, instance.name)
+                nested.append(line)
+
+    return nested
+
+
+def nest_results(results_by_instance, aggregates=None):
+    # results_by_instance is an ordered dict of instance name to its multigraph value lines,
+    # aggregates maps field names to the function combining their values, sum by default
+    aggregates = aggregates or dict()
+    values_by_field = OrderedDict()
+    children = OrderedDict()
+
+    for name, lines in results_by_instance.items():
+        for graph, values in split_graphs(lines).items():
+            graph_values = values_by_field.setdefault(graph, OrderedDict())
+            children.setdefault(graph, list()).append('multigraph %s.%s' % (graph, name))
+
+            for line in values:
+                children[graph].append(line)
+                field, sep, value = line.partition('.value ')
+                if not sep:
+                    continue
+                try:
+                    graph_values.setdefault(field, list()).append(float(value))
+                except ValueError:
+                    continue
+
+    nested = list()
+    for graph, graph_values in values_by_field.items():
+        nested.append('multigraph %s' % graph)
+        for field, values in graph_values.items():
+            value = float(aggregates.get(field, sum)(values))
+            nested.append('{k}.value {v}'.format(k=field, v=int(value) if value.is_integer() else value))
+        nested.extend(children[graph])
+
+    return nested
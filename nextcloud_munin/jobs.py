@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# State of the background job queue from the oc_jobs table
+#
+# Three aggregate queries over the job table and the app config answer
+# everything the jobs plugin draws: the number of queued jobs, the reserved
+# ones (picked up by a cron run and not finished yet), the stuck ones
+# (reserved for more than env.jobs_stuck_after seconds), the jobs which never
+# ran, the number of jobs and the age of the oldest last run per job class and
+# the seconds since the last cron run. The database connection is configured
+# as for the database backend, see nextcloud_munin/database.py.
+import os
+
+from nextcloud_munin.database import Database, settings
+
+DEFAULT_STUCK_AFTER = 3600
+DEFAULT_TOP = 10
+
+
+class JobQueue:
+    def __init__(self, queued, reserved, stuck, never_run, classes, last_cron):
+        self.queued = queued
+        self.reserved = reserved
+        self.stuck = stuck
+        self.never_run = never_run
+
+        # class name to (number of jobs, unix time of the oldest last run or None if none ran yet)
+        self.classes = classes
+        self.last_cron = last_cron
+
+    def largest(self, size=None):
+        # the classes with the most jobs
+        size = size or int(os.environ.get('jobs_top', DEFAULT_TOP))
+        return sorted(self.classes, key=lambda name: (-self.classes[name][0], name))[:size]
+
+    def most_behind(self, size=None):
+        # the classes whose oldest last run lies back the longest
+        size = size or int(os.environ.get('jobs_top', DEFAULT_TOP))
+        ran = [name for name in self.classes if self.classes[name][1] is not None]
+        return sorted(ran, key=lambda name: (self.classes[name][1], name))[:size]
+
+
+def query(database, now):
+    stuck_after = float(os.environ.get('jobs_stuck_after', DEFAULT_STUCK_AFTER))
+    queued, reserved, stuck, never_run = database.query(
+        'SELECT COUNT(*), '
+        'COALESCE(SUM(CASE WHEN reserved_at > 0 THEN 1 ELSE 0 END), 0), '
+        'COALESCE(SUM(CASE WHEN reserved_at > 0 AND reserved_at < %s THEN 1 ELSE 0 END), 0), '
+        'COALESCE(SUM(CASE WHEN last_run = 0 THEN 1 ELSE 0 END), 0) '
+        'FROM {p}jobs', (int(now - stuck_after),))
+
+    classes = dict()
+    for name, count, oldest in database.rows(
+            'SELECT class, COUNT(*), MIN(CASE WHEN last_run > 0 THEN last_run END) FROM {p}jobs GROUP BY class'):
+        classes[name] = (int(count), int(oldest) if oldest is not None else None)
+
+    row = database.query("SELECT configvalue FROM {p}appconfig WHERE appid = 'core' AND configkey = 'lastcron'")
+    last_cron = int(row[0]) if row and row[0] else None
+
+    return JobQueue(int(queued), int(reserved), int(stuck), int(never_run), classes, last_cron)
+
+
+def fetch(now, timeout=None):
+    database = Database(settings(), timeout)
+    try:
+        return query(database, now)
+    finally:
+        database.close()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# Counters of the entries of nextcloud.log
+#
+# nextcloud writes one JSON object per line. Every run reads the entries
+# appended since the previous run (nextcloud_munin/tail.py) and adds them to
+# running totals per level, per app and per exception class, which munin
+# turns into rates. Entries whose message matches env.log_slow_pattern are
+# counted as slow. Apps and exception classes are ranked by a count decaying
+# over a day, only the TRACKED highest are kept, so the state stays small
+# however many different exceptions the log has seen.
+import json
+import math
+import os
+import re
+
+DEFAULT_LOG_FILE = '/var/www/nextcloud/data/nextcloud.log'
+DEFAULT_SLOW_PATTERN = r'(?i)\bslow\b|took too long'
+DEFAULT_TOP = 10
+
+LEVELS = ('debug', 'info', 'warning', 'error', 'fatal')
+
+# time constant of the ranking in seconds and the number of apps and exceptions kept
+DECAY = 86400
+TRACKED = 100
+
+
+def exception_class(entry):
+    # newer versions log the exception next to the message, older ones as the message
+    exception = entry.get('exception')
+    if not isinstance(exception, dict):
+        exception = entry.get('message')
+    if isinstance(exception, dict):
+        return exception.get('Exception')
+    return None
+
+
+def score(item, now):
+    total, value, updated = item
+    return value * math.exp(-(now - updated) / DECAY)
+
+
+def increment(table, key, now):
+    # table maps a key to [total, decaying score, time of the score]
+    item = table.get(key)
+    if item is None:
+        item = table[key] = [0, 0.0, now]
+    item[0] += 1
+    item[1] = score(item, now) + 1
+    item[2] = now
+
+
+def prune(table, now):
+    if len(table) > TRACKED:
+        for key in sorted(table, key=lambda key: score(table[key], now))[:len(table) - TRACKED]:
+            del table[key]
+
+
+def ranked(table, now, size=None):
+    # the keys with the highest decayed score
+    size = size or int(os.environ.get('log_top', DEFAULT_TOP))
+    return sorted(table, key=lambda key: (-score(table[key], now), key))[:size]
+
+
+def count(tail, now):
+    # add the new entries of the log to the counters in tail.data
+    data = tail.data
+    levels = data.setdefault('levels', dict((level, 0) for level in LEVELS))
+    apps = data.setdefault('apps', dict())
+    exceptions = data.setdefault('exceptions', dict())
+    slow = re.compile(os.environ.get('log_slow_pattern', DEFAULT_SLOW_PATTERN))
+    data.setdefault('slow', 0)
+    data.setdefault('invalid', 0)
+
+    for line in tail.lines():
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            index = int(entry.get('level', 0))
+        except (ValueError, TypeError, AttributeError):
+            data['invalid'] += 1
+            continue
+        if not 0 <= index < len(LEVELS):
+            # a negative index would count as fatal
+            data['invalid'] += 1
+            continue
+        level = LEVELS[index]
+
+        levels[level] += 1
+        increment(apps, str(entry.get('app') or 'no app'), now)
+
+        name = exception_class(entry)
+        if name:
+            increment(exceptions, str(name), now)
+
+        message = entry.get('message')
+        if isinstance(message, str) and slow.search(message):
+            data['slow'] += 1
+
+    prune(apps, now)
+    prune(exceptions, now)
+    return data
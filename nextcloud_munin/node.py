@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+# munin-node protocol server hosting the nextcloud plugins in one process
+#
+# munin-node starts a new interpreter for every plugin on every fetch. This
+# server speaks the munin-node protocol itself (cap, list, nodes, config,
+# fetch, spoolfetch, version, quit) and runs the plugin classes of the
+# nextcloud_*.py scripts next to this package in-process, so a fetch costs no
+# process creation, the serverinfo connections stay open between fetches and
+# the response cache and circuit breakers are shared as before.
+#
+# All plugins see the environment of the server, so the env.* settings of the
+# plugin-config go into its environment without the env. prefix. Only the
+# addresses in env.node_allow may connect. Either stop munin-node or give one
+# of both another port when running both on one host.
+#
+# usage: url=... username=... password=... node_listen=0.0.0.0:4949 \
+#            python3 -m nextcloud_munin.node
+import importlib.util
+import inspect
+import ipaddress
+import os
+import signal
+import socket
+import socketserver
+import sys
+
+from nextcloud_munin import serverinfo
+from nextcloud_munin.plugin import NextcloudPlugin
+
+DEFAULT_LISTEN = '127.0.0.1:4949'
+DEFAULT_ALLOW = '127.0.0.1 ::1'
+CAPABILITIES = ('multigraph', 'dirtyconfig', 'spool')
+VERSION = '1.0'
+
+
+def discover(directory=None):
+    # name to plugin class of every nextcloud_*.py script, env.node_plugins restricts them
+    directory = directory or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    wanted = os.environ.get('node_plugins', '').split()
+
+    plugins = dict()
+    for filename in sorted(os.listdir(directory)):
+        if not (filename.startswith('nextcloud_') and filename.endswith('.py')):
+            continue
+        if wanted and filename not in wanted:
+            continue
+
+        spec = importlib.util.spec_from_file_location(filename[:-len('.py')], os.path.join(directory, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        for _, cls in inspect.getmembers(module, inspect.isclass):
+            if issubclass(cls, NextcloudPlugin) and cls is not NextcloudPlugin and cls.__module__ == module.__name__:
+                plugins[filename] = cls
+    return plugins
+
+
+def allowed_networks():
+    return [ipaddress.ip_network(address, strict=False)
+            for address in os.environ.get('node_allow', DEFAULT_ALLOW).split()]
+
+
+class Connection(socketserver.StreamRequestHandler):
+    # one munin master session, commands are answered until quit or the connection closes
+    def setup(self):
+        super().setup()
+        self.capabilities = set()
+
+    def handle(self):
+        address = ipaddress.ip_address(self.client_address[0].split('%')[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not any(address in network for network in self.server.allow):
+            return
+
+        self.write('# munin node at %s' % self.server.hostname)
+        for raw in self.rfile:
+            command, _, argument = raw.decode('utf-8', 'replace').strip().partition(' ')
+            if command in ('quit', '.'):
+                return
+
+            handler = getattr(self, 'do_%s' % command, None)
+            if handler is None:
+                self.write('# Unknown command. Try cap, list, nodes, config, fetch, version or quit')
+            else:
+                try:
+                    handler(argument.strip())
+                except Exception as e:
+                    # a failing plugin must not take the connection down, its buffered output is dropped and
+                    # only the end of its answer is sent
+                    print('%s %s failed: %s' % (command, argument.strip(), e), file=sys.stderr)
+                    self.write('.')
+            self.wfile.flush()
+
+    def write(self, line):
+        self.wfile.write(('%s\n' % line).encode('utf-8'))
+
+    def plugin(self, name):
+        # a new instance for every command, so it reads the current environment and state
+        cls = self.server.plugins.get(name)
+        if cls is None or (cls.multigraph and 'multigraph' not in self.capabilities):
+            self.write('# Unknown service')
+            self.write('.')
+            return None
+
+        plugin = cls()
+        plugin.name = name
+        return plugin
+
+    def do_cap(self, argument):
+        self.capabilities = set(argument.split()) & set(CAPABILITIES)
+        self.write('cap %s' % ' '.join(CAPABILITIES))
+
+    def do_nodes(self, argument):
+        self.write(self.server.hostname)
+        self.write('.')
+
+    def do_list(self, argument):
+        self.write(' '.join(name for name, cls in self.server.plugins.items()
+                            if not cls.multigraph or 'multigraph' in self.capabilities))
+
+    def do_version(self, argument):
+        self.write('munins node on %s version: %s (nextcloud-munin-py)' % (self.server.hostname, VERSION))
+
+    def do_config(self, argument):
+        plugin = self.plugin(argument)
+        if plugin is None:
+            return
+
+        out = Lines()
+        for line in plugin.config_lines():
+            out.write(line + '\n')
+        if 'dirtyconfig' in self.capabilities:
+            plugin.run(out)
+        out.send(self)
+        self.write('.')
+
+    def do_fetch(self, argument):
+        plugin = self.plugin(argument)
+        if plugin is None:
+            return
+
+        out = Lines()
+        plugin.run(out)
+        out.send(self)
+        self.write('.')
+
+    def do_spoolfetch(self, argument):
+        # every plugin's config and spooled samples, single graph plugins are named by a multigraph line
+        try:
+            since = int(argument or 0)
+        except ValueError:
+            since = 0
+
+        for name, cls in self.server.plugins.items():
+            out = Lines()
+            try:
+                plugin = cls()
+                plugin.name = name
+                if not cls.multigraph:
+                    out.write('multigraph %s\n' % name.replace('.', '_'))
+                plugin.spoolfetch(since, out)
+            except Exception as e:
+                # the samples of the other plugins are still sent
+                print('spoolfetch %s failed: %s' % (name, e), file=sys.stderr)
+                continue
+            out.send(self)
+        self.write('.')
+
+
+class Lines:
+    # file-like writer for print() collecting a plugin's answer, which is sent once the plugin is done, lines
+    # starting with a dot would end the answer
+    def __init__(self):
+        self.lines = list()
+        self.pending = ''
+
+    def write(self, text):
+        self.pending += text
+        *lines, self.pending = self.pending.split('\n')
+        self.lines.extend(' ' + line if line.startswith('.') else line for line in lines)
+
+    def flush(self):
+        pass
+
+    def send(self, connection):
+        for line in self.lines:
+            connection.write(line)
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, plugins):
+        self.address_family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+        self.plugins = plugins
+        self.allow = allowed_networks()
+        self.hostname = os.environ.get('node_hostname') or socket.getfqdn()
+        super().__init__(address, Connection)
+
+
+def main():
+    plugins = discover()
+    if not plugins:
+        print('no plugins found', file=sys.stderr)
+        sys.exit(1)
+
+    # keep the connections to nextcloud open between fetches
+    serverinfo.persistent_sessions = dict()
+
+    host, _, port = os.environ.get('node_listen', DEFAULT_LISTEN).rpartition(':')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with Server((host.strip('[]') or '0.0.0.0', int(port)), plugins) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
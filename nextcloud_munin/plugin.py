@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+# Common munin command handling of all nextcloud plugins
+#
+# A plugin class names the registry graphs it draws in graphs, config, the
+# serverinfo sections and key paths to request and parse_data() are derived
+# from the registry. Plugins with graphs of their own provide self.config and
+# a parse_data(api_response) method appending the value lines to self.result.
+import sys
+import os
+import time
+
+from nextcloud_munin import history, registry, serverinfo, supersample
+from nextcloud_munin.breaker import ERROR_CLASSES as ERRORS
+from nextcloud_munin.cache import DEFAULT_TTL
+from nextcloud_munin.spool import Spool, timestamped
+
+DEFAULT_SAMPLE_INTERVAL = 300
+
+
+def mark_stale(lines, age, reason, fresh=()):
+    # annotate every value served from an earlier report with its age and why it was served, the fields in
+    # fresh are not taken from the report
+    for line in lines:
+        yield line
+        field, sep, _ = line.partition('.value ')
+        if sep and field not in fresh:
+            yield '%s.extinfo stale value from %.0f seconds ago, %s' % (field, age, reason)
+
+
+class NextcloudPlugin:
+    # names of the registry graphs the plugin draws and whether they are output as multigraphs
+    graphs = ()
+    multigraph = False
+
+    # whether the values are recorded in the local history even without env.history 1
+    keep_history = False
+
+    def __init__(self):
+        self.config = list(registry.config(tuple(self.graphs), self.multigraph))
+        self.result = list()
+
+        # optional serverinfo sections and key paths of the report the graphs read
+        self.sections = registry.sections(self.graphs)
+        self.paths = registry.paths(self.graphs)
+        self.extractor = registry.Extractor(self.graphs, self.multigraph)
+
+        # the serverinfo report the values were parsed from and the seconds spent parsing
+        self.report = None
+        self.parse_time = 0.0
+
+        # the name munin knows the plugin by, which is the name of the symlink
+        self.name = os.path.basename(sys.argv[0])
+
+    def config_lines(self):
+        if supersample.enabled():
+            return supersample.config(self.config, graph=self.graph)
+        return self.config
+
+    def plugin_values(self):
+        # values of the registry fields which are not read from serverinfo
+        return self.health_values()
+
+    def health_values(self):
+        # the age of the report and the state of the circuit breaker, current even for a stale report
+        values = dict()
+        if self.report is None:
+            return values
+
+        if self.report.age is not None:
+            values['data_age'] = '%.0f' % self.report.age
+        if self.report.health is not None:
+            values['breaker_state'] = self.report.health['breaker_state']
+            values['consecutive_failures'] = self.report.health['failures']
+        return values
+
+    def parse_data(self, api_response):
+        self.result.extend(self.extractor.values(api_response, self.plugin_values()))
+
+    def handle(self, report):
+        # parse a serverinfo report into self.result, returns an error message if that was not possible
+        self.report = report
+        if report.status_code is None:
+            return report.error or 'deadline exceeded'
+
+        # if status code is successful continue
+        if report.status_code == 200:
+            started = time.monotonic()
+            self.parse_data(report.data)
+            self.parse_time += time.monotonic() - started
+            if report.stale:
+                self.result = list(mark_stale(self.result, report.age, report.error, self.health_values()))
+            return None
+
+        return ERRORS.get(report.status_code, 'unknown error')
+
+    def collect(self):
+        # fill self.result with the value lines, returns an error message if that was not possible
+        self.result = list()
+        error = self.handle(serverinfo.fetch(sections=self.sections, paths=self.paths))
+        if error is None:
+            self.record(self.result, self.report)
+        return error
+
+    def record(self, lines, report, instance=None):
+        # with env.history 1 keep the values in the local history, stamped with the time the report
+        # was fetched, so a report served again from the cache or as a stale fallback is not recorded twice
+        if not (history.enabled() or self.keep_history) or report.age is None:
+            return
+        history.record(lines, time.time() - report.age, graph=self.graph,
+                       suffix=instance, fields=registry.fields())
+
+    def fetch(self):
+        # fill self.result for a munin fetch, with env.supersample 1 from the last period of the sampler
+        if not supersample.enabled():
+            return self.collect()
+
+        lines = supersample.load(self.name)
+        if lines is not None:
+            self.result = lines
+            return None
+
+        # no sampler running, the current values stand in for all statistics
+        error = self.collect()
+        if error is None:
+            window = self.window(time.time())
+            window.add(self.result, self.graph)
+            self.result = window.lines(self.multigraph)
+        return error
+
+    @property
+    def graph(self):
+        # the graph value lines without a multigraph line belong to
+        return None if self.multigraph else self.graphs[0]
+
+    def window(self, start):
+        return supersample.Window(start, skip=supersample.counters(self.config, self.graph))
+
+    def supersample(self):
+        # collect every env.supersample_interval seconds and store the statistics of every finished period
+        interval = float(os.environ.get('supersample_interval', supersample.DEFAULT_INTERVAL))
+        period = float(os.environ.get('supersample_period', supersample.DEFAULT_PERIOD))
+
+        # a cached report would be counted several times, the sampler keeps the cache as fresh as it samples
+        if float(os.environ.get('cache_ttl', DEFAULT_TTL)) > interval:
+            os.environ['cache_ttl'] = str(interval / 2)
+
+        window = self.window(time.time() // period * period)
+        last_report = None
+        while True:
+            now = time.time()
+            if now >= window.start + period:
+                if window.samples:
+                    supersample.store(self.name, window, window.start + period, self.multigraph)
+                window = self.window(now // period * period)
+
+            try:
+                error = self.collect()
+                if error:
+                    print(error, file=sys.stderr)
+                elif not self.report.stale:
+                    # a report served again from the cache is the same sample
+                    fetched = time.time() - self.report.age
+                    if last_report is None or abs(fetched - last_report) > 1:
+                        window.add(self.result, self.graph)
+                        last_report = fetched
+            except Exception as e:
+                print('sampling failed: %s' % e, file=sys.stderr)
+
+            # sample on the interval grid, so every period gets the same number of samples
+            time.sleep(interval - time.time() % interval)
+
+    def run(self, out=None):
+        out = out or sys.stdout
+        error = self.fetch()
+        if error:
+            print(error, file=out)
+            return
+
+        # output results to stdout
+        for el in self.result:
+            print(el, file=out)
+
+    def acquire(self, spool):
+        # take one sample and append it to the spool
+        timestamp = time.time()
+        error = self.collect()
+        if error:
+            print(error, file=sys.stderr)
+        else:
+            spool.append(self.result, timestamp)
+
+    def sample(self):
+        # collect on a timer independent of the munin master's polling
+        spool = Spool(self.name)
+        interval = float(os.environ.get('sample_interval', DEFAULT_SAMPLE_INTERVAL))
+
+        while True:
+            started = time.monotonic()
+            try:
+                self.acquire(spool)
+            except Exception as e:
+                print('sampling failed: %s' % e, file=sys.stderr)
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def spoolfetch(self, since, out=None):
+        # config once, then every spooled sample newer than since in one batch
+        out = out or sys.stdout
+        for el in self.config_lines():
+            print(el, file=out)
+
+        for timestamp, lines in Spool(self.name).read(since):
+            for el in timestamped(lines, timestamp):
+                print(el, file=out)
+
+    def main(self):
+        # check if any argument is given
+        if sys.argv.__len__() >= 2:
+            # check if first argument is config or autoconf if not fetch data
+            if sys.argv[1] == "config":
+                # output config list to stdout
+                for el in self.config_lines():
+                    print(el, file=sys.stdout)
+
+                # if DIRTYCONFIG true also return the corresponding values
+                if os.environ.get('MUNIN_CAP_DIRTYCONFIG') == '1':
+                    self.run()
+
+            elif sys.argv[1] == 'autoconf':
+                if None in [os.environ.get('username'), os.environ.get('password')]:
+                    print('env variables are missing')
+                else:
+                    print('yes')
+
+            elif sys.argv[1] == 'acquire':
+                self.acquire(Spool(self.name))
+
+            elif sys.argv[1] == 'sample':
+                self.sample()
+
+            elif sys.argv[1] == 'supersample':
+                self.supersample()
+
+            elif sys.argv[1] == 'spoolfetch':
+                self.spoolfetch(int(sys.argv[2]) if sys.argv.__len__() >= 3 else 0)
+
+            elif sys.argv[1] == 'fetch':
+                self.run()
+        else:
+            self.run()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+# Per-user quota and usage from the OCS provisioning API
+#
+# serverinfo only reports totals. The provisioning API lists the user ids in
+# pages (cloud/users?limit=&offset=) and tells the quota of one user at a time
+# (cloud/users/<id>), which is far too many requests to make for every user in
+# every munin cycle. The usage of every user is therefore kept in a cache in
+# the plugin state directory, and a run only refreshes the users whose entry is
+# older than env.quota_ttl seconds, oldest first and at most env.quota_batch of
+# them. The user list itself is refreshed every env.quota_list_ttl seconds.
+# Pages and users are requested concurrently by env.quota_workers threads on
+# one keep-alive session, and a run stops sending requests after
+# env.quota_budget seconds, so the cost per run stays bounded however many
+# accounts the instance has.
+#
+# The api needs the credentials of an admin, the base url is the part of
+# env.url in front of /ocs/.
+import concurrent.futures
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import time
+from urllib.parse import quote
+
+from nextcloud_munin.cache import cache_key, state_dir
+from nextcloud_munin.serverinfo import DEFAULT_TIMEOUT
+
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_WORKERS = 4
+DEFAULT_TTL = 3600
+DEFAULT_LIST_TTL = 3600
+DEFAULT_BATCH = 500
+DEFAULT_BUDGET = 8
+DEFAULT_TOP = 10
+
+# upper bounds of the relative usage buckets in percent, the last one is over quota
+BUCKETS = (
+    ('below_50', 50),
+    ('below_80', 80),
+    ('below_90', 90),
+    ('below_100', 100),
+    ('over_quota', None),
+)
+
+
+def base_url(url):
+    # the nextcloud root of the serverinfo url
+    return url.split('/ocs/', 1)[0]
+
+
+class QuotaCache:
+    def __init__(self, url, username, directory=None):
+        self.path = os.path.join(directory or state_dir(), 'nextcloud_quota_%s.json' % cache_key(url, username))
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'listed': 0, 'users': {}}
+
+    @contextlib.contextmanager
+    def lock(self):
+        # one refreshing run at a time, the others report the cache as it is
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
+
+    def store(self, state):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.nextcloud_quota_')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+
+class Provisioning:
+    def __init__(self, url, username, password, timeout, deadline=None):
+        import requests
+
+        self.base = base_url(url)
+        self.timeout = timeout
+
+        # monotonic time no request may last beyond, so a run ends with its budget
+        self.deadline = deadline
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers.update({'Accept': 'application/json', 'OCS-APIRequest': 'true'})
+
+        # one pooled connection per worker
+        workers = int(os.environ.get('quota_workers', DEFAULT_WORKERS))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path, **params):
+        timeout = self.timeout
+        if self.deadline is not None:
+            timeout = min(timeout, self.deadline - time.monotonic())
+            if timeout <= 0:
+                raise TimeoutError('quota budget spent')
+        r = self.session.get('%s/ocs/v1.php/cloud/%s' % (self.base, path), params=dict(params, format='json'),
+                             timeout=timeout)
+        r.raise_for_status()
+        return r.json()['ocs']['data']
+
+    def users(self, limit, offset):
+        return self.get('users', limit=limit, offset=offset)['users']
+
+    def quota(self, user):
+        # (used bytes, quota in bytes or None without a quota)
+        quota = self.get('users/%s' % quote(user, safe=''))['quota']
+        limit = quota.get('quota')
+        if not isinstance(limit, (int, float)) or limit < 0:
+            limit = None
+        return int(quota.get('used') or 0), limit
+
+    def close(self):
+        self.session.close()
+
+
+def run_until(executor, calls, deadline):
+    # submit the calls, returns the finished (argument, result) pairs and cancels the rest at the deadline
+    futures = dict((executor.submit(call, argument), argument) for call, argument in calls)
+    done, pending = concurrent.futures.wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+    for future in pending:
+        future.cancel()
+
+    results = list()
+    for future in done:
+        try:
+            results.append((futures[future], future.result()))
+        except Exception:
+            # a failing request keeps the cached entry, it is retried in a later run
+            continue
+    return results
+
+
+def list_users(api, executor, workers, deadline, page_size):
+    # all user ids, pages are requested in waves of one page per worker until a short page arrives
+    users = list()
+    offset = 0
+    while time.monotonic() < deadline:
+        offsets = [offset + i * page_size for i in range(workers)]
+        pages = dict(run_until(executor, [(lambda o: api.users(page_size, o), o) for o in offsets], deadline))
+        if len(pages) != len(offsets):
+            return None
+
+        for o in offsets:
+            users.extend(pages[o])
+            if len(pages[o]) < page_size:
+                return users
+        offset += workers * page_size
+    return None
+
+
+def refresh(url, username, password, timeout=None, directory=None):
+    # returns the cached usage of all users and how many of them were refreshed and failed in this run
+    cache = QuotaCache(url, username, directory)
+    ttl = float(os.environ.get('quota_ttl', DEFAULT_TTL))
+    list_ttl = float(os.environ.get('quota_list_ttl', DEFAULT_LIST_TTL))
+    batch = int(os.environ.get('quota_batch', DEFAULT_BATCH))
+    workers = int(os.environ.get('quota_workers', DEFAULT_WORKERS))
+    deadline = time.monotonic() + float(os.environ.get('quota_budget', DEFAULT_BUDGET))
+    timeout = timeout or float(os.environ.get('timeout', DEFAULT_TIMEOUT))
+
+    with cache.lock() as locked:
+        state = cache.load()
+        if not locked:
+            return state, 0, 0
+
+        now = time.time()
+        api = Provisioning(url, username, password, timeout, deadline)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            if now - state['listed'] >= list_ttl:
+                listed = list_users(api, executor, workers, deadline,
+                                    int(os.environ.get('quota_page_size', DEFAULT_PAGE_SIZE)))
+                if listed is not None:
+                    # deleted users leave the cache, new ones are refreshed first
+                    state['users'] = dict((user, state['users'].get(user, {'time': 0})) for user in listed)
+                    state['listed'] = now
+
+            stale = sorted((entry['time'], user) for user, entry in state['users'].items() if now - entry['time'] >= ttl)
+            wanted = [user for _, user in stale[:batch]]
+            results = run_until(executor, [(api.quota, user) for user in wanted], deadline)
+        finally:
+            # the requests still running end at the deadline, the session is closed once they did
+            executor.shutdown(wait=True, cancel_futures=True)
+            api.close()
+
+        for user, (used, limit) in results:
+            state['users'][user] = {'time': now, 'used': used, 'quota': limit}
+
+        # this run reports the users of the ranking config declared, the new ranking is stored for the next config
+        declared = state.get('top', [])
+        state['top'] = [user for user, _, _ in top(state)]
+        cache.store(state)
+        return dict(state, top=declared), len(results), len(wanted) - len(results)
+
+
+def known(state):
+    # (user, used, quota) of every user whose usage was fetched at least once
+    return [(user, entry['used'], entry['quota']) for user, entry in state['users'].items() if 'used' in entry]
+
+
+def top(state, size=None):
+    size = size or int(os.environ.get('quota_top', DEFAULT_TOP))
+    return sorted(known(state), key=lambda user: (-user[1], user[0]))[:size]
+
+
+def drawn(state):
+    # (user, used, quota) of the users of the stored ranking, the fields of the top users graph
+    users = state['users']
+    return [(user, users[user]['used'], users[user]['quota']) for user in state.get('top', [])
+            if 'used' in users.get(user, {})]
+
+
+def distribution(state):
+    # number of users per bucket of relative usage, users without a quota are counted on their own
+    counts = dict((name, 0) for name, _ in BUCKETS)
+    counts['unlimited'] = 0
+    for _, used, limit in known(state):
+        if limit is None:
+            counts['unlimited'] += 1
+            continue
+        relative = 100.0 * used / limit if limit else 100.0
+        counts[next(name for name, bound in BUCKETS if bound is None or relative < bound)] += 1
+    return counts
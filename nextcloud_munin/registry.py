@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+
+# Declarative registry of all graphs the nextcloud plugins draw
+#
+# Every graph lists its munin attributes and its fields, every field the key
+# path of its value in the serverinfo report. The munin config, the key paths
+# to extract and the value lines of the single plugins and the multigraph are
+# all derived from here.
+import functools
+import statistics
+from collections import OrderedDict
+
+DATA = ('ocs', 'data')
+SYSTEM = DATA + ('nextcloud', 'system')
+STORAGE = DATA + ('nextcloud', 'storage')
+SHARES = DATA + ('nextcloud', 'shares')
+PHP = DATA + ('server', 'php')
+OPCACHE = PHP + ('opcache',)
+APCU = PHP + ('apcu',)
+VERSION = SYSTEM + ('version',)
+
+
+def has(node, key):
+    # whether an object has the key or an array the index, integers in key paths index into arrays
+    if isinstance(node, dict):
+        return key in node
+    return isinstance(node, list) and isinstance(key, int) and key < len(node) and node[key] is not None
+
+
+def lookup(node, path):
+    # the value at the key path of a report or None if it is missing
+    for key in path:
+        if not has(node, key):
+            return None
+        node = node[key]
+    return node
+
+
+class Field:
+    def __init__(self, name, path, aggregate=sum, scale=None, **attributes):
+        # fields without a path are filled in by the plugin itself, e.g. the age of the data
+        self.name = name
+        self.path = tuple(path) if path is not None else None
+
+        # how the values of several instances are combined into the cluster-wide value
+        self.aggregate = aggregate
+
+        # munin field attributes in config order, e.g. label, info, min
+        self.attributes = attributes
+
+        # factor to the base unit of the value, applied by munin with a cdef
+        self.scale = scale or 1
+        if scale is not None:
+            self.attributes['cdef'] = '%s,%s,*' % (name, scale)
+
+
+class Graph:
+    def __init__(self, name, fields, sections=(), min_version=None, **attributes):
+        self.name = name
+        self.fields = fields
+
+        # optional serverinfo sections the graph needs and the first nextcloud version providing it
+        self.sections = tuple(sections)
+        self.min_version = min_version
+
+        # munin graph attributes in config order without the graph_ prefix, e.g. title, args
+        self.attributes = attributes
+
+    @property
+    def paths(self):
+        paths = [field.path for field in self.fields if field.path is not None]
+        if self.min_version is not None:
+            paths.append(VERSION)
+        return paths
+
+    def config(self):
+        lines = ['graph_%s %s' % (key, value) for key, value in self.attributes.items()]
+        for field in self.fields:
+            lines.extend('%s.%s %s' % (field.name, key, value) for key, value in field.attributes.items())
+        return lines
+
+
+def counter(name, path, label, info, **attributes):
+    # the common case of a field counting something
+    return Field(name, path, label=label, info=info, min=0, **attributes)
+
+
+def kilobytes(name, path, label, info, **attributes):
+    # serverinfo reports the memory of the system in kB, munin scales bytes
+    return Field(name, path, label=label, info=info, min=0, scale=1024, **attributes)
+
+
+GRAPHS = OrderedDict((graph.name, graph) for graph in [
+    Graph('nextcloud_users', [
+        counter('last5minutes', DATA + ('activeUsers', 'last5minutes'),
+                'last 5 minutes', 'users connected in the last 5 minutes'),
+        counter('last1hour', DATA + ('activeUsers', 'last1hour'),
+                'last hour', 'users connected in the last hour'),
+        counter('last24hours', DATA + ('activeUsers', 'last24hours'),
+                'last 24 hours', 'users connected in the last 24 hours'),
+        counter('num_users', STORAGE + ('num_users',),
+                'number of users', 'total number of users'),
+    ], title='Nextcloud User Activity', args='--base 1000 -l 0', printf='%.0lf',
+        vlabel='connected users', info='graph showing the number of connected user', category='nextcloud'),
+
+    Graph('nextcloud_shares', [
+        counter('num_shares', SHARES + ('num_shares',),
+                'total number of shares', 'current over all total of shares'),
+        counter('num_shares_user', SHARES + ('num_shares_user',),
+                'user shares', 'current total of user shares'),
+        counter('num_shares_groups', SHARES + ('num_shares_groups',),
+                'group shares', 'current total of group shares'),
+        counter('num_shares_link', SHARES + ('num_shares_link',),
+                'link shares', 'current total of shares through a link'),
+        counter('num_shares_mail', SHARES + ('num_shares_mail',),
+                'mail shares', 'current total of mail shares'),
+        counter('num_shares_room', SHARES + ('num_shares_room',),
+                'room shares', 'current total of room shares'),
+        counter('num_shares_link_no_password', SHARES + ('num_shares_link_no_password',),
+                'link shares without a password',
+                'current total of shares through a link without a password protection'),
+        counter('num_fed_shares_sent', SHARES + ('num_fed_shares_sent',),
+                'federated shares sent', 'current total of federated shares sent'),
+        counter('num_fed_shares_received', SHARES + ('num_fed_shares_received',),
+                'federated shares recieved', 'current total of federated shares recieved'),
+    ], title='Nextcloud Shares', args='--base 1000 -l 0', printf='%.0lf',
+        vlabel='number of shares', info='graph showing the number of shares', category='nextcloud'),
+
+    Graph('nextcloud_dbsize', [
+        Field('db_size', DATA + ('server', 'database', 'size'),
+              label='database size in byte', info='users connected in the last 5 minutes', draw='AREA', min=0),
+    ], title='Nextcloud Database Size', args='--base 1024 -l 0',
+        vlabel='size in byte', info='graph showing the database size in byte', category='nextcloud'),
+
+    Graph('nextcloud_available_updates', [
+        counter('num_updates_available', SYSTEM + ('apps', 'num_updates_available'),
+                'available app updates', 'number of available app updates', warning=1),
+    ], sections=('apps',), min_version=14,
+        title='Nextcloud available App updates', args='--base 1000 -l 0', printf='%.0lf',
+        vlabel='updates available', info='graph showing the number of available app updates', category='nextcloud'),
+
+    Graph('nextcloud_storages', [
+        counter('num_storages', STORAGE + ('num_storages',),
+                'total number of storages', 'current over all total of storages'),
+        counter('num_storages_local', STORAGE + ('num_storages_local',),
+                'number of local storages', 'current over all total of storage'),
+        counter('num_storages_home', STORAGE + ('num_storages_home',),
+                'number of home storages', 'current over all total of storage'),
+        counter('num_storages_other', STORAGE + ('num_storages_other',),
+                'number of other storages', 'current over all total of storage'),
+    ], title='Nextcloud Storages', args='--base 1000 -l 0', printf='%.0lf',
+        vlabel='number', info='graph showing the number of storages', category='nextcloud'),
+
+    Graph('nextcloud_filecount', [
+        counter('num_files', STORAGE + ('num_files',),
+                'number of files', 'current number of files in the repository'),
+    ], title='Nextcloud Files', args='--base 1000 -l 0', printf='%.0lf',
+        vlabel='number of files', info='graph showing the number of files', category='nextcloud'),
+
+    Graph('nextcloud_freshness', [
+        Field('data_age', None, aggregate=max, label='age of the values',
+              info='seconds since the values were fetched, older values are served when serverinfo misses the deadline',
+              min=0, warning=600),
+    ], title='Nextcloud data freshness', args='--base 1000 -l 0', printf='%.0lf',
+        vlabel='seconds', info='graph showing how old the reported serverinfo values are', category='nextcloud'),
+
+    Graph('nextcloud_health', [
+        Field('breaker_state', None, aggregate=max, label='circuit breaker state',
+              info='0 closed, 1 half open with a trial request, 2 open with requests suspended after repeated failures',
+              min=0, max=2, warning=0, critical=1),
+        Field('consecutive_failures', None, aggregate=max, label='consecutive failures',
+              info='failed serverinfo requests in a row, including server errors, timeouts and connection errors',
+              min=0),
+    ], title='Nextcloud serverinfo health', args='--base 1000 -l 0', printf='%.0lf',
+        vlabel='state', info='graph showing the circuit breaker state of the serverinfo requests', category='nextcloud'),
+
+    Graph('nextcloud_cpuload', [
+        Field('load1', SYSTEM + ('cpuload', 0), aggregate=max, label='1 minute', info='load average over 1 minute',
+              min=0),
+        Field('load5', SYSTEM + ('cpuload', 1), aggregate=max, label='5 minutes', info='load average over 5 minutes',
+              min=0),
+        Field('load15', SYSTEM + ('cpuload', 2), aggregate=max, label='15 minutes',
+              info='load average over 15 minutes', min=0),
+    ], title='Nextcloud Server Load', args='--base 1000 -l 0', vlabel='load',
+        info='graph showing the load average of the nextcloud server', category='nextcloud'),
+
+    Graph('nextcloud_memory', [
+        kilobytes('mem_total', SYSTEM + ('mem_total',), 'total memory', 'physical memory of the server'),
+        kilobytes('mem_free', SYSTEM + ('mem_free',), 'free memory', 'physical memory available'),
+        kilobytes('swap_total', SYSTEM + ('swap_total',), 'total swap', 'swap space of the server'),
+        kilobytes('swap_free', SYSTEM + ('swap_free',), 'free swap', 'swap space available'),
+    ], title='Nextcloud Server Memory', args='--base 1024 -l 0', vlabel='bytes',
+        info='graph showing the memory and swap of the nextcloud server', category='nextcloud'),
+
+    Graph('nextcloud_opcache', [
+        Field('opcache_hit_rate', OPCACHE + ('opcache_statistics', 'opcache_hit_rate'), aggregate=statistics.mean,
+              label='hit rate', info='share of scripts served from the opcache', min=0, max=100, warning='90:'),
+    ], title='Nextcloud PHP OPcache Hit Rate', args='--base 1000 -l 0 -u 100', vlabel='%',
+        info='graph showing the hit rate of the php opcache', category='nextcloud'),
+
+    Graph('nextcloud_opcache_memory', [
+        Field('used_memory', OPCACHE + ('memory_usage', 'used_memory'), label='used',
+              info='opcache memory holding compiled scripts', draw='AREA', min=0),
+        Field('wasted_memory', OPCACHE + ('memory_usage', 'wasted_memory'), label='wasted',
+              info='opcache memory of outdated scripts, freed on the next restart', draw='STACK', min=0),
+        Field('free_memory', OPCACHE + ('memory_usage', 'free_memory'), label='free',
+              info='opcache memory available', draw='STACK', min=0),
+    ], title='Nextcloud PHP OPcache Memory', args='--base 1024 -l 0', vlabel='bytes',
+        info='graph showing the memory usage of the php opcache', category='nextcloud'),
+
+    Graph('nextcloud_apcu', [
+        Field('mem_size', APCU + ('cache', 'mem_size'), label='cached data', info='memory used by cached entries',
+              draw='AREA', min=0),
+        Field('avail_mem', APCU + ('sma', 'avail_mem'), label='available', info='shared memory available to apcu',
+              draw='STACK', min=0),
+    ], title='Nextcloud APCu Memory', args='--base 1024 -l 0', vlabel='bytes',
+        info='graph showing the memory usage of the apcu cache', category='nextcloud'),
+
+    Graph('nextcloud_apcu_requests', [
+        Field('num_hits', APCU + ('cache', 'num_hits'), label='hits', info='apcu lookups answered from the cache',
+              type='DERIVE', min=0),
+        Field('num_misses', APCU + ('cache', 'num_misses'), label='misses', info='apcu lookups not in the cache',
+              type='DERIVE', min=0),
+    ], title='Nextcloud APCu Requests', args='--base 1000 -l 0', vlabel='lookups per ${graph_period}',
+        info='graph showing the lookups of the apcu cache', category='nextcloud'),
+
+    Graph('nextcloud_php_limits', [
+        Field('memory_limit', PHP + ('memory_limit',), aggregate=max, label='memory limit',
+              info='php memory_limit of a single request', min=0),
+        Field('upload_max_filesize', PHP + ('upload_max_filesize',), aggregate=max, label='upload limit',
+              info='php upload_max_filesize of a single upload', min=0),
+    ], title='Nextcloud PHP Limits', args='--base 1024 -l 0', vlabel='bytes',
+        info='graph showing the memory and upload limits of php', category='nextcloud'),
+
+    Graph('nextcloud_php_execution_time', [
+        Field('max_execution_time', PHP + ('max_execution_time',), aggregate=max, label='max execution time',
+              info='php max_execution_time of a single request, 0 is unlimited', min=0),
+    ], title='Nextcloud PHP Execution Time Limit', args='--base 1000 -l 0', vlabel='seconds',
+        info='graph showing the execution time limit of php', category='nextcloud'),
+
+    # derived from the local history by nextcloud_munin/forecast.py
+    Graph('nextcloud_dbsize_growth', [
+        Field('db_size_day', None, label='last day', info='growth of the database per day fitted over the last day'),
+        Field('db_size_week', None, label='last week', info='growth of the database per day fitted over the last week'),
+    ], title='Nextcloud Database Growth', args='--base 1024', vlabel='bytes per day',
+        info='graph showing how fast the database grows', category='nextcloud'),
+
+    Graph('nextcloud_filecount_growth', [
+        Field('num_files_day', None, label='last day', info='new files per day fitted over the last day'),
+        Field('num_files_week', None, label='last week', info='new files per day fitted over the last week'),
+    ], title='Nextcloud File Growth', args='--base 1000', vlabel='files per day',
+        info='graph showing how fast the number of files grows', category='nextcloud'),
+
+    Graph('nextcloud_users_growth', [
+        Field('num_users_day', None, label='last day', info='new users per day fitted over the last day'),
+        Field('num_users_week', None, label='last week', info='new users per day fitted over the last week'),
+    ], title='Nextcloud User Growth', args='--base 1000', vlabel='users per day',
+        info='graph showing how fast the number of users grows', category='nextcloud'),
+
+    Graph('nextcloud_exhaustion', [
+        Field('db_size_days', None, aggregate=min, label='database size',
+              info='days until the database reaches env.db_size_limit', min=0, warning='30:', critical='7:'),
+        Field('num_files_days', None, aggregate=min, label='number of files',
+              info='days until the number of files reaches env.num_files_limit', min=0, warning='30:', critical='7:'),
+        Field('num_users_days', None, aggregate=min, label='number of users',
+              info='days until the number of users reaches env.num_users_limit', min=0, warning='30:', critical='7:'),
+    ], title='Nextcloud Capacity Forecast', args='--base 1000 -l 0', printf='%.1lf', vlabel='days',
+        info='graph showing when the configured limits will be reached at the current growth', category='nextcloud'),
+
+    # self-instrumentation of the multigraph plugin, only drawn with env.perf_graph 1
+    Graph('nextcloud_plugin_perf', [
+        Field('connect', None, label='connect', info='dns lookup and tcp connect, only measured with env.http_backend stdlib',
+              draw='AREA', min=0),
+        Field('tls', None, label='tls', info='tls handshake, only measured with env.http_backend stdlib',
+              draw='STACK', min=0),
+        Field('ttfb', None, label='time to first byte', info='request sent until the response headers arrived',
+              draw='STACK', min=0),
+        Field('download', None, label='download', info='receiving and extracting the response body',
+              draw='STACK', min=0),
+        Field('parse', None, label='parse', info='turning the report into value lines', draw='STACK', min=0),
+        Field('output', None, label='output', info='writing the value lines to munin-node', draw='STACK', min=0),
+    ], title='Nextcloud plugin runtime', args='--base 1000 -l 0', vlabel='seconds',
+        info='graph showing where the multigraph plugin spends its time, the request phases are those of the '
+             'request the report came from', category='nextcloud'),
+
+    Graph('nextcloud_plugin_bytes', [
+        Field('payload_bytes', None, label='payload', info='bytes of the response body read', min=0),
+        Field('transfer_bytes', None, label='transferred', info='bytes received on the wire, after compression',
+              min=0),
+    ], title='Nextcloud plugin response size', args='--base 1024 -l 0', vlabel='bytes',
+        info='graph showing the size of the serverinfo response', category='nextcloud'),
+
+    Graph('nextcloud_plugin_hits', [
+        Field('cache', None, label='response cache', info='reports served from the response cache', min=0, max=100),
+        Field('collector', None, label='collector', info='reports served by the resident collector', min=0, max=100),
+        Field('stale', None, label='stale', info='earlier reports served in place of a current one', min=0, max=100),
+    ], title='Nextcloud plugin hit rates', args='--base 1000 -l 0 -u 100', vlabel='%',
+        info='graph showing where the reports come from, averaged over time these are the hit rates',
+        category='nextcloud'),
+
+    # php-fpm pool status read by nextcloud_munin/fpm.py, only drawn with env.fpm_status
+    Graph('nextcloud_fpm_processes', [
+        Field('active', None, label='active', info='processes serving a request', draw='AREA', min=0),
+        Field('idle', None, label='idle', info='processes waiting for a request', draw='STACK', min=0),
+    ], title='Nextcloud PHP-FPM processes', args='--base 1000 -l 0', printf='%.0lf', vlabel='processes',
+        info='graph showing the busy and idle processes of the php-fpm pool', category='nextcloud'),
+
+    Graph('nextcloud_fpm_queue', [
+        Field('listen_queue', None, label='listen queue', info='requests waiting for a free process', min=0,
+              warning=1),
+        Field('listen_queue_len', None, label='queue size', info='requests the listen queue can hold at most',
+              min=0),
+    ], title='Nextcloud PHP-FPM listen queue', args='--base 1000 -l 0', printf='%.0lf', vlabel='requests',
+        info='graph showing the requests waiting for the php-fpm pool', category='nextcloud'),
+
+    Graph('nextcloud_fpm_events', [
+        Field('max_children_reached', None, label='max children reached',
+              info='times the pool wanted to start a process beyond pm.max_children', type='DERIVE', min=0,
+              warning=0),
+        Field('slow_requests', None, label='slow requests', info='requests running longer than '
+              'request_slowlog_timeout', type='DERIVE', min=0),
+    ], title='Nextcloud PHP-FPM saturation', args='--base 1000 -l 0', vlabel='events per ${graph_period}',
+        info='graph showing how often the php-fpm pool was saturated or slow', category='nextcloud'),
+])
+
+PERF_GRAPHS = ('nextcloud_plugin_perf', 'nextcloud_plugin_bytes', 'nextcloud_plugin_hits')
+FPM_GRAPHS = ('nextcloud_fpm_processes', 'nextcloud_fpm_queue', 'nextcloud_fpm_events')
+
+
+@functools.lru_cache(maxsize=None)
+def config(names, multigraph=True):
+    # munin config of the given graphs, rendered once per process
+    lines = list()
+    for name in names:
+        if multigraph:
+            lines.append('multigraph %s' % name)
+        lines.extend(GRAPHS[name].config())
+    return tuple(lines)
+
+
+def field(graph, name):
+    return next(field for field in GRAPHS[graph].fields if field.name == name)
+
+
+@functools.lru_cache(maxsize=None)
+def fields():
+    # graph name to the names of all its fields
+    return dict((graph.name, tuple(field.name for field in graph.fields)) for graph in GRAPHS.values())
+
+
+def aggregates(names):
+    return dict((field.name, field.aggregate) for name in names for field in GRAPHS[name].fields)
+
+
+def paths(names):
+    return sorted(set(path for name in names for path in GRAPHS[name].paths))
+
+
+def sections(names):
+    return tuple(sorted(set(section for name in names for section in GRAPHS[name].sections)))
+
+
+class Extractor:
+    # reads the values of a set of graphs with a flat list of precomputed accessors
+    #
+    # Fields sharing a parent object (e.g. all shares) are read from it after it
+    # was looked up once, instead of walking the report from the top for every field.
+    def __init__(self, names, multigraph=True):
+        self.multigraph = multigraph
+        self.parents = list()
+        self.graphs = list()
+
+        parent_index = dict()
+        for name in names:
+            graph = GRAPHS[name]
+            accessors = list()
+            for field in graph.fields:
+                if field.path is None:
+                    accessors.append((field.name, None, field.name))
+                    continue
+
+                parent = field.path[:-1]
+                if parent not in parent_index:
+                    parent_index[parent] = len(self.parents)
+                    self.parents.append(parent)
+                accessors.append((field.name, parent_index[parent], field.path[-1]))
+            self.graphs.append((graph.name, graph.min_version, accessors))
+
+    def values(self, api_response, plugin_values=None):
+        # yields the multigraph and value lines of every graph the report provides,
+        # plugin_values holds the values of the fields without a path
+        parents = [lookup(api_response, parent) for parent in self.parents]
+        version = lookup(api_response, VERSION)
+        major = int(str(version).split('.')[0]) if version else None
+
+        for name, min_version, accessors in self.graphs:
+            # precaution for graphs the nextcloud version does not provide yet
+            if min_version is not None and (major is None or major < min_version):
+                continue
+
+            if self.multigraph:
+                yield 'multigraph %s' % name
+            for field, parent, key in accessors:
+                node = parents[parent] if parent is not None else plugin_values
+                if has(node, key):
+                    yield '%s.value %s' % (field, node[key])
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+# Fetch the serverinfo report of the nextcloud instance configured in the environment
+#
+# requests is only imported once a request is actually made, so config and
+# autoconf never load a network stack. With env.http_backend stdlib the
+# report is fetched with http.client and requests is not needed at all.
+#
+# A fetch is bounded by env.timeout seconds in total. When the deadline is
+# missed the last good report is served instead, marked as stale, and a
+# detached refresh process (python3 -m nextcloud_munin.serverinfo refresh)
+# finishes updating the cache in the background.
+#
+# Requests go through the circuit breaker of the instance, failing instances
+# are left alone while it is open and the last good report is served instead.
+import json
+import subprocess
+import sys
+import os
+import threading
+import time
+from collections import namedtuple
+
+from nextcloud_munin.breaker import CircuitBreaker, CircuitOpen, error_class
+from nextcloud_munin.cache import DEFAULT_TTL, ResponseCache
+from nextcloud_munin.extract import extract
+
+# optional sections of the report and the query parameter skipping them,
+# the update check is never graphed and therefore always skipped
+SKIPPABLE_SECTIONS = {
+    'apps': 'skipApps',
+    'update': 'skipUpdate',
+}
+
+ALL_SECTIONS = ('apps',)
+
+CHUNK_SIZE = 65536
+
+# total seconds a plugin waits for the report, below munin-node's default plugin timeout of 10s
+DEFAULT_TIMEOUT = 8
+
+# seconds the background refresh may take after a missed deadline
+DEFAULT_REFRESH_TIMEOUT = 120
+
+# status_code and report as before, age in seconds since the report was fetched,
+# stale is set if the report is an older one served because of error, the reason no
+# current report is available, health the state of the circuit breaker and stats the
+# cost of the request the report came from and where it was served from (source)
+Report = namedtuple('Report', ['status_code', 'data', 'age', 'stale', 'error', 'health', 'stats'],
+                    defaults=(None, None, None))
+
+# long running processes (nextcloud_munin/node.py) keep one session per instance open between requests,
+# mapping url and credentials to the session and a lock, a session is used by one request at a time
+persistent_sessions = None
+persistent_sessions_lock = threading.Lock()
+
+
+def debug(message):
+    # munin-run --debug exports MUNIN_DEBUG, munin-node logs stderr
+    if os.environ.get('MUNIN_DEBUG') == '1':
+        print('# %s' % message, file=sys.stderr)
+
+
+def skip_parameters(sections):
+    return {parameter: 'false' if section in sections else 'true'
+            for section, parameter in sorted(SKIPPABLE_SECTIONS.items())}
+
+
+def extract_enabled():
+    return os.environ.get('json_extract', '1') != '0'
+
+
+def request_stats(entry, source):
+    # the stats of a cache entry or collector snapshot without the report itself
+    stats = dict((key, value) for key, value in entry.items() if key not in ('data', 'last_good'))
+    stats['source'] = source
+    return stats
+
+
+def request(url, username=None, password=None, session=None, timeout=None, sections=ALL_SECTIONS, paths=None):
+    # returns (status_code, data, stats) with stats describing the cost of the request,
+    # with paths given data is a pruned report containing only these key paths
+    if url and url.startswith('database:'):
+        from nextcloud_munin import database
+        return database.request(url, username, password, timeout=timeout, sections=sections, paths=paths)
+
+    if session is None:
+        if os.environ.get('http_backend') == 'stdlib':
+            return request_stdlib(url, username, password, timeout=timeout, sections=sections, paths=paths)
+
+        import requests
+
+        if persistent_sessions is not None:
+            with persistent_sessions_lock:
+                if (url, username, password) not in persistent_sessions:
+                    s = requests.Session()
+                    s.auth = (username, password)
+                    s.headers.update({'Accept': 'application/json'})
+                    persistent_sessions[url, username, password] = (s, threading.Lock())
+                s, lock = persistent_sessions[url, username, password]
+            with lock:
+                return request(url, session=s, timeout=timeout, sections=sections, paths=paths)
+
+        # init request session with specific header and credentials
+        with requests.Session() as s:
+            s.auth = (username, password)
+
+            # update header for json
+            s.headers.update({'Accept': 'application/json'})
+
+            return request(url, session=s, timeout=timeout, sections=sections, paths=paths)
+
+    # request the data, compressed and without the sections nobody asked for
+    started = time.monotonic()
+    with session.get(url, params=skip_parameters(sections), timeout=timeout, stream=True,
+                     headers={'Accept-Encoding': 'gzip, deflate'}) as r:
+        # requests only tells the time until the headers arrived, connect and tls are part of it
+        ttfb = r.elapsed.total_seconds()
+        data = None
+        if r.status_code == 200 and paths is not None:
+            data, payload_bytes = extract(r.iter_content(CHUNK_SIZE), paths)
+        else:
+            payload_bytes = len(r.content)
+            if r.status_code == 200:
+                data = r.json()
+
+        stats = {
+            'sections': sorted(sections),
+            'paths': paths and sorted(paths),
+            'fetch_time': time.monotonic() - started,
+            'phases': {'ttfb': ttfb, 'download': max(0.0, time.monotonic() - started - ttfb)},
+            'payload_bytes': payload_bytes,
+            'transfer_bytes': r.raw.tell() if hasattr(r.raw, 'tell') else payload_bytes,
+        }
+
+    return r.status_code, data, stats
+
+
+def request_stdlib(url, username, password, timeout=None, sections=ALL_SECTIONS, paths=None):
+    # same as request() with nothing but the standard library, redirects are not followed
+    import base64
+    import http.client
+    import ssl
+    import zlib
+    from urllib.parse import urlencode, urlsplit
+
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    query = urlencode(skip_parameters(sections))
+    path = '%s?%s&%s' % (path, parts.query, query) if parts.query else '%s?%s' % (path, query)
+
+    credentials = base64.b64encode(('%s:%s' % (username, password)).encode('utf-8')).decode('ascii')
+    headers = {
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip, deflate',
+        'Authorization': 'Basic %s' % credentials,
+        'Connection': 'close',
+        # the connection is opened with an explicit port, which would otherwise end up in the host header
+        'Host': parts.netloc.rpartition('@')[2],
+    }
+
+    started = time.monotonic()
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80),
+                                            timeout=timeout)
+    phases = dict()
+    transferred = [0]
+
+    def chunks(r):
+        # wbits offset 32 detects the gzip and zlib headers on its own
+        decompressor = None
+        if r.getheader('Content-Encoding', '').lower() in ('gzip', 'deflate'):
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+
+        while True:
+            chunk = r.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            transferred[0] += len(chunk)
+            yield decompressor.decompress(chunk) if decompressor else chunk
+
+        if decompressor:
+            yield decompressor.flush()
+
+    try:
+        # connect and wrap the socket in tls separately, HTTPSConnection.connect() does both in one go
+        connection.connect()
+        phases['connect'] = time.monotonic() - started
+        if parts.scheme == 'https':
+            connection.sock = ssl.create_default_context().wrap_socket(connection.sock, server_hostname=parts.hostname)
+            phases['tls'] = time.monotonic() - started - phases['connect']
+
+        requested = time.monotonic()
+        connection.request('GET', path, headers=headers)
+        r = connection.getresponse()
+        phases['ttfb'] = time.monotonic() - requested
+
+        received = time.monotonic()
+        data = None
+        if r.status == 200:
+            data, payload_bytes = extract(chunks(r), paths) if paths is not None else parse(chunks(r))
+        else:
+            payload_bytes = sum(len(chunk) for chunk in chunks(r))
+        phases['download'] = time.monotonic() - received
+    finally:
+        connection.close()
+
+    stats = {
+        'sections': sorted(sections),
+        'paths': paths and sorted(paths),
+        'fetch_time': time.monotonic() - started,
+        'phases': phases,
+        'payload_bytes': payload_bytes,
+        'transfer_bytes': transferred[0],
+    }
+
+    return r.status, data, stats
+
+
+def parse(chunks):
+    # parse the whole document, returns (data, payload bytes) like extract()
+    body = b''.join(chunks)
+    return json.loads(body.decode('utf-8')), len(body)
+
+
+def fallback(cache, sections, paths, error, health):
+    # the last good report in place of a current one, marked as stale
+    entry = cache.last_good(sections, paths)
+    if entry is None:
+        debug('%s without an earlier report to fall back to' % error)
+        return Report(None, None, None, True, error, health)
+
+    age = time.time() - entry['time']
+    debug('%s, serving the report from %.0fs ago' % (error, age))
+    return Report(entry['status_code'], entry['data'], age, True, error, health, request_stats(entry, 'stale'))
+
+
+def fetch(url=None, username=None, password=None, timeout=None, sections=ALL_SECTIONS, paths=None):
+    # returns a Report, without an explicit instance url and credentials are read from env
+    collector_socket = None
+    if url is None:
+        url = os.environ.get('url')
+        username = os.environ.get('username')
+        password = os.environ.get('password')
+        collector_socket = os.environ.get('collector_socket')
+
+        if os.environ.get('backend') == 'database':
+            # the database is identified by its own url, so it gets a cache and a breaker of its own
+            from nextcloud_munin import database
+            url = database.source()
+            username = password = None
+
+    if timeout is None:
+        timeout = float(os.environ.get('timeout', DEFAULT_TIMEOUT))
+
+    breaker = CircuitBreaker(url, username)
+
+    # a resident collector answers without any network round trip
+    if collector_socket:
+        from nextcloud_munin import collector
+        try:
+            snapshot = collector.query(collector_socket)
+            age = time.time() - snapshot['time']
+
+            # a collector whose refreshes keep failing serves an old report, which is fetched directly instead
+            limit = max(float(os.environ.get('cache_ttl', DEFAULT_TTL)), snapshot.get('interval') or 0) + timeout
+            if age > limit:
+                raise ValueError('collector report is %.0f seconds old' % age)
+
+            debug('serverinfo served by collector')
+            return Report(snapshot['status_code'], snapshot['data'], age, False,
+                          health=breaker.health(), stats=request_stats(snapshot, 'collector'))
+        except (OSError, ValueError) as e:
+            debug('collector not available: %s' % e)
+
+    # extract only the key paths the graphs read instead of materialising the whole report
+    if not extract_enabled():
+        paths = None
+
+    cache = ResponseCache(url, username, password)
+    outcome = dict()
+    recorded = threading.Lock()
+
+    def claim():
+        # the outcome is recorded once, either by the request or as a missed deadline
+        return recorded.acquire(blocking=False)
+
+    def get():
+        try:
+            outcome['result'] = cache.get(
+                breaker.guard(lambda requested_sections, requested_paths: request(
+                    url, username, password, timeout=timeout, sections=requested_sections, paths=requested_paths),
+                    claim),
+                sections, paths)
+        except BaseException as e:
+            outcome['error'] = e
+
+    # the deadline covers waiting for the cache lock, connect, tls, first byte and download
+    worker = threading.Thread(target=get, daemon=True)
+    worker.start()
+    worker.join(timeout)
+
+    if worker.is_alive():
+        # the request still running no longer records its outcome, the background refresh reports its own,
+        # unless the circuit opens in between
+        if claim():
+            breaker.record_failure('timeout')
+        refresh_in_background(url, username, password, sections, paths)
+        return fallback(cache, sections, paths, 'serverinfo missed the deadline of %ss' % timeout, breaker.health())
+
+    if 'error' in outcome:
+        health = breaker.health()
+        if isinstance(outcome['error'], CircuitOpen):
+            error = 'circuit open after %d failures, last error: %s' % (health['failures'], health['last_error'])
+        elif isinstance(outcome['error'], Exception):
+            error = 'serverinfo request failed: %s' % error_class(exception=outcome['error'])
+        else:
+            raise outcome['error']
+        return fallback(cache, sections, paths, error, health)
+
+    status_code, api_response = outcome['result']
+    entry = cache.entry
+    debug('serverinfo cache %s, sections [%s] fetched in %.3fs, %d bytes payload, %d bytes transferred' % (
+        cache.status, ', '.join(entry.get('sections', ())), entry.get('fetch_time', 0),
+        entry.get('payload_bytes', 0), entry.get('transfer_bytes', 0)))
+
+    return Report(status_code, api_response, time.time() - entry['time'], False, health=breaker.health(),
+                  stats=request_stats(entry, cache.status))
+
+
+def refresh_in_background(url, username, password, sections, paths):
+    # a fresh interpreter in its own session outlives the plugin, credentials are passed in its environment
+    environment = dict(os.environ, url=url or '', username=username or '', password=password or '')
+    environment.pop('collector_socket', None)
+    arguments = json.dumps({'sections': list(sections), 'paths': paths and [list(path) for path in paths]})
+
+    subprocess.Popen([sys.executable, '-m', 'nextcloud_munin.serverinfo', 'refresh', arguments],
+                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=environment,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+
+def refresh(arguments):
+    # waits for the lock of the abandoned fetch and refreshes the cache unless someone else already did
+    arguments = json.loads(arguments)
+    url = os.environ.get('url')
+    username = os.environ.get('username')
+    password = os.environ.get('password')
+    timeout = float(os.environ.get('refresh_timeout', DEFAULT_REFRESH_TIMEOUT))
+
+    try:
+        ResponseCache(url, username, password).get(
+            CircuitBreaker(url, username).guard(lambda requested_sections, requested_paths: request(
+                url, username, password, timeout=timeout, sections=requested_sections, paths=requested_paths)),
+            arguments['sections'], arguments['paths'])
+    except CircuitOpen:
+        pass
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['refresh']:
+        refresh(sys.argv[2])
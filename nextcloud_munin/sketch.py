@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Mergeable quantile sketch with a relative error guarantee
+#
+# A value x is counted in the bucket ceil(log(x) / log(gamma)) with
+# gamma = (1 + accuracy) / (1 - accuracy), every quantile read back is within
+# the relative accuracy of the true value (DDSketch, Masson et al. 2019).
+# Merging two sketches adds their bucket counts, so sketches of several logs
+# or request classes combine into exactly the sketch of all their values.
+# Once there are more than max_buckets the lowest buckets are collapsed, which
+# only costs accuracy on the smallest values, so the memory stays constant.
+import math
+
+DEFAULT_ACCURACY = 0.01
+DEFAULT_MAX_BUCKETS = 2048
+
+# values up to this are counted as zero
+MIN_VALUE = 1e-9
+
+
+class Sketch:
+    def __init__(self, accuracy=DEFAULT_ACCURACY, max_buckets=DEFAULT_MAX_BUCKETS):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+
+        self.buckets = dict()
+        self.zero = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        self.count += count
+        if value <= MIN_VALUE:
+            self.zero += count
+            return
+
+        key = int(math.ceil(math.log(value) / self.log_gamma))
+        self.buckets[key] = self.buckets.get(key, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self.collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('sketches of different accuracy can not be merged')
+
+        self.count += other.count
+        self.zero += other.zero
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self.collapse()
+
+    def collapse(self):
+        # fold the lowest buckets into the lowest one that is kept
+        keys = sorted(self.buckets)
+        folded = keys[:len(keys) - self.max_buckets + 1]
+        self.buckets[folded[-1]] = sum(self.buckets.pop(key) for key in folded)
+
+    def quantile(self, q):
+        # the value at quantile q (0 to 1), None while the sketch is empty
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self.zero
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Local spool of timestamped samples for munin's spoolfetch
+#
+# Every sample is stored as the plugin's value lines, each prefixed with the
+# unix timestamp of the collection:
+#
+#   1700000000 multigraph nextcloud_users
+#   1700000000 last5minutes.value 2
+#
+# Appends and trims are serialized with a file lock, so a sampler and a
+# concurrent spoolfetch never see a partially written sample.
+import contextlib
+import fcntl
+import os
+import time
+
+from nextcloud_munin.cache import state_dir
+
+DEFAULT_RETENTION = 86400
+
+# only rewrite the spool once the oldest sample is this much older than the retention
+TRIM_SLACK = 3600
+
+
+class Spool:
+    def __init__(self, name, retention=None, directory=None):
+        if retention is None:
+            retention = float(os.environ.get('spool_retention', DEFAULT_RETENTION))
+
+        self.retention = retention
+        self.path = os.path.join(directory or state_dir(), 'nextcloud_spool_%s' % name)
+
+    @contextlib.contextmanager
+    def open(self, mode):
+        with open(self.path, mode, encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if mode == 'r' else fcntl.LOCK_EX)
+            yield f
+
+    def append(self, lines, timestamp=None):
+        timestamp = int(timestamp or time.time())
+
+        with self.open('a') as f:
+            f.write(''.join('%d %s\n' % (timestamp, line) for line in lines))
+
+        self.trim(timestamp)
+
+    def read(self, since=0):
+        # returns a list of (timestamp, lines) of all samples taken after since
+        samples = list()
+
+        try:
+            with self.open('r') as f:
+                for row in f:
+                    timestamp, line = row.rstrip('\n').split(' ', 1)
+                    timestamp = int(timestamp)
+                    if timestamp <= since:
+                        continue
+
+                    if not samples or samples[-1][0] != timestamp:
+                        samples.append((timestamp, list()))
+                    samples[-1][1].append(line)
+        except FileNotFoundError:
+            pass
+
+        return samples
+
+    def trim(self, now=None):
+        cutoff = (now or time.time()) - self.retention
+
+        with self.open('r+') as f:
+            first = f.readline()
+            if not first or int(first.split(' ', 1)[0]) >= cutoff - TRIM_SLACK:
+                return
+
+            f.seek(0)
+            rows = [row for row in f if int(row.split(' ', 1)[0]) >= cutoff]
+            f.seek(0)
+            f.writelines(rows)
+            f.truncate()
+
+
+def timestamped(lines, timestamp):
+    # rewrite value lines to munin's "field.value epoch:value" form
+    for line in lines:
+        field, sep, value = line.partition('.value ')
+        yield '%s.value %d:%s' % (field, timestamp, value) if sep else line
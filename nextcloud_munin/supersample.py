@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+# Sub-cycle sampling aggregated into min, average, max and 95th percentile
+#
+# munin polls every 5 minutes, so a value like the users active in the last 5
+# minutes is seen once per cycle and short spikes in between are lost. With
+# env.supersample 1 a resident sampler (the supersample command of a plugin)
+# collects every env.supersample_interval seconds and aggregates the samples of
+# every munin period (env.supersample_period, aligned to the clock) in process.
+# At the end of a period the aggregate is written to the plugin state directory
+# and the next munin fetch reports it: the field itself as the average and
+# <field>_min, <field>_max and <field>_p95 next to it.
+#
+# Every field keeps a count, the sum, the extremes and a P-square estimator of
+# the 95th percentile (five markers, Jain & Chlamtac 1985), so the memory does
+# not depend on the number of samples. Counters (DERIVE, COUNTER) report their
+# last value, munin derives the rate from it anyway.
+import json
+import math
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+from nextcloud_munin.cache import state_dir
+
+DEFAULT_INTERVAL = 20
+DEFAULT_PERIOD = 300
+DEFAULT_GRAPHS = ('nextcloud_users', 'nextcloud_dbsize', 'nextcloud_cpuload', 'nextcloud_memory')
+
+QUANTILE = 0.95
+STATISTICS = (('min', 'minimum'), ('max', 'maximum'), ('p95', '95th percentile'))
+
+
+def enabled():
+    return os.environ.get('supersample') == '1'
+
+
+def graphs():
+    # the graphs drawn with their statistics, all others report the last sample
+    return tuple(os.environ.get('supersample_graphs', ' '.join(DEFAULT_GRAPHS)).split())
+
+
+def path(name, directory=None):
+    return os.path.join(directory or state_dir(), 'nextcloud_supersample_%s' % name)
+
+
+class Quantile:
+    # P-square estimate of a quantile in constant memory
+    def __init__(self, p=QUANTILE):
+        self.p = p
+        self.heights = list()
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(x)
+            heights.sort()
+            return
+
+        # the cell the observation falls into, extending the extremes if needed
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if heights[i] <= x < heights[i + 1])
+
+        for i in range(k + 1, 5):
+            self.positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # move the middle markers towards their desired positions
+        for i in range(1, 4):
+            d = self.desired[i] - self.positions[i]
+            if (d >= 1 and self.positions[i + 1] - self.positions[i] > 1) or \
+                    (d <= -1 and self.positions[i - 1] - self.positions[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self.parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self.linear(i, d)
+                heights[i] = height
+                self.positions[i] += d
+
+    def parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def linear(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+
+    def value(self):
+        if len(self.heights) < 5:
+            # exact while there are too few samples for the markers
+            if not self.heights:
+                return math.nan
+            return self.heights[min(len(self.heights) - 1, int(math.ceil(self.p * len(self.heights))) - 1)]
+        return self.heights[2]
+
+
+class Statistics:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.last = None
+        self.quantile = Quantile()
+
+    def add(self, x):
+        self.count += 1
+        self.total += x
+        self.minimum = min(self.minimum, x)
+        self.maximum = max(self.maximum, x)
+        self.last = x
+        self.quantile.add(x)
+
+
+def counters(config, graph=None):
+    # (graph, field) of every field munin derives a rate from
+    result = set()
+    for line in config:
+        if line.startswith('multigraph '):
+            graph = line[len('multigraph '):]
+            continue
+        field, sep, kind = line.partition('.type ')
+        if sep and kind in ('DERIVE', 'COUNTER'):
+            result.add((graph, field))
+    return result
+
+
+def selected(graph, names):
+    # nested instance graphs follow the graph they belong to
+    return graph is None or graph.partition('.')[0] in names
+
+
+def config(lines, names=None, graph=None):
+    # the plugin config with the statistics fields added to the gauges of the supersampled graphs,
+    # graph names the graph of plugins without multigraph lines
+    names = graphs() if names is None else names
+    skip = counters(lines, graph)
+    result = list()
+    labels = OrderedDict()
+
+    def flush():
+        for field, attributes in labels.items():
+            for suffix, description in STATISTICS:
+                name = '%s_%s' % (field, suffix)
+                result.append('%s.label %s (%s)' % (name, attributes.get('label', field), suffix))
+                result.append('%s.info %s of the samples taken during the last munin period' % (name, description))
+                if 'min' in attributes:
+                    result.append('%s.min %s' % (name, attributes['min']))
+                if 'cdef' in attributes:
+                    result.append('%s.cdef %s%s' % (name, name, attributes['cdef'][len(field):]))
+        labels.clear()
+
+    for line in lines:
+        if line.startswith('multigraph '):
+            flush()
+            graph = line[len('multigraph '):]
+        result.append(line)
+
+        field, _, rest = line.partition('.')
+        key, sep, value = rest.partition(' ')
+        if sep and not line.startswith('graph_') and selected(graph, names) and (graph, field) not in skip:
+            labels.setdefault(field, dict())[key] = value
+
+    flush()
+    return result
+
+
+class Window:
+    # the statistics of every field over one munin period
+    def __init__(self, start, names=None, skip=()):
+        self.start = start
+        self.names = graphs() if names is None else names
+        self.skip = skip
+        self.samples = 0
+        self.fields = OrderedDict()
+
+    def add(self, lines, graph=None):
+        self.samples += 1
+        for line in lines:
+            if line.startswith('multigraph '):
+                graph = line[len('multigraph '):]
+                continue
+            field, sep, value = line.partition('.value ')
+            if not sep:
+                continue
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            self.fields.setdefault(graph, OrderedDict()).setdefault(field, Statistics()).add(value)
+
+    def lines(self, multigraph=True):
+        result = list()
+        for graph, fields in self.fields.items():
+            if multigraph:
+                result.append('multigraph %s' % graph)
+            aggregated = selected(graph, self.names)
+            for field, stats in fields.items():
+                if not aggregated or (graph, field) in self.skip:
+                    result.append('%s.value %s' % (field, number(stats.last)))
+                    continue
+                result.append('%s.value %s' % (field, number(stats.total / stats.count)))
+                for suffix, value in (('min', stats.minimum), ('max', stats.maximum),
+                                      ('p95', stats.quantile.value())):
+                    result.append('%s_%s.value %s' % (field, suffix, number(value)))
+        return result
+
+
+def number(value):
+    return int(value) if float(value).is_integer() else round(value, 6)
+
+
+def store(name, window, end, multigraph=True, directory=None):
+    # replace the last finished period of the plugin atomically
+    target = path(name, directory)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.nextcloud_supersample_')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'start': window.start, 'end': end, 'samples': window.samples,
+                       'lines': window.lines(multigraph)}, f)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def load(name, period=None, directory=None):
+    # the lines of the last finished period, None if the sampler did not finish one lately
+    period = period or float(os.environ.get('supersample_period', DEFAULT_PERIOD))
+    try:
+        with open(path(name, directory), encoding='utf-8') as f:
+            window = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if window['end'] < time.time() - 2 * period:
+        return None
+    return window['lines']
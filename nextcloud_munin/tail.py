@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Incremental reading of growing log files
+#
+# The byte offset and inode of every followed file are kept in the plugin
+# state directory together with the counters of the plugin reading it, so a
+# run only reads what was appended since the previous run, however large the
+# file has grown. A file that was rotated away (its inode changed) is read to
+# its end from its rotated name (<path>.1) before the new file is read from
+# the start, a truncated file is read from the start. Only complete lines are
+# consumed, a line still being written is read by the next run. The first run
+# starts at the end of the file instead of reading the whole history. The
+# state is read, the lines are processed and the state is stored under a file
+# lock, so runs overlapping each other neither count lines twice nor lose the
+# counters of one another.
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+
+from nextcloud_munin.cache import cache_key, state_dir
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class Tail:
+    def __init__(self, name, paths, directory=None):
+        # name identifies the reader, paths are the files it follows
+        self.paths = list(paths)
+        self.path = os.path.join(directory or state_dir(), 'nextcloud_tail_%s_%s.json' % (
+            name, cache_key(*self.paths)[:16]))
+        self.max_bytes = int(os.environ.get('tail_max_bytes', DEFAULT_MAX_BYTES))
+        self.load()
+
+    def load(self):
+        # (re)reads the offsets and counters, under the lock before the lines are read
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = dict()
+
+        self.files = state.get('files', dict())
+        # counters of the reading plugin, persisted together with the offsets
+        self.data = state.get('data', dict())
+        self.bytes_read = 0
+        self.complete = False
+
+    @contextlib.contextmanager
+    def lock(self):
+        # one reader at a time from loading the state to storing it, the others wait
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def lines(self):
+        # yields the new complete lines of all files as bytes without the line break
+        for path in self.paths:
+            for line in self.follow(path):
+                yield line
+
+    def follow(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+
+        position = self.files.get(path)
+        if position is None:
+            # nothing to compare with, start following at the current end
+            self.files[path] = {'inode': st.st_ino, 'offset': st.st_size}
+            return
+
+        if position['inode'] != st.st_ino:
+            # rotated, the rest of the previous file went to its rotated name
+            try:
+                rotated = os.stat('%s.1' % path)
+            except FileNotFoundError:
+                rotated = None
+
+            if rotated is not None and rotated.st_ino == position['inode']:
+                for line in self.read('%s.1' % path, position):
+                    yield line
+                if not self.complete:
+                    # out of budget, the next run continues in the rotated file
+                    return
+            position = self.files[path] = {'inode': st.st_ino, 'offset': 0}
+        elif st.st_size < position['offset']:
+            # truncated in place
+            position['offset'] = 0
+
+        for line in self.read(path, position):
+            yield line
+
+    def read(self, path, position):
+        # buffered chunks from the stored offset, the offset advances over every complete line,
+        # complete tells whether the end of the file was reached within the budget
+        self.complete = False
+        with open(path, 'rb') as f:
+            f.seek(position['offset'])
+            rest = b''
+            while self.bytes_read < self.max_bytes:
+                chunk = f.read(min(CHUNK_SIZE, self.max_bytes - self.bytes_read))
+                if not chunk:
+                    self.complete = True
+                    return
+                self.bytes_read += len(chunk)
+
+                lines = (rest + chunk).split(b'\n')
+                rest = lines.pop()
+                for line in lines:
+                    position['offset'] += len(line) + 1
+                    yield line
+
+    def commit(self):
+        # store the offsets and counters after the lines were processed
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.nextcloud_tail_')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'files': self.files, 'data': self.data}, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
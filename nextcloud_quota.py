@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Plugin to monitor the storage used by the users of the specified nextcloud instance
+#   * top users by used storage
+#   * distribution of the users over their relative quota usage
+#   * cost of the collection
+#
+# The usage is collected through the OCS provisioning API with the credentials
+# of an admin, see nextcloud_munin/quota.py for the paging and caching.
+#
+# Parameters understood:
+#     config   (required)
+#     autoconf (optional - used by munin-config)
+#     acquire  (optional - append one sample to the spool)
+#     sample   (optional - keep appending samples every env.sample_interval seconds)
+#     spoolfetch <timestamp> (optional - output all spooled samples taken after timestamp)
+
+# Magic markers - optional - used by installation scripts and
+# munin-config:
+#
+#  #%# family=manual
+#  #%# capabilities=autoconf
+import os
+import time
+
+from nextcloud_munin import instances, quota
+from nextcloud_munin.plugin import NextcloudPlugin
+
+
+def field_name(user):
+    return instances.field_name('user', user)
+
+
+class NextcloudQuota(NextcloudPlugin):
+    multigraph = True
+
+    def __init__(self):
+        super().__init__()
+        self.url = os.environ.get('url')
+        self.username = os.environ.get('username')
+        self.password = os.environ.get('password')
+
+        # the top users are taken from the cache, config does not send any request
+        state = quota.QuotaCache(self.url, self.username).load() if self.url else {'users': {}}
+        self.config = self.quota_config(state)
+
+    def quota_config(self, state):
+        config = [
+            'multigraph nextcloud_quota_top',
+            'graph_title Nextcloud top users by storage',
+            'graph_args --base 1024 -l 0',
+            'graph_vlabel bytes',
+            'graph_info graph showing the users using the most storage',
+            'graph_category nextcloud',
+        ]
+        for user, _, limit in quota.drawn(state):
+            config.append('%s.label %s' % (field_name(user), user))
+            config.append('%s.info storage used by %s, %s' % (
+                field_name(user), user, 'quota %d bytes' % limit if limit is not None else 'no quota'))
+            config.append('%s.min 0' % field_name(user))
+
+        config.extend([
+            'multigraph nextcloud_quota_distribution',
+            'graph_title Nextcloud quota usage distribution',
+            'graph_args --base 1000 -l 0',
+            'graph_printf %.0lf',
+            'graph_vlabel users',
+            'graph_info graph showing how many users use how much of their quota',
+            'graph_category nextcloud',
+        ])
+        bound = 0
+        for name, upper in quota.BUCKETS:
+            label = '%d%% to %d%%' % (bound, upper) if upper is not None else 'over quota'
+            config.extend(['%s.label %s' % (name, label), '%s.draw AREASTACK' % name, '%s.min 0' % name])
+            bound = upper
+        config.extend(['unlimited.label no quota', 'unlimited.draw AREASTACK', 'unlimited.min 0'])
+
+        config.extend([
+            'multigraph nextcloud_quota_collection',
+            'graph_title Nextcloud quota collection',
+            'graph_args --base 1000 -l 0',
+            'graph_printf %.0lf',
+            'graph_vlabel users',
+            'graph_info graph showing how up to date the per-user usage is',
+            'graph_category nextcloud',
+            'known.label known users',
+            'known.info users whose usage was fetched at least once',
+            'known.min 0',
+            'refreshed.label refreshed',
+            'refreshed.info users whose usage was fetched in this run',
+            'refreshed.min 0',
+            'failed.label failed',
+            'failed.info users whose usage could not be fetched in time in this run',
+            'failed.min 0',
+            'stale.label stale',
+            'stale.info users whose usage is older than env.quota_ttl',
+            'stale.min 0',
+        ])
+        return config
+
+    def collect(self):
+        if not self.url:
+            return 'env variable url is missing'
+
+        self.result = list()
+        try:
+            state, refreshed, failed = quota.refresh(self.url, self.username, self.password)
+        except Exception as e:
+            return 'quota collection failed: %s' % e
+
+        self.result.append('multigraph nextcloud_quota_top')
+        for user, used, _ in quota.drawn(state):
+            self.result.append('%s.value %d' % (field_name(user), used))
+
+        self.result.append('multigraph nextcloud_quota_distribution')
+        for name, count in quota.distribution(state).items():
+            self.result.append('%s.value %d' % (name, count))
+
+        ttl = float(os.environ.get('quota_ttl', quota.DEFAULT_TTL))
+        now = time.time()
+        self.result.extend([
+            'multigraph nextcloud_quota_collection',
+            'known.value %d' % len(quota.known(state)),
+            'refreshed.value %d' % refreshed,
+            'failed.value %d' % failed,
+            'stale.value %d' % sum(1 for entry in state['users'].values() if now - entry['time'] >= ttl),
+        ])
+        return None
+
+
+if __name__ == "__main__":
+    NextcloudQuota().main()